@@ -0,0 +1,61 @@
+""" Find and recognize faces in recorded videos and image archives
+
+Usage: python batch_process.py /recordings/door /dumps/2019-06 --out results.db --stride 5
+
+Videos are split into chunks of frames processed on a pool of processes, every process
+decoding, detecting and recognizing its own chunks. Faces are written to an SQLite results
+file indexed by name and by source and frame. Running the same command again after an
+interruption only processes the chunks that are not in the results file yet.
+"""
+import argparse
+import sys
+import time
+
+from components.batch import BatchResults, process_media
+from components.face_detector import PROFILES
+from components.util.projection import PRECISIONS
+
+parser = argparse.ArgumentParser(description="Find and recognize faces in recorded videos and images")
+
+parser.add_argument("inputs", nargs='+', help="Video files, image files or folders searched recursively")
+parser.add_argument("--out", default='results.db', help="SQLite results file, resumed if it exists")
+parser.add_argument("--facespace", default='./data/faces/facespace', help="Model directory written by extract_facespace.py, or legacy facespace pickle file")
+parser.add_argument("--precision", choices=PRECISIONS, default=None, help="Projection precision, the storage type of the facespace if omitted")
+parser.add_argument("--thresh", type=float, default=6000, help="Distance under which a face is recognized as its closest known face")
+parser.add_argument("--start", type=float, default=0.0, help="Seconds into every video to start at")
+parser.add_argument("--end", type=float, default=None, help="Seconds into every video to stop at, the end if omitted")
+parser.add_argument("--stride", type=int, default=1, help="Process every STRIDE-th frame of the videos")
+parser.add_argument("--chunk-frames", type=int, default=600, dest="chunk_frames", help="Frames of a video per work unit, the granularity of resuming")
+parser.add_argument("--workers", type=int, default=None, help="Number of processes, all cores if omitted, 0 to process in this process")
+parser.add_argument("--detect-profile", choices=list(PROFILES), default='accurate', dest="detect_profile", help="Cascade search profile, faster profiles detect on a downscaled frame")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    assert args.stride >= 1, "--stride must be at least 1"
+
+    results = BatchResults(args.out)
+    start = time.perf_counter()
+    processed = {'units': 0, 'frames': 0}
+
+    def progress(unit, frames, faces):
+        processed['units'] += 1
+        processed['frames'] += frames
+        elapsed = time.perf_counter() - start
+        sys.stdout.write(f"\r{processed['units']} units, {processed['frames']} frames, "
+                         f"{processed['frames']/elapsed:.1f} frames/s")
+        sys.stdout.flush()
+
+    try:
+        stats = process_media(args.inputs, results, args.facespace, workers=args.workers, start=args.start,
+                              end=args.end, stride=args.stride, chunk_frames=args.chunk_frames,
+                              profile=args.detect_profile, progress=progress,
+                              recognizer_kwargs=dict(precision=args.precision, thresh=args.thresh,
+                                                     contrast_coeff=1, brightness_coeff=100))
+    finally:
+        results.close()
+
+    elapsed = time.perf_counter() - start
+    print(f"\n{stats['frames']} frames and {stats['faces']} faces in {elapsed:.2f}s "
+          f"({stats['frames']/elapsed if elapsed > 0 else 0:.1f} frames/s), "
+          f"{stats['skipped']} of {stats['units']} units already in {args.out}")
@@ -0,0 +1,77 @@
+""" Benchmark fisheye calibration on synthetic chessboard views
+
+Usage: python -m benchmarks.calibration --views 300 --resolution 960 1280 --processes 1 4
+
+Views of a chessboard at random poses are rendered with a known fisheye calibration and
+written as PNG files, or read from --images. Corners are found serially at full resolution,
+then on process pools with the downscaled first pass, and the recovered calibration is
+compared with the one the views were rendered with.
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+
+import cv2
+
+from benchmarks.synthetic import synthetic_calibration_views
+from components.util.camera import find_chessboard_corners, find_corners_in_files, calibrate_fisheye
+from components.util.image import list_images
+
+parser = argparse.ArgumentParser(description="Benchmark fisheye calibration")
+
+parser.add_argument("--images", default=None, help="Folder of chessboard images, synthetic views if omitted")
+parser.add_argument("--views", type=int, default=300, help="Number of synthetic views")
+parser.add_argument("--resolution", type=int, nargs=2, default=[960, 1280], metavar=('H', 'W'), help="Size of the synthetic views")
+parser.add_argument("--board", type=int, nargs=2, default=[7, 7], metavar=('COLS', 'ROWS'), help="Inner corners of the chessboard")
+parser.add_argument("--processes", type=int, nargs='+', default=sorted({1, os.cpu_count()}), help="Numbers of corner finding processes")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    board_size = tuple(args.board)
+
+    workdir, truth = None, None
+    if args.images is None:
+        workdir = tempfile.mkdtemp(prefix='pybell-calibration-')
+        images, K, D = synthetic_calibration_views(args.views, tuple(args.resolution), board_size)
+        for i, img in enumerate(images):
+            cv2.imwrite(os.path.join(workdir, f'{i:04d}.png'), img)
+        truth = (K, D)
+    paths = list_images(args.images or workdir)
+
+    try:
+        start = time.perf_counter()
+        serial = [find_chessboard_corners(cv2.imread(path, cv2.IMREAD_GRAYSCALE), board_size, downscale=1) for path in paths]
+        serial_time = time.perf_counter() - start
+        print(f"serial full resolution: {serial_time:6.2f}s boards={sum(c is not None for c in serial)}")
+
+        results = list()
+        for processes in args.processes:
+            start = time.perf_counter()
+            views, image_size = find_corners_in_files(paths, board_size, processes=processes)
+            corners_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            K, D, rms, used = calibrate_fisheye([corners for _, corners in views], image_size, board_size)
+            calibrate_time = time.perf_counter() - start
+
+            result = {'processes': processes, 'images': len(paths), 'boards': len(views), 'used': len(used),
+                      'corners_s': corners_time, 'calibrate_s': calibrate_time, 'serial_corners_s': serial_time,
+                      'rms_px': rms}
+            if truth is not None:
+                result['focal_error'] = float(abs(K[0, 0]/truth[0][0, 0] - 1))
+            results.append(result)
+            print(f"processes={processes:<3} corners={corners_time:6.2f}s calibrate={calibrate_time:6.2f}s "
+                  f"boards={len(views)} used={len(used)} rms={rms:.3f}px"
+                  + (f" focal error={result['focal_error']:.2%}" if truth is not None else ''))
+    finally:
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,93 @@
+""" Benchmark speed and recall of the face detection profiles on a recorded clip
+
+Usage: python -m benchmarks.detection_profiles --clip door.mp4 --profiles accurate balanced fast
+
+Every profile runs on the same frames. Recall is measured against the detections of a
+reference profile, full resolution 'accurate' by default: a reference face counts as
+found when a detection overlaps it with an IoU of at least --iou.
+"""
+import argparse
+import json
+import time
+
+import cv2
+
+from components.face_detector import FaceDetector, DetectionProfile, PROFILES
+from components.tracker import iou
+from components.util.image import cvt_to_gray
+
+parser = argparse.ArgumentParser(description="Benchmark face detection profiles")
+
+parser.add_argument("--clip", required=True, help="Recorded video file to run detection on")
+parser.add_argument("--profiles", nargs='+', default=list(PROFILES), choices=list(PROFILES), help="Profiles to benchmark")
+parser.add_argument("--reference", default='accurate', choices=list(PROFILES), help="Profile whose detections recall is measured against")
+parser.add_argument("--face-distance", type=float, nargs=2, default=None, dest="face_distance", metavar=('MIN', 'MAX'), help="Also benchmark every profile limited to faces seen between these distances in meters")
+parser.add_argument("--focal-length", type=float, default=None, dest="focal_length", help="Focal length in pixels for --face-distance")
+parser.add_argument("--max-frames", type=int, default=300, dest="max_frames", help="Maximum number of frames to read from the clip")
+parser.add_argument("--iou", type=float, default=0.5, help="Minimum IoU of a detection matching a reference face")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+def load_clip(path, max_frames):
+    """Read up to max_frames grayscale frames of a video file"""
+    capture = cv2.VideoCapture(path)
+    frames = list()
+    while len(frames) < max_frames:
+        ok, img = capture.read()
+        if not ok:
+            break
+        frames.append(cvt_to_gray(img))
+    capture.release()
+    return frames
+
+
+def run_profile(profile, frames):
+    """Detect faces in every frame, returning the detections and the detection time"""
+    detector = FaceDetector(profile=profile)
+    detections = list()
+    start = time.perf_counter()
+    for gray in frames:
+        detections.append(detector.detectFaces(gray, gray=gray)[1])
+    return detections, time.perf_counter() - start
+
+
+def recall(detections, reference, iou_thresh):
+    """Fraction of the reference faces overlapped by a detection of the same frame"""
+    found, expected = 0, 0
+    for bboxes, reference_bboxes in zip(detections, reference):
+        expected += len(reference_bboxes)
+        found += sum(any(iou(r, b) >= iou_thresh for b in bboxes) for r in reference_bboxes)
+    return found/expected if expected else 1.0
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    frames = load_clip(args.clip, args.max_frames)
+    assert frames, f"No frames could be read from {args.clip}"
+
+    profiles = [(name, DetectionProfile(**PROFILES[name])) for name in args.profiles]
+    if args.face_distance:
+        assert args.focal_length, "--face-distance needs --focal-length"
+        min_distance, max_distance = args.face_distance
+        profiles += [(name + '+geometry', DetectionProfile.from_camera_geometry(
+                          args.focal_length, min_distance, max_distance, **PROFILES[name]))
+                     for name in args.profiles]
+
+    reference, _ = run_profile(DetectionProfile(**PROFILES[args.reference]), frames)
+
+    results = list()
+    for name, profile in profiles:
+        detections, elapsed = run_profile(profile, frames)
+        result = {
+            'profile': name,
+            'frames': len(frames),
+            'fps': len(frames)/elapsed,
+            'faces': sum(len(bboxes) for bboxes in detections),
+            'recall': recall(detections, reference, args.iou),
+        }
+        results.append(result)
+        print(f"{name:>20}: {result['fps']:7.1f} fps faces={result['faces']:<5} recall={result['recall']:.3f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
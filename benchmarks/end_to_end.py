@@ -0,0 +1,274 @@
+""" End-to-end benchmark of the pybell.py pipeline on recorded or synthetic clips
+
+Usage: python -m benchmarks.end_to_end --clip door.mp4 --gallery-sizes 0 1000 10000 --out results.json -- --track
+
+Clips are replayed through a file-backed CameraStream and the pipeline built by pybell.py,
+consumed by its main loop without the display, once per gallery size. Every run executes in
+a fresh process so that its memory high-water mark is its own. Arguments after -- are
+pybell.py options, e.g. --track or --detect-profile fast.
+
+Per stage and end-to-end latency percentiles, FPS and peak memory are reported and saved
+with the git commit they were measured on. --compare reports the runs whose FPS dropped or
+whose latency grew by more than --tolerance against results saved on another commit.
+"""
+import argparse
+import concurrent.futures
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import cv2
+
+import pybell
+from benchmarks.synthetic import synthetic_clip, synthetic_faces, write_clip
+from components.camera import CameraStream
+from components.face_detector import FaceDetector
+from components.face_recognizer import FaceRecognizer
+from components.motion_gate import MotionGate
+from components.parallel_detector import ParallelFaceDetector
+from components.pipeline import Closed
+from components.sinks import annotate
+from components.tracker import FaceTracker
+from components.util.eigenfaces import extract_facespace
+from components.util.model import save_model
+
+PERCENTILES = (50, 90, 95, 99)
+
+parser = argparse.ArgumentParser(description="Benchmark the detection and recognition pipeline end to end",
+                                 usage="python -m benchmarks.end_to_end [options] [-- pybell.py options]")
+
+parser.add_argument("--clip", nargs='+', default=None, help="Recorded video files to replay, a synthetic clip if omitted")
+parser.add_argument("--frames", type=int, default=300, help="Number of frames of the synthetic clip")
+parser.add_argument("--resolution", type=int, nargs=2, default=[480, 640], metavar=('H', 'W'), help="Frame size of the synthetic clip")
+parser.add_argument("--faces", type=int, default=2, help="Number of faces moving across the synthetic clip")
+parser.add_argument("--save-clip", default=None, dest="save_clip", help="Also save the synthetic clip to this video file, to replay it on other commits")
+parser.add_argument("--model", default=None, help="Model directory or facespace pickle, a synthetic facespace if omitted")
+parser.add_argument("--components", type=int, default=100, help="Components of the synthetic facespace")
+parser.add_argument("--gallery-sizes", type=int, nargs='+', default=[0, 1000, 10000], dest="gallery_sizes", help="Numbers of known faces added to the gallery, one run each")
+parser.add_argument("--realtime", action="store_true", help="Read clips with the background grabber, dropping frames like a live camera, instead of processing every frame")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+parser.add_argument("--compare", default=None, help="Results JSON of a previous run to compare with")
+parser.add_argument("--tolerance", type=float, default=0.1, help="Relative FPS drop or latency increase reported as a regression")
+
+
+def summarize(durations):
+    """Latency percentiles, mean and max of durations in seconds, in milliseconds"""
+    if not durations:
+        return {'count': 0}
+    ms = 1000*np.asarray(durations)
+    summary = {f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(ms, PERCENTILES))}
+    summary.update(count=len(ms), mean=float(ms.mean()), max=float(ms.max()))
+    return summary
+
+
+def max_rss_mb():
+    """Memory high-water mark of the current process"""
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return rss/2**20 if sys.platform == 'darwin' else rss/2**10
+
+
+def timed(func, durations):
+    """Wrap a stage function to record how long it takes on every item it passes on"""
+    def wrapper(item):
+        start = time.perf_counter()
+        result = func(item)
+        if result is not None:
+            durations.append(time.perf_counter() - start)
+        return result
+    return wrapper
+
+
+def run_clip(clip, model_path, gallery_size, pybell_argv, realtime):
+    """ Replay a clip through the pybell.py pipeline, in a process of its own
+
+        Returns:
+            result (dict): FPS, end-to-end and per stage latency summaries and peak memory
+    """
+    options = pybell.parser.parse_args(pybell_argv)
+    # Replays process every frame unless they mimic a live camera
+    options.no_drop = options.no_drop or not realtime
+
+    recognizer = FaceRecognizer.from_model(model_path, save_gallery=False, precision=options.precision,
+                                           thresh=6000, contrast_coeff=1, brightness_coeff=100)
+    # Known faces are made in batches, so they do not inflate the peak memory of the run
+    for start in range(0, gallery_size, 1000):
+        n_faces = min(1000, gallery_size - start)
+        faces = synthetic_faces(n_faces, shape=tuple(recognizer.img_shape), seed=start)
+        recognizer.add_known_faces([f'person-{start + i}' for i in range(n_faces)], faces)
+
+    profile = pybell.detection_profile(options)
+    if options.detect_processes:
+        detector = ParallelFaceDetector(options.detect_processes, profile=profile, tiles=options.detect_tiles)
+    else:
+        detector = FaceDetector(profile=profile)
+
+    motion_gate = None
+    if options.motion_gate:
+        motion_gate = MotionGate(method=options.motion_gate, pixel_thresh=options.motion_thresh,
+                                 min_area=options.motion_min_area, hold_frames=options.motion_hold)
+    tracker = None
+    if options.track:
+        tracker = FaceTracker(recognizer, motion=options.track_motion, recognize_every=options.recognize_every)
+
+    cam = CameraStream(clip, threaded=realtime)
+    pipeline = pybell.build_pipeline(cam, detector, recognizer, queue.Queue(), options, motion_gate, tracker)
+    stage_durations = {stage.name: list() for stage in pipeline.stages}
+    for stage in pipeline.stages:
+        stage.func = timed(stage.func, stage_durations[stage.name])
+
+    # Main loop of pybell.py, without showing frames or reading commands
+    latencies, n_faces, skipped, last_frame_id = list(), 0, 0, -1
+    start = time.perf_counter()
+    pipeline.start()
+    try:
+        while True:
+            try:
+                packet = pipeline.get(timeout=1)
+            except TimeoutError:
+                continue
+            except Closed:
+                break
+
+            if packet.frame_id < last_frame_id:
+                skipped += 1
+                continue
+            last_frame_id = packet.frame_id
+
+            # Labels are drawn as for the preview and video sinks
+            annotate(packet)
+            latencies.append(time.monotonic() - packet.timestamp)
+            n_faces += len(packet.bboxes)
+        elapsed = time.perf_counter() - start
+        stats = pipeline.stats()
+    finally:
+        pipeline.stop()
+        cam.stop()
+        if options.detect_processes:
+            detector.close()
+
+    return {
+        'gallery_size': len(recognizer.gallery),
+        'frames': len(latencies),
+        'faces': n_faces,
+        'fps': len(latencies)/elapsed if elapsed > 0 else 0.0,
+        'latency_ms': summarize(latencies),
+        'stages': {name: dict(summarize(durations), dropped=stats[name]['dropped'], errors=stats[name]['errors'])
+                   for name, durations in stage_durations.items()},
+        'camera_dropped': cam.dropped_frames,
+        'skipped': skipped,
+        'recognitions': tracker.recognitions if tracker is not None else None,
+        'max_rss_mb': max_rss_mb(),
+    }
+
+
+def git(*args):
+    """Output of a git command run in the repository, None if git is unavailable"""
+    try:
+        output = subprocess.run(('git',) + args, cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.stdout.decode().strip()
+
+
+def environment():
+    """Commit and environment the results were measured in"""
+    status = git('status', '--porcelain', '--untracked-files=no')
+    return {
+        'commit': git('rev-parse', 'HEAD'),
+        'dirty': bool(status) if status is not None else None,
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'cpu_count': os.cpu_count(),
+    }
+
+
+def compare(baseline, results, tolerance):
+    """ Print the change of every run against the matching run of a baseline
+
+        Returns:
+            regressions (List): descriptions of the runs that got slower than tolerance allows
+    """
+    previous = {(run['clip'], run['gallery_size']): run for run in baseline['runs']}
+    print(f"Compared with commit {baseline['environment'].get('commit')}")
+
+    regressions = list()
+    for run in results['runs']:
+        old = previous.get((run['clip'], run['gallery_size']))
+        if old is None or not old['fps'] or not run['latency_ms'].get('count'):
+            continue
+        fps_change = run['fps']/old['fps'] - 1
+        p95_change = run['latency_ms']['p95']/old['latency_ms']['p95'] - 1
+        print(f"{run['clip']:>20} gallery={run['gallery_size']:<6} fps {fps_change:+7.1%} p95 latency {p95_change:+7.1%}")
+        if fps_change < -tolerance or p95_change > tolerance:
+            regressions.append(f"{run['clip']} gallery={run['gallery_size']}")
+    return regressions
+
+
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    split = argv.index('--') if '--' in argv else len(argv)
+    args = parser.parse_args(argv[:split])
+    pybell_argv = argv[split + 1:]
+    # Fail early on invalid pybell.py options
+    pybell.parser.parse_args(pybell_argv)
+
+    workdir = tempfile.mkdtemp(prefix='pybell-benchmark-')
+    try:
+        clips = {os.path.basename(clip): clip for clip in args.clip or list()}
+        if not clips:
+            frames, _ = synthetic_clip(tuple(args.resolution), args.frames, n_faces=args.faces,
+                                       size=args.resolution[0]//4)
+            path = args.save_clip or os.path.join(workdir, 'synthetic.avi')
+            write_clip(path, frames)
+            clips[f'synthetic-{args.resolution[0]}x{args.resolution[1]}-{args.faces}'] = path
+
+        model_path = args.model
+        if model_path is None:
+            faces = synthetic_faces(1000)
+            facespace, mean_face = extract_facespace(faces, args.components)
+            model_path = os.path.join(workdir, 'model')
+            save_model(model_path, facespace, mean_face, faces.shape[1:])
+
+        results = {'environment': environment(), 'config': dict(vars(args), pybell_args=pybell_argv), 'runs': list()}
+        for name, clip in clips.items():
+            for gallery_size in args.gallery_sizes:
+                # A fresh process per run, so memory high-water marks do not carry over
+                with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as pool:
+                    run = pool.submit(run_clip, clip, model_path, gallery_size, pybell_argv, args.realtime).result()
+                run['clip'] = name
+                results['runs'].append(run)
+
+                latency = run['latency_ms']
+                print(f"{name:>20} gallery={run['gallery_size']:<6} {run['fps']:6.1f} fps "
+                      f"latency p50={latency.get('p50', 0):7.2f} p95={latency.get('p95', 0):7.2f} "
+                      f"p99={latency.get('p99', 0):7.2f} ms rss={run['max_rss_mb']:6.1f}MB")
+                for stage, summary in run['stages'].items():
+                    print(f"{stage:>31}: p50={summary.get('p50', 0):7.2f} p95={summary.get('p95', 0):7.2f} "
+                          f"p99={summary.get('p99', 0):7.2f} ms")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.tolerance)
+        if regressions:
+            print(f"Regressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+            sys.exit(1)
@@ -0,0 +1,92 @@
+""" Benchmark recall and latency of the gallery indexes against brute force search
+
+Usage: python -m benchmarks.gallery_index --sizes 1000 10000 50000 --indexes brute kdtree ivfpq
+
+The gallery is synthetic: eigenface coefficients with a decaying variance, queries are
+enrolled faces with added noise, similar to a known person seen again at the door.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from components.util.gallery_index import create_index, INDEX_TYPES
+
+parser = argparse.ArgumentParser(description="Benchmark gallery nearest neighbour indexes")
+
+parser.add_argument("--sizes", type=int, nargs='+', default=[1000, 10000, 50000], help="Gallery sizes to benchmark")
+parser.add_argument("--indexes", nargs='+', default=list(INDEX_TYPES), choices=INDEX_TYPES, help="Indexes to benchmark")
+parser.add_argument("--components", type=int, default=250, help="Dimension of the facespace")
+parser.add_argument("--queries", type=int, default=500, help="Number of queries")
+parser.add_argument("--noise", type=float, default=0.05, help="Query noise relative to coefficient scale")
+parser.add_argument("--radius", type=float, default=None, help="Radius for radius query recall, median NN distance if omitted")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+def synthetic_gallery(size, components, n_queries, noise, seed=0):
+    """Generate gallery vectors and noisy queries of known gallery members"""
+    rng = np.random.RandomState(seed)
+    scale = 1000/np.sqrt(np.arange(1, components + 1))
+    gallery = rng.randn(size, components)*scale
+    sources = rng.choice(size, n_queries, replace=False)
+    queries = gallery[sources] + rng.randn(n_queries, components)*scale*noise
+    return gallery, queries
+
+
+def benchmark_index(kind, gallery, queries, truth_ids, radius, truth_radius):
+    """Build an index incrementally and time single and batched queries"""
+    index = create_index(kind)
+
+    start = time.perf_counter()
+    for i in range(0, len(gallery), 100):
+        index.add(gallery[i:i+100], np.arange(i, min(i+100, len(gallery))))
+    build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ids = np.vstack([index.search(q, k=1)[1] for q in queries])
+    single_latency = (time.perf_counter() - start)/len(queries)
+
+    start = time.perf_counter()
+    index.search(queries, k=1)
+    batch_latency = (time.perf_counter() - start)/len(queries)
+
+    matches = index.radius_search(queries, radius)
+    found = sum(len(np.intersect1d(m_ids, t_ids)) for (m_ids, _), (t_ids, _) in zip(matches, truth_radius))
+    expected = sum(len(t_ids) for t_ids, _ in truth_radius)
+
+    return {
+        'index': kind,
+        'size': len(gallery),
+        'build_s': build_time,
+        'single_query_ms': single_latency*1000,
+        'batch_query_ms': batch_latency*1000,
+        'recall_at_1': float(np.mean(ids[:, 0] == truth_ids)),
+        'radius_recall': found/expected if expected else 1.0,
+    }
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    results = list()
+    for size in args.sizes:
+        gallery, queries = synthetic_gallery(size, args.components, args.queries, args.noise)
+
+        # Exact answers from the current brute force path
+        truth_index = create_index('brute')
+        truth_index.add(gallery, np.arange(size))
+        truth_dist, truth_ids = truth_index.search(queries, k=1)
+        radius = args.radius or float(np.median(truth_dist))
+        truth_radius = truth_index.radius_search(queries, radius)
+
+        for kind in args.indexes:
+            result = benchmark_index(kind, gallery, queries, truth_ids[:, 0], radius, truth_radius)
+            results.append(result)
+            print(f"{kind:>8} K={size:<7} build={result['build_s']:.2f}s "
+                  f"single={result['single_query_ms']:.3f}ms batch={result['batch_query_ms']:.3f}ms "
+                  f"recall@1={result['recall_at_1']:.3f} radius_recall={result['radius_recall']:.3f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
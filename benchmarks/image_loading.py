@@ -0,0 +1,51 @@
+""" Benchmark training set ingestion: serial color decoding against threaded grayscale decoding
+
+Usage: python -m benchmarks.image_loading --folder ./data/training/faces --workers 1 4 8
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import cv2
+
+from components.util.image import list_images, load_image_batches, cvt_to_gray
+
+parser = argparse.ArgumentParser(description="Benchmark face image loading")
+
+parser.add_argument("--folder", default='./data/training/faces', help="Folder holding face images")
+parser.add_argument("--max-images", type=int, default=0, dest="nb_images", help="Maximum number of images to load, 0 for all")
+parser.add_argument("--shape", type=int, nargs=2, default=[64, 64], metavar=('H', 'W'), help="Shape faces are resized to")
+parser.add_argument("--workers", type=int, nargs='+', default=[1, 2, 4, 8], help="Numbers of decoding threads")
+parser.add_argument("--batch-size", type=int, default=1024, dest="batch_size", help="Images per batch")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+def serial_color(paths, shape):
+    """The previous loader: decode color, convert to gray, resize, stack a list"""
+    images = [cv2.resize(cvt_to_gray(cv2.imread(p)), (shape[1], shape[0])) for p in paths]
+    return np.array(images)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    paths = list_images(args.folder, args.nb_images)
+    assert paths, f"No images found in {args.folder}"
+
+    start = time.perf_counter()
+    serial_color(paths, args.shape)
+    serial = len(paths)/(time.perf_counter() - start)
+    print(f"serial color: {serial:8.1f} images/s")
+
+    results = [{'loader': 'serial_color', 'images_per_s': serial}]
+    for workers in args.workers:
+        start = time.perf_counter()
+        for _ in load_image_batches(paths, args.batch_size, shape=args.shape, workers=workers):
+            pass
+        rate = len(paths)/(time.perf_counter() - start)
+        results.append({'loader': 'threaded_gray', 'workers': workers, 'images_per_s': rate})
+        print(f"workers={workers:<3} {rate:8.1f} images/s speedup={rate/serial:.2f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,82 @@
+""" Benchmark face detection throughput against the number of worker processes
+
+Usage: python -m benchmarks.parallel_detection --resolutions 1080p 4k --processes 1 2 4 8
+
+Frames are synthetic, with faces moving across them, unless --clip gives a recording that
+is then resized to every resolution. Throughput of ParallelFaceDetector is reported for
+whole frames and for tiled frames, with the speedup over a single FaceDetector.
+"""
+import argparse
+import json
+import os
+import time
+
+import cv2
+
+from benchmarks.synthetic import synthetic_clip
+from components.face_detector import FaceDetector, PROFILES
+from components.parallel_detector import ParallelFaceDetector
+from components.util.image import cvt_to_gray
+
+RESOLUTIONS = {'480p': (480, 640), '720p': (720, 1280), '1080p': (1080, 1920), '4k': (2160, 3840)}
+
+parser = argparse.ArgumentParser(description="Benchmark process pool face detection")
+
+parser.add_argument("--resolutions", nargs='+', default=['1080p', '4k'], choices=list(RESOLUTIONS), help="Frame sizes to benchmark")
+parser.add_argument("--processes", type=int, nargs='+', default=sorted({1, 2, 4, os.cpu_count()}), help="Numbers of worker processes")
+parser.add_argument("--tiles", type=int, nargs=2, default=[2, 2], metavar=('ROWS', 'COLS'), help="Tile grid of the tiled runs")
+parser.add_argument("--profile", default='accurate', choices=list(PROFILES), help="Detection profile")
+parser.add_argument("--frames", type=int, default=32, help="Number of frames per run")
+parser.add_argument("--clip", default=None, help="Recorded video file to use instead of synthetic frames")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+def load_frames(args, shape):
+    """Synthetic frames or frames of the clip resized to shape"""
+    if args.clip is None:
+        return synthetic_clip(shape, args.frames, n_faces=3, size=shape[0]//6)[0]
+
+    capture = cv2.VideoCapture(args.clip)
+    frames = list()
+    while len(frames) < args.frames:
+        ok, img = capture.read()
+        if not ok:
+            break
+        frames.append(cv2.resize(cvt_to_gray(img), (shape[1], shape[0])))
+    capture.release()
+    return frames
+
+
+def throughput(detect, frames):
+    """Frames per second of a function detecting faces in all frames"""
+    start = time.perf_counter()
+    detect(frames)
+    return len(frames)/(time.perf_counter() - start)
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    results = list()
+    for resolution in args.resolutions:
+        frames = load_frames(args, RESOLUTIONS[resolution])
+        detector = FaceDetector(profile=args.profile)
+        serial = throughput(lambda frames: [detector.detectFaces(f) for f in frames], frames)
+        print(f"{resolution:>6} serial: {serial:6.2f} fps")
+
+        for processes in args.processes:
+            for tiles in [(1, 1), tuple(args.tiles)]:
+                with ParallelFaceDetector(processes, profile=args.profile, tiles=tiles) as parallel:
+                    # Start the workers before timing
+                    parallel.detectFaces(frames[0])
+                    fps = throughput(lambda frames: list(parallel.detect_frames(frames)), frames)
+
+                result = {'resolution': resolution, 'processes': processes, 'tiles': list(tiles),
+                          'fps': fps, 'serial_fps': serial, 'speedup': fps/serial}
+                results.append(result)
+                print(f"{resolution:>6} processes={processes:<3} tiles={tiles[0]}x{tiles[1]} "
+                      f"{fps:6.2f} fps speedup={result['speedup']:.2f}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
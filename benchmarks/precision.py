@@ -0,0 +1,96 @@
+""" Benchmark accuracy against speed of the recognizer's projection precisions
+
+Usage: python -m benchmarks.precision --dataset ./data/training/faces.pack --model ./data/faces/facespace
+
+The evaluation set is made of faces of a packed dataset, or of synthetic faces if none is
+given. Each face is enrolled, then recognized again with pixel noise and a brightness
+shift, like a known person seen again at the door. Every precision is compared with the
+float64 recognizer: recall@1, agreement of the recognized identities, error of the
+projections, facespace memory and projection latency.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_faces
+from components.face_recognizer import FaceRecognizer
+from components.util.dataset import open_faces
+from components.util.eigenfaces import extract_facespace, PRECISIONS
+from components.util.model import load_facespace
+
+parser = argparse.ArgumentParser(description="Benchmark recognizer projection precisions")
+
+parser.add_argument("--dataset", default=None, help="Dataset packed by pack_faces.py, synthetic faces if omitted")
+parser.add_argument("--model", default=None, help="Model directory or facespace pickle, extracted from the evaluation faces if omitted")
+parser.add_argument("--precisions", nargs='+', default=list(PRECISIONS), choices=PRECISIONS, help="Precisions to benchmark")
+parser.add_argument("--faces", type=int, default=1000, help="Number of evaluation faces")
+parser.add_argument("--components", type=int, default=250, help="Components of the extracted facespace")
+parser.add_argument("--noise", type=float, default=8, help="Standard deviation of the pixel noise of queries")
+parser.add_argument("--batch", type=int, default=32, help="Faces per batch for the batched latency")
+parser.add_argument("--out", default=None, help="Optional JSON file to write results to")
+
+
+def latency(recognizer, faces, batch):
+    """Mean projection time per face, one face at a time and in batches"""
+    start = time.perf_counter()
+    for face in faces[:200]:
+        recognizer._project_batch_to_facespace([face])
+    single = (time.perf_counter() - start)/min(len(faces), 200)
+
+    start = time.perf_counter()
+    for i in range(0, len(faces), batch):
+        recognizer._project_batch_to_facespace(faces[i:i+batch])
+    batched = (time.perf_counter() - start)/len(faces)
+    return single, batched
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    rng = np.random.RandomState(1)
+
+    if args.dataset:
+        faces = np.asarray(open_faces(args.dataset).faces[:args.faces])
+    else:
+        faces = synthetic_faces(args.faces)
+
+    if args.model:
+        model = load_facespace(args.model, mmap=False)
+    else:
+        facespace, mean_face = extract_facespace(faces, min(args.components, len(faces)))
+        model = {'facespace': facespace, 'mean_face': mean_face, 'img_shape': faces.shape[1:]}
+
+    queries = np.clip(faces + rng.randn(*faces.shape)*args.noise + rng.uniform(-10, 10, (len(faces), 1, 1)),
+                      0, 255).astype(np.uint8)
+    names = [str(i) for i in range(len(faces))]
+
+    results, reference = list(), None
+    for precision in args.precisions:
+        recognizer = FaceRecognizer(model['mean_face'], model['facespace'], img_shape=model['img_shape'],
+                                    thresh=np.inf, precision=precision, facespace_scales=model.get('facespace_scales'))
+        recognizer.add_known_faces(names, faces)
+        found, _ = recognizer.recognize_batch(queries)
+        projections = recognizer._project_batch_to_facespace(queries).astype(np.float64)
+        if reference is None:
+            reference = (found, projections)
+
+        single, batched = latency(recognizer, queries, args.batch)
+        error = np.abs(projections - reference[1]).max()/np.abs(reference[1]).max()
+        result = {
+            'precision': precision,
+            'facespace_mb': recognizer.facespace.nbytes/2**20,
+            'single_ms': single*1000,
+            'batch_ms': batched*1000,
+            'recall_at_1': float(np.mean([a == b for a, b in zip(found, names)])),
+            'agreement': float(np.mean([a == b for a, b in zip(found, reference[0])])),
+            'max_relative_error': float(error),
+        }
+        results.append(result)
+        print(f"{precision:>8}: facespace={result['facespace_mb']:6.2f}MB single={result['single_ms']:.3f}ms "
+              f"batch={result['batch_ms']:.3f}ms recall@1={result['recall_at_1']:.3f} "
+              f"agreement={result['agreement']:.3f} error={result['max_relative_error']:.1e}")
+
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
@@ -0,0 +1,163 @@
+""" Synthetic frames with faces the Haar cascades detect, for benchmarks without recordings """
+import numpy as np
+import cv2
+
+
+def draw_face(size=100, skin=170, background=200):
+    """ Draw a frontal cartoon face: head, eyes, brows, nose and mouth
+
+        Args:
+            size (int): width and height of the face image
+            skin (int): gray level of the head
+            background (int): gray level around the head
+
+        Returns:
+            face (size x size np.array): uint8 face image
+    """
+    face = np.full((size, size), background, dtype=np.uint8)
+    c = size//2
+    cv2.ellipse(face, (c, c), (int(size*.38), int(size*.48)), 0, 0, 360, skin, -1)
+    for side in (-1, 1):
+        cv2.ellipse(face, (c + side*int(size*.17), int(size*.38)), (int(size*.09), int(size*.04)), 0, 0, 360, 40, -1)
+        cv2.line(face, (c + side*int(size*.08), int(size*.28)), (c + side*int(size*.27), int(size*.28)), 60, 3)
+    cv2.line(face, (c, int(size*.42)), (c, int(size*.6)), 120, 3)
+    cv2.ellipse(face, (c, int(size*.73)), (int(size*.14), int(size*.04)), 0, 0, 360, 70, -1)
+    return cv2.GaussianBlur(face, (5, 5), 0)
+
+
+def synthetic_frame(shape, faces, background=200, noise=0, rng=None):
+    """ Draw faces on a plain background
+
+        Args:
+            shape (tuple): (H, W) of the frame
+            faces (List): (x, y, size) of every face
+            noise (float): standard deviation of added gaussian noise
+            rng (np.random.RandomState): random state used for the noise
+
+        Returns:
+            frame (H x W np.array): uint8 grayscale frame
+    """
+    frame = np.full(shape, background, dtype=np.uint8)
+    for x, y, size in faces:
+        frame[y:y+size, x:x+size] = draw_face(size, background=background)
+    if noise:
+        rng = rng or np.random.RandomState(0)
+        frame = np.clip(frame + rng.randn(*shape)*noise, 0, 255).astype(np.uint8)
+    return frame
+
+
+def synthetic_clip(shape, n_frames, n_faces=1, size=100, speed=4, noise=2, seed=0):
+    """ Frames of faces moving across a frame, like people walking past the door
+
+        Returns:
+            frames (List): uint8 grayscale frames
+            truth (List): (x, y, size, size) boxes of the faces drawn in every frame
+    """
+    rng = np.random.RandomState(seed)
+    height, width = shape
+    starts = rng.randint(0, [max(1, width - size), max(1, height - size)], size=(n_faces, 2))
+    directions = rng.choice([-1, 1], size=(n_faces, 2))
+
+    frames, truth = list(), list()
+    for i in range(n_frames):
+        positions = starts + directions*speed*i
+        # Bounce off the frame borders
+        positions[:, 0] = _bounce(positions[:, 0], width - size)
+        positions[:, 1] = _bounce(positions[:, 1], height - size)
+        faces = [(int(x), int(y), size) for x, y in positions]
+        frames.append(synthetic_frame(shape, faces, noise=noise, rng=rng))
+        truth.append([(x, y, size, size) for x, y, _ in faces])
+    return frames, truth
+
+
+def synthetic_faces(n_faces, shape=(64, 64), n_basis=40, seed=0):
+    """Faces varying along a few smooth directions, with a decaying variance"""
+    rng = np.random.RandomState(seed)
+    basis = rng.randn(n_basis, shape[0]*shape[1])*(60/np.sqrt(np.arange(1, n_basis + 1)))[:, np.newaxis]
+    faces = 128 + rng.randn(n_faces, n_basis).dot(basis)
+    return np.clip(faces, 0, 255).astype(np.uint8).reshape((n_faces,) + shape)
+
+
+def synthetic_chessboard(shape, board_size, K, D, rvec, tvec, square_px=40):
+    """ Fisheye view of a chessboard, for calibration without recorded images
+
+        Args:
+            shape (tuple): (H, W) of the image
+            board_size (tuple): number of inner corners per row and column
+            K (3x3 np.array), D (4 np.array): fisheye calibration of the camera
+            rvec, tvec (3 np.array): pose of the board, in chessboard squares
+            square_px (int): side of a square in the rendered board texture
+
+        Returns:
+            img (H x W np.array): uint8 grayscale image
+            corners (N x 2 np.array): true image coordinates of the inner corners
+    """
+    cols, rows = board_size
+    board = np.full(((rows + 3)*square_px, (cols + 3)*square_px), 255, dtype=np.uint8)
+    for r in range(rows + 1):
+        for c in range(cols + 1):
+            if (r + c) % 2 == 0:
+                board[(r+1)*square_px:(r+2)*square_px, (c+1)*square_px:(c+2)*square_px] = 0
+
+    # Ray of every pixel, intersected with the board plane through the homography [r1 r2 t]
+    height, width = shape
+    pixels = np.stack(np.meshgrid(np.arange(width), np.arange(height)), axis=-1).reshape(-1, 1, 2)
+    rays = cv2.fisheye.undistortPoints(pixels.astype(np.float64), K, D).reshape(-1, 2)
+    R, _ = cv2.Rodrigues(np.asarray(rvec, dtype=np.float64))
+    H = np.column_stack([R[:, 0], R[:, 1], np.ravel(tvec)])
+    plane = np.linalg.solve(H, np.column_stack([rays, np.ones(len(rays))]).T)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x, y = plane[0]/plane[2], plane[1]/plane[2]
+    behind = plane[2] <= 0
+    x[behind], y[behind] = -1e4, -1e4
+
+    # The first inner corner is two squares from the texture border
+    map_x = ((x + 2)*square_px - 0.5).reshape(shape).astype(np.float32)
+    map_y = ((y + 2)*square_px - 0.5).reshape(shape).astype(np.float32)
+    img = cv2.remap(board, map_x, map_y, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=128)
+
+    object_points = np.zeros((1, cols*rows, 3))
+    object_points[0, :, :2] = np.mgrid[0:cols, 0:rows].T.reshape(-1, 2)
+    corners, _ = cv2.fisheye.projectPoints(object_points, np.ravel(rvec).astype(np.float64),
+                                           np.ravel(tvec).astype(np.float64), K, D)
+    return img, corners.reshape(-1, 2)
+
+
+def synthetic_calibration_views(n_views, shape=(480, 640), board_size=(7, 7), seed=0):
+    """ Chessboard views at random poses seen by a fisheye camera
+
+        Returns:
+            images (List): uint8 grayscale images
+            K (3x3 np.array), D (1x4 np.array): calibration the views were rendered with
+    """
+    rng = np.random.RandomState(seed)
+    height, width = shape
+    K = np.array([[0.4*width, 0, width/2], [0, 0.4*width, height/2], [0, 0, 1]])
+    D = np.array([[0.05, -0.02, 0.01, -0.002]])
+
+    images = list()
+    for _ in range(n_views):
+        rvec = rng.uniform(-0.5, 0.5, 3)*[1, 1, 0.5]
+        distance = rng.uniform(7, 11)
+        # Boards all over the image, where the distortion differs
+        center = np.array([rng.uniform(-0.5, 0.5), rng.uniform(-0.35, 0.35)])*distance
+        tvec = np.array([center[0] - (board_size[0] - 1)/2, center[1] - (board_size[1] - 1)/2, distance])
+        images.append(synthetic_chessboard(shape, board_size, K, D, rvec, tvec)[0])
+    return images, K, D
+
+
+def write_clip(path, frames, fps=30):
+    """Write grayscale frames to a video file, so they can be replayed like a recording"""
+    height, width = frames[0].shape[:2]
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'MJPG'), fps, (width, height))
+    assert writer.isOpened(), f"Could not open {path} for writing"
+    for frame in frames:
+        writer.write(cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR) if frame.ndim == 2 else frame)
+    writer.release()
+
+
+def _bounce(position, limit):
+    if limit <= 0:
+        return np.zeros_like(position)
+    position = np.mod(position, 2*limit)
+    return np.where(position > limit, 2*limit - position, position)
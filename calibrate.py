@@ -0,0 +1,55 @@
+#! user/bin/env python
+""" Calibrate a fisheye camera from images of a chessboard
+
+Usage: python calibrate.py --images ./data/calibration/images --out ./data/calibration/calibration.pkl
+
+Chessboard corners are found on a pool of processes, on downscaled images first and refined
+at full resolution. The camera is calibrated on every view the board was found in, and the
+calibration is saved with the undistortion maps CameraStream loads for frames of that size.
+"""
+import argparse
+import time
+
+from components.util.camera import (find_corners_in_files, calibrate_fisheye, save_calibration_coefficients,
+                                    build_undistort_maps, save_undistort_maps, undistort_maps_file)
+from components.util.image import list_images
+
+parser = argparse.ArgumentParser(description="Calibrate a fisheye camera from chessboard images")
+
+parser.add_argument("--images", default='./data/calibration/images', help="Folder of chessboard images")
+parser.add_argument("--board", type=int, nargs=2, default=[7, 7], metavar=('COLS', 'ROWS'), help="Inner corners per row and column of the chessboard")
+parser.add_argument("--square-size", type=float, default=1.0, dest="square_size", help="Side of a chessboard square, the unit of the board poses")
+parser.add_argument("--max-images", type=int, default=0, dest="max_images", help="Maximum number of images to use, 0 for all")
+parser.add_argument("--downscale", type=float, default=None, help="Scale of the images boards are first searched in, automatic if omitted")
+parser.add_argument("--processes", type=int, default=None, help="Number of corner finding processes, all cores if omitted")
+parser.add_argument("--out", default='./data/calibration/calibration.pkl', help="Calibration pickle file to write")
+parser.add_argument("--no-maps", action="store_true", dest="no_maps", help="Do not precompute the undistortion maps")
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    board_size = tuple(args.board)
+
+    paths = list_images(args.images, args.max_images)
+    assert paths, f"No images found in {args.images}"
+
+    start = time.perf_counter()
+    views, image_size = find_corners_in_files(paths, board_size, args.downscale, args.processes)
+    corners_time = time.perf_counter() - start
+    print(f"Found the chessboard in {len(views)} of {len(paths)} images in {corners_time:.2f}s")
+
+    start = time.perf_counter()
+    K, D, rms, used = calibrate_fisheye([corners for _, corners in views], image_size, board_size, args.square_size)
+    print(f"Calibrated on {len(used)} views in {time.perf_counter() - start:.2f}s, "
+          f"reprojection error {rms:.3f} px")
+    print(f"K =\n{K}\nD = {D}")
+
+    save_calibration_coefficients(K, D, args.out, rms=rms, image_size=image_size,
+                                  views=[views[i][0] for i in used])
+    print(f"Saved calibration to {args.out}")
+
+    if not args.no_maps:
+        # CameraStream undistorts keeping the camera matrix K, see CameraStream.undistort_maps
+        maps_file = undistort_maps_file(args.out, image_size)
+        save_undistort_maps(build_undistort_maps(K, D, image_size, new_K=K), K, D, image_size, maps_file, new_K=K)
+        print(f"Saved undistortion maps to {maps_file}")
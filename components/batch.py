@@ -0,0 +1,307 @@
+""" Offline face detection and recognition of recorded videos and image archives
+
+    Inputs are split into work units, a chunk of frames of a video or a single image, that
+    pool processes decode, detect and recognize on their own so only the results cross
+    processes. Results are written to an SQLite file together with the units they cover,
+    a run that was interrupted resumes with the units that are not in it yet.
+"""
+import collections
+import json
+import logging
+import multiprocessing
+import os
+import sqlite3
+
+import numpy as np
+import cv2
+
+from .face_detector import FaceDetector, get_profile
+from .face_recognizer import FaceRecognizer
+from .util.image import load_image
+from .util.model import gallery_version
+
+VIDEO_EXTENSIONS = ('.avi', '.mp4', '.mkv', '.mov', '.m4v', '.mpg', '.mpeg', '.webm', '.h264')
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.pgm', '.ppm', '.tif', '.tiff', '.webp')
+
+# Frames of a video or a single image, end is None when the frame count of a video is unknown
+WorkUnit = collections.namedtuple('WorkUnit', ['source', 'start', 'end', 'is_video'])
+
+# Detector and recognizer of a pool process, set by _init_worker
+_worker = dict()
+
+
+def find_media(inputs):
+    """ Video and image files of a list of files and folders, folders are searched recursively
+
+        Returns:
+            videos (List): absolute paths of the video files
+            images (List): absolute paths of the image files
+    """
+    videos, images = list(), list()
+    for path in inputs:
+        if os.path.isdir(path):
+            files = sorted(os.path.join(root, name) for root, _, names in os.walk(path) for name in names)
+        else:
+            assert os.path.isfile(path), f"No such file or folder: {path}"
+            files = [path]
+
+        for file in files:
+            ext = os.path.splitext(file)[1].lower()
+            if ext in VIDEO_EXTENSIONS or (ext not in IMAGE_EXTENSIONS and file == path):
+                videos.append(os.path.abspath(file))
+            elif ext in IMAGE_EXTENSIONS:
+                images.append(os.path.abspath(file))
+    return videos, images
+
+
+def plan_video(path, start=0.0, end=None, stride=1, chunk_frames=600):
+    """ Split the frames of a video between start and end seconds into work units
+
+        Units hold a multiple of stride frames, so every unit keeps the stride of the whole video
+
+        Returns:
+            units (List): WorkUnit of every chunk of frames
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        if not capture.isOpened():
+            logging.warning(f"Could not open video {path}")
+            return list()
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        n_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    finally:
+        capture.release()
+
+    assert fps > 0 or (not start and end is None), f"Frame rate of {path} unknown, cannot seek to seconds"
+    first = int(round(start*fps)) if start else 0
+    last = n_frames if n_frames > 0 else None
+    if end is not None:
+        last = int(round(end*fps)) if last is None else min(last, int(round(end*fps)))
+    if last is None:
+        return [WorkUnit(path, first, None, True)]
+
+    chunk = max(stride, chunk_frames - chunk_frames % stride)
+    return [WorkUnit(path, i, min(i + chunk, last), True) for i in range(first, last, chunk)]
+
+
+def read_video_frames(path, start=0, end=None, stride=1):
+    """ Decode every stride-th frame of a video from frame start to frame end
+
+        Skipped frames are only grabbed, which demuxes and decodes them without converting
+        them to BGR images.
+
+        Yields:
+            index (int): frame number in the video
+            timestamp (float): seconds from the beginning of the video
+            frame (np.array): BGR image
+    """
+    capture = cv2.VideoCapture(path)
+    try:
+        fps = capture.get(cv2.CAP_PROP_FPS)
+        if start:
+            capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        index = start
+        while end is None or index < end:
+            if (index - start) % stride:
+                if not capture.grab():
+                    break
+            else:
+                ok, frame = capture.read()
+                if not ok:
+                    break
+                timestamp = index/fps if fps > 0 else capture.get(cv2.CAP_PROP_POS_MSEC)/1000
+                yield index, timestamp, frame
+            index += 1
+    finally:
+        capture.release()
+
+
+class BatchResults:
+    """ SQLite file of the faces found in recorded media, and of the work units processed
+
+        Tables:
+            faces: source, frame, timestamp (seconds into the video, modification time of
+                   an image), x, y, w, h, name (NULL if unknown) and distance (NULL if there
+                   are no known faces), indexed by name and by source and frame
+            units: source, start, end, frames and faces of every processed unit
+            settings: processing options the faces were found with
+
+        The faces of a unit and the unit itself are written in one transaction, so a unit
+        is either fully recorded or processed again when resuming.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS units (source TEXT, start INTEGER, end INTEGER, '
+                            'frames INTEGER, faces INTEGER, PRIMARY KEY (source, start))')
+            self.db.execute('CREATE TABLE IF NOT EXISTS faces (source TEXT, frame INTEGER, timestamp REAL, '
+                            'x INTEGER, y INTEGER, w INTEGER, h INTEGER, name TEXT, distance REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS faces_by_name ON faces (name, timestamp)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS faces_by_frame ON faces (source, frame)')
+
+    def check_settings(self, settings):
+        """Record the processing options, or check they are those the existing results were found with"""
+        stored = dict(self.db.execute('SELECT key, value FROM settings'))
+        settings = {key: json.dumps(value) for key, value in settings.items()}
+        if not stored:
+            with self.db:
+                self.db.executemany('INSERT INTO settings VALUES (?, ?)', settings.items())
+            return
+        changed = sorted(key for key in settings if stored.get(key) != settings[key])
+        assert not changed, f"{self.path} holds results found with other {', '.join(changed)}, use another results file"
+
+    def done(self):
+        """(source, start) of every processed unit"""
+        return set(self.db.execute('SELECT source, start FROM units'))
+
+    def add(self, unit, frames, rows):
+        """ Record the faces found in a unit
+
+            Args:
+                unit (WorkUnit): processed unit
+                frames (int): number of frames processed
+                rows (List): (source, frame, timestamp, x, y, w, h, name, distance) of every face
+        """
+        with self.db:
+            self.db.executemany('INSERT INTO faces VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+            self.db.execute('INSERT OR REPLACE INTO units VALUES (?, ?, ?, ?, ?)',
+                            (unit.source, unit.start, unit.end, frames, len(rows)))
+
+    def faces(self, name=None, source=None):
+        """ Faces found, in source and frame order
+
+            Args:
+                (Optional) name (str): only faces recognized as name
+                (Optional) source (str): only faces of this video or image
+
+            Returns:
+                rows (List): (source, frame, timestamp, x, y, w, h, name, distance) tuples
+        """
+        query, args = 'SELECT * FROM faces', list()
+        conditions = list()
+        if name is not None:
+            conditions.append('name = ?')
+            args.append(name)
+        if source is not None:
+            conditions.append('source = ?')
+            args.append(source)
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        return self.db.execute(query + ' ORDER BY source, frame', args).fetchall()
+
+    def close(self):
+        self.db.close()
+
+
+def _init_worker(model, profile, recognizer_kwargs):
+    # One process per core already, OpenCV threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+    _load_worker(model, profile, recognizer_kwargs)
+
+
+def _load_worker(model, profile, recognizer_kwargs):
+    recognizer = FaceRecognizer.from_model(model, save_gallery=False, **recognizer_kwargs)
+    _worker['recognizer'] = recognizer
+    _worker['detector'] = FaceDetector(profile=profile)
+
+
+def _process_task(task):
+    """ Detect and recognize the faces of the units of a task, run by the pool processes
+
+        Faces are recognized in one batch per task instead of frame by frame
+
+        Returns:
+            results (List): (unit, frames, rows) of every unit, see BatchResults.add
+    """
+    units, stride = task
+    detector, recognizer = _worker['detector'], _worker['recognizer']
+    # cv2.resize takes (W, H)
+    face_shape = tuple(recognizer.img_shape[::-1])
+
+    found, faces, frames = list(), list(), list()
+    for unit in units:
+        if unit.is_video:
+            images = read_video_frames(unit.source, unit.start, unit.end, stride)
+        else:
+            images = [(0, os.path.getmtime(unit.source), load_image(unit.source))]
+
+        n_frames = 0
+        for index, timestamp, image in images:
+            if image is None:
+                logging.warning(f"Could not read image {unit.source}")
+                continue
+            n_frames += 1
+            _, bboxes, crops = detector.detectFaces(image)
+            found.extend((len(frames), index, timestamp, bbox) for bbox in bboxes)
+            faces.extend(cv2.resize(face, face_shape) for face in crops)
+        frames.append((unit, n_frames))
+
+    names, distances = recognizer.recognize_batch(faces)
+    rows = [list() for _ in units]
+    for (u, index, timestamp, (x, y, w, h)), name, distance in zip(found, names, distances):
+        rows[u].append((units[u].source, index, timestamp, int(x), int(y), int(w), int(h), name,
+                        float(distance) if np.isfinite(distance) else None))
+    return [(unit, n_frames, unit_rows) for (unit, n_frames), unit_rows in zip(frames, rows)]
+
+
+def process_media(inputs, results, model, workers=None, start=0.0, end=None, stride=1, chunk_frames=600,
+                  images_per_task=64, profile=None, recognizer_kwargs=None, progress=None):
+    """ Find and recognize the faces of videos and images, skipping units already in results
+
+        Args:
+            inputs (List): video files, image files and folders
+            results (BatchResults): results file to write to
+            model (str): model directory or facespace pickle of the recognizer
+            (Optional) workers (int): number of pool processes, all cores if None, 0 to process in this process
+            (Optional) start (float): seconds into every video to start at
+            (Optional) end (float): seconds into every video to stop at, None for the end
+            (Optional) stride (int): process every stride-th frame of the videos
+            (Optional) chunk_frames (int): frames of a video per work unit
+            (Optional) images_per_task (int): images recognized together by a pool process
+            (Optional) profile (DetectionProfile): detection profile, see FaceDetector
+            (Optional) recognizer_kwargs (dict): other FaceRecognizer arguments
+            (Optional) progress (callable): called as progress(unit, frames, faces) after every unit
+
+        Returns:
+            stats (dict): number of units, units skipped as already processed, frames and faces
+    """
+    recognizer_kwargs = recognizer_kwargs or dict()
+    # Faces enrolled or removed since the existing results change the names they would get
+    results.check_settings({'model': os.path.abspath(model), 'gallery': gallery_version(model),
+                            'start': start, 'end': end, 'stride': stride, 'profile': vars(get_profile(profile)),
+                            'recognizer': recognizer_kwargs})
+
+    videos, images = find_media(inputs)
+    units = [unit for video in videos for unit in plan_video(video, start, end, stride, chunk_frames)]
+    units += [WorkUnit(image, 0, 1, False) for image in images]
+
+    done = results.done()
+    pending = [unit for unit in units if (unit.source, unit.start) not in done]
+    tasks = [([unit], stride) for unit in pending if unit.is_video]
+    pending_images = [unit for unit in pending if not unit.is_video]
+    tasks += [(pending_images[i:i + images_per_task], stride) for i in range(0, len(pending_images), images_per_task)]
+
+    stats = {'units': len(units), 'skipped': len(units) - len(pending), 'frames': 0, 'faces': 0}
+
+    def record(task_results):
+        for unit, frames, rows in task_results:
+            results.add(unit, frames, rows)
+            stats['frames'] += frames
+            stats['faces'] += len(rows)
+            if progress is not None:
+                progress(unit, frames, len(rows))
+
+    if workers == 0:
+        _load_worker(model, profile, recognizer_kwargs)
+        for task in tasks:
+            record(_process_task(task))
+        return stats
+
+    with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(model, profile, recognizer_kwargs)) as pool:
+        for task_results in pool.imap_unordered(_process_task, tasks):
+            record(task_results)
+    return stats
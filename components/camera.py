@@ -1,17 +1,28 @@
 """ Camera module used for input processing """
+import collections
 import os
+import threading
+import time
 
 import numpy as np
 import cv2
 
 import components.util.camera as util
+from components.metrics import REGISTRY
+
+TimestampedFrame = collections.namedtuple('TimestampedFrame', ['image', 'timestamp', 'frame_id'])
 
 class CameraStream:
     """ Class creates a camera object used for retrieving frames for facial recognition
         processing
 
         As this project is meant for use in apartment door peepholes, this camera class
-        is able to hande fisheye distortion on images
+        is able to hande fisheye distortion on images. Undistortion maps are computed once
+        per calibration and frame size, then every frame is undistorted with a plain remap
+
+        In threaded mode a background thread reads frames continuously into a ring buffer,
+        so the driver buffer never fills up with stale frames and readers always get the
+        newest frame, however slow the processing downstream is.
 
         Attributes:
             video_capture: OpenCV video capture object using specificed camera object
@@ -20,32 +31,188 @@ class CameraStream:
             D: (1x4) np.array distortion coefficients used for undistorting fisheye
             calibration_file: pickle file with saved calibration information, to be used
                 if K, D are not specified
+            cache_maps: A boolean indicating whether to save undistortion maps next to the
+                calibration file, so later runs can load instead of computing them
+            threaded: A boolean indicating whether frames are read by a background grabber
+            frames: ring buffer of the buffer_size most recent TimestampedFrames
+            dropped_frames: number of captured frames that were never returned
 
     """
 
-    def __init__(self, camera=0, undistort_fisheye = False, K=None, D=None, calibration_file=None):
+    def __init__(self, camera=0, undistort_fisheye = False, K=None, D=None, calibration_file=None,
+                 cache_maps=True, threaded=False, buffer_size=4):
         """Initialize Camera Stream Object"""
         self.video_capture = cv2.VideoCapture(camera)
         self.undistort_fisheye = undistort_fisheye
         self.K = K
         self.D = D
+        self.calibration_file = calibration_file
+        self.cache_maps = cache_maps
         if calibration_file:
             self._set_calibration_values(calibration_file)
 
+        labels = dict(camera=camera)
+        self._read_seconds = REGISTRY.histogram('pybell_camera_read_seconds', 'Seconds spent reading a frame', **labels)
+        self._undistort_seconds = REGISTRY.histogram('pybell_undistort_seconds', 'Seconds spent undistorting a frame', **labels)
+        self._frames_total = REGISTRY.counter('pybell_camera_frames_total', 'Frames read from the camera', **labels)
+        self._dropped_total = REGISTRY.counter('pybell_camera_dropped_frames_total',
+                                               'Frames captured but never returned', **labels)
+
+        self.threaded = threaded
+        self.frames = collections.deque(maxlen=buffer_size)
+        self.dropped_frames = 0
+        self._next_frame_id = 0
+        self._last_frame_id = -1
+        self._frame_cond = threading.Condition()
+        self._grabbing = False
+        self._grabber = None
+        if threaded:
+            self._start_grabber()
+
+    def _start_grabber(self):
+        """Start the background thread reading frames into the ring buffer"""
+        self._grabbing = True
+        self._grabber = threading.Thread(target=self._grab_frames, name='camera-grabber', daemon=True)
+        self._grabber.start()
+
+    def _grab_frames(self):
+        """Read frames until stopped or until the capture has no more frames"""
+        while self._grabbing:
+            with self._read_seconds.time():
+                ok, img = self.video_capture.read()
+            timestamp = time.monotonic()
+            if ok:
+                self._frames_total.inc()
+
+            with self._frame_cond:
+                if not ok:
+                    self._grabbing = False
+                else:
+                    self.frames.append(TimestampedFrame(img, timestamp, self._next_frame_id))
+                    self._next_frame_id += 1
+                self._frame_cond.notify_all()
+
+    @property
+    def grabbing(self):
+        """True while the background grabber is reading frames"""
+        return self._grabbing
 
     def stop(self):
         """Stop the video capture"""
+        if self._grabber is not None:
+            self._grabbing = False
+            self._grabber.join()
         self.video_capture.release()
 
     def next_frame(self):
         """Return the next frame of the video capture, undistorting if undistort_fisheye"""
-        _, img = self.video_capture.read()
+        img = self.read()
 
         if self.undistort_fisheye:
-            img = cv2.fisheye.undistortImage(img, self.K, self.D)
+            img = self.undistort(img)
 
         return img
 
+    def read(self):
+        """Return the next raw frame of the video capture, None if no frame could be read"""
+        if self.threaded:
+            frame = self.latest_frame()
+            return frame.image if frame is not None else None
+
+        with self._read_seconds.time():
+            ok, img = self.video_capture.read()
+        if ok:
+            self._frames_total.inc()
+        return img
+
+    def latest_frame(self, timeout=None):
+        """ Return the newest raw frame that has not been returned before
+
+            In threaded mode this waits for the grabber to capture a new frame, frames
+            captured in between are skipped and counted in dropped_frames
+
+            Args:
+                timeout (float): seconds to wait for a new frame, None waits forever
+
+            Returns:
+                frame (TimestampedFrame): (image, timestamp, frame_id) of the newest frame,
+                                          None on timeout or at the end of the capture
+        """
+        if not self.threaded:
+            with self._read_seconds.time():
+                ok, img = self.video_capture.read()
+            if not ok:
+                return None
+            self._frames_total.inc()
+            self._last_frame_id += 1
+            return TimestampedFrame(img, time.monotonic(), self._last_frame_id)
+
+        with self._frame_cond:
+            self._frame_cond.wait_for(lambda: self._has_new_frame() or not self._grabbing, timeout)
+            if not self._has_new_frame():
+                return None
+
+            frame = self.frames[-1]
+            self.dropped_frames += frame.frame_id - self._last_frame_id - 1
+            self._dropped_total.inc(frame.frame_id - self._last_frame_id - 1)
+            self._last_frame_id = frame.frame_id
+            return frame
+
+    def _has_new_frame(self):
+        return len(self.frames) > 0 and self.frames[-1].frame_id > self._last_frame_id
+
+    def __iter__(self):
+        """Iterate over the newest raw frames until the capture ends"""
+        frame = self.latest_frame()
+        while frame is not None:
+            yield frame
+            frame = self.latest_frame()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """Wait for the newest raw frame without blocking the event loop"""
+        # Only imported by asyncio users, it is a noticeable part of the startup time
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        frame = await loop.run_in_executor(None, self.latest_frame)
+        if frame is None:
+            raise StopAsyncIteration
+        return frame
+
+    def undistort(self, img):
+        """Undistort a raw frame using the fisheye calibration K, D"""
+        with self._undistort_seconds.time():
+            map1, map2 = self.undistort_maps(img.shape)
+            return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+    def undistort_roi(self, img, bbox):
+        """ Undistort only the region of a raw frame around a bounding box
+
+            Args:
+                img (np.array): raw frame
+                bbox (tuple): (x, y, w, h) bounding box in raw frame coordinates
+
+            Returns:
+                roi (np.array): undistorted region enclosing the bounding box
+        """
+        maps = self.undistort_maps(img.shape)
+        return util.undistort_roi(img, bbox, maps, self.K, self.D, new_K=self.K)
+
+    def undistort_maps(self, shape):
+        """ Return the undistortion maps for frames of a given (H, W, ...) shape
+
+            The undistorted image keeps the camera matrix K, so it has the same scale as the raw frame
+        """
+        image_size = (shape[1], shape[0])
+        cache_file = None
+        if self.cache_maps and self.calibration_file:
+            cache_file = util.undistort_maps_file(self.calibration_file, image_size)
+
+        return util.get_undistort_maps(self.K, self.D, image_size, new_K=self.K, cache_file=cache_file)
+
     def _set_calibration_values(self, calib_file):
         """Set calibration values from calibration dictionary file"""
         calib_dict = util.load_calibration_coefficients(calib_file)
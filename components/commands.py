@@ -0,0 +1,124 @@
+""" Operator commands, such as enrolling an unknown face, read without blocking the frame loop """
+import collections
+import os
+import stat
+import sys
+import threading
+
+
+class CommandChannel(threading.Thread):
+    """ Reads operator commands from a text stream on a background thread
+
+        The frame loop only offers the unknown faces it sees and checks quit_requested, all
+        terminal or pipe I/O happens on the channel thread. Commands, one per line:
+
+            unknown                 list the ids of the unknown faces that can be enrolled
+            enroll [#ID] NAME       add an unknown face to the known faces, the latest one
+                                    if no id is given
+            quit                    stop the program
+
+        Unknown faces are identified by their track id when faces are tracked.
+
+        Attributes:
+            enroll (callable): called as enroll(name, face) on the channel thread, it must only
+                               queue the face for the thread owning the recognizer
+            stream: text stream or path of the file commands are read from, a named pipe is
+                    reopened whenever its writer closes it
+            output: text stream replies are written to, stderr by default as stdout may carry
+                    JSON events
+            max_unknown (int): number of most recent unknown faces kept for enrollment
+            quit_requested (threading.Event): set by the quit command
+    """
+    def __init__(self, enroll, stream=None, output=None, max_unknown=16):
+        super().__init__(name='command-channel', daemon=True)
+        self.enroll = enroll
+        self.stream = sys.stdin if stream in (None, '-') else stream
+        self.output = output or sys.stderr
+        self.max_unknown = max_unknown
+        self.quit_requested = threading.Event()
+        self._unknown = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def offer(self, face, source=None, track_id=None):
+        """ Make an unknown face available for enrollment
+
+            Args:
+                face (np.array): face image resized for recognition
+                source: camera the face was seen by, when there are several
+                track_id (int): track of the face, a face offered again by the same track
+                                replaces the previous one
+        """
+        with self._lock:
+            if track_id is None:
+                key = f'f{self._next_id}'
+                self._next_id += 1
+            else:
+                key = str(track_id)
+            if source is not None:
+                key = f'{source}/{key}'
+
+            self._unknown.pop(key, None)
+            self._unknown[key] = face
+            while len(self._unknown) > self.max_unknown:
+                self._unknown.popitem(last=False)
+
+    def run(self):
+        if not isinstance(self.stream, str):
+            self._read(self.stream)
+            return
+
+        while not self.quit_requested.is_set():
+            with open(self.stream) as stream:
+                self._read(stream)
+            if not stat.S_ISFIFO(os.stat(self.stream).st_mode):
+                break
+
+    def _read(self, stream):
+        for line in stream:
+            self.execute(line)
+            if self.quit_requested.is_set():
+                break
+
+    def execute(self, line):
+        """ Run a command line
+
+            Returns:
+                ok (bool): False if the command was invalid or failed
+        """
+        words = line.split()
+        if not words:
+            return True
+        command, args = words[0].lower(), words[1:]
+
+        if command == 'quit':
+            self.quit_requested.set()
+            return True
+
+        if command == 'unknown':
+            with self._lock:
+                keys = list(self._unknown)
+            self._reply(f"Unknown faces: {' '.join('#' + key for key in keys) or 'none'}")
+            return True
+
+        if command == 'enroll' and args and not (args[0].startswith('#') and len(args) == 1):
+            key = args.pop(0)[1:] if args[0].startswith('#') else None
+            name = ' '.join(args)
+            with self._lock:
+                if key is None and self._unknown:
+                    key = next(reversed(self._unknown))
+                face = self._unknown.pop(key, None)
+
+            if face is None:
+                self._reply(f"No unknown face {'#' + key if key else 'to enroll'}")
+                return False
+            self.enroll(name, face)
+            self._reply(f"Enrolling #{key} as {name}")
+            return True
+
+        self._reply("Commands: unknown | enroll [#ID] NAME | quit")
+        return False
+
+    def _reply(self, message):
+        self.output.write(message + '\n')
+        self.output.flush()
@@ -0,0 +1,120 @@
+""" Cache of facespace projections and matches of faces seen again, e.g. a person standing at the door """
+import collections
+import threading
+import time
+
+import numpy as np
+
+from .metrics import REGISTRY
+from .util.image import dhash
+
+CACHE_HITS = REGISTRY.counter('pybell_embedding_cache_total', 'Embedding cache lookups', result='hit')
+CACHE_MISSES = REGISTRY.counter('pybell_embedding_cache_total', 'Embedding cache lookups', result='miss')
+
+CachedEmbedding = collections.namedtuple('CachedEmbedding', ['projection', 'version', 'name', 'distance', 'time', 'face'])
+
+
+class EmbeddingCache:
+    """ Bounded LRU cache of face projections and their closest known face
+
+        Faces are keyed by the difference hash of their crop, so identical and near-identical
+        crops share an entry, or by their track id when key='track' and one is given. A key
+        alone does not prove the face is the one cached: different faces can share a hash and
+        a track can drift to another person, so an entry is only returned for a crop whose mean
+        absolute difference to the cached crop is at most max_diff gray levels. Entries expire
+        ttl seconds after they were stored, the least recently used entry is evicted when the
+        cache is full.
+
+        Attributes:
+            max_size (int): maximum number of entries
+            ttl (float): seconds an entry stays valid, None to never expire
+            key (str): 'hash' to key faces by their crop, 'track' to prefer their track id
+            hash_size (int): the crop hashes have hash_size**2 bits
+            max_diff (float): mean absolute gray level difference of a crop to the cached one
+                              up to which the entry is returned
+            hits (int): lookups that found a valid entry
+            misses (int): lookups that did not, or found an entry of another face
+            evictions (int): entries removed because the cache was full or they expired
+    """
+    def __init__(self, max_size=1024, ttl=2.0, key='hash', hash_size=16, max_diff=4.0):
+        assert key in ('hash', 'track'), f"Unknown cache key: {key}"
+        self.max_size = max_size
+        self.ttl = ttl
+        self.key = key
+        self.hash_size = hash_size
+        self.max_diff = max_diff
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits/lookups if lookups else 0.0
+
+    def key_of(self, face, track_id=None):
+        """Cache key of a face crop, its track id if keyed by track and one is given"""
+        if self.key == 'track' and track_id is not None:
+            return ('track', track_id)
+        return ('hash', dhash(face, self.hash_size))
+
+    def get(self, key, face=None):
+        """ Entry of a key, None if there is none, it expired or it was stored for another face
+
+            Args:
+                key: cache key, see key_of
+                (Optional) face (np.array): crop looked up, compared with the cached crop
+
+            Returns:
+                entry (CachedEmbedding): projection, gallery version, name, distance, time and crop stored
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry.time > self.ttl:
+                del self._entries[key]
+                self.evictions += 1
+                entry = None
+            if entry is not None and face is not None and not self._same_face(entry.face, face):
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                CACHE_MISSES.inc()
+                return None
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            CACHE_HITS.inc()
+            return entry
+
+    def put(self, key, projection, version, name, distance, face=None):
+        """Store the projection and closest known face of a face, with a copy of its crop"""
+        face = np.array(face) if face is not None else None
+        with self._lock:
+            self._entries[key] = CachedEmbedding(projection, version, name, distance, time.monotonic(), face)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def _same_face(self, cached, face):
+        """True if a crop is close enough to the cached crop to share its entry"""
+        if cached is None:
+            return True
+        if cached.shape != face.shape:
+            return False
+        return np.mean(np.abs(cached.astype(np.int16) - face)) <= self.max_diff
+
+    def clear(self):
+        """Remove every entry, e.g. when projections change"""
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {'size': len(self), 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'hit_rate': self.hit_rate}
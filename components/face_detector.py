@@ -4,53 +4,166 @@ import os
 import logging
 
 import cv2
+import numpy as np
 
+from .metrics import REGISTRY
 from .util.image import cvt_to_gray
 
 dirname = os.path.dirname(os.path.abspath(__file__))
 
+DETECT_SECONDS = REGISTRY.histogram('pybell_detect_seconds', 'Seconds spent detecting faces in a frame')
+FACES_DETECTED = REGISTRY.counter('pybell_faces_detected_total', 'Faces detected')
+
+
+class DetectionProfile:
+    """ Parameters of the multiscale cascade search
+
+        Every pyramid level costs a full cascade pass, the default profile searches faces of
+        any size on the full resolution image. Restricting the face size range and detecting
+        on a downscaled image removes the levels that can never contain a face at the door.
+
+        Attributes:
+            scale_factor (float): size ratio between pyramid levels
+            min_neighbors (int): overlapping candidates required to keep a detection
+            min_size (tuple): (w, h) smallest face searched, in full resolution pixels, None for no limit
+            max_size (tuple): (w, h) largest face searched, in full resolution pixels, None for no limit
+            downscale (float): factor the image is resized by before detection, 1 for full resolution
+    """
+    def __init__(self, scale_factor=1.1, min_neighbors=5, min_size=None, max_size=None, downscale=1.0):
+        assert 0 < downscale <= 1, "Detection can only run on a downscaled image"
+        self.scale_factor = scale_factor
+        self.min_neighbors = min_neighbors
+        self.min_size = min_size
+        self.max_size = max_size
+        self.downscale = downscale
+
+    @classmethod
+    def from_camera_geometry(cls, focal_length, min_distance, max_distance, face_width=0.15, **kwargs):
+        """ Derive the face size range from the camera focal length and the distances faces are seen at
+
+            Args:
+                focal_length (float): focal length in pixels, e.g. K[0, 0] of the calibration
+                min_distance (float): closest distance of a face to the camera, in meters
+                max_distance (float): farthest distance of a face to the camera, in meters
+                face_width (float): width of a face in meters
+                kwargs: other DetectionProfile arguments
+
+            Returns:
+                profile (DetectionProfile)
+        """
+        assert 0 < min_distance < max_distance, "Face distances must be positive and increasing"
+        smallest = int(focal_length*face_width/max_distance)
+        largest = int(np.ceil(focal_length*face_width/min_distance))
+        return cls(min_size=(smallest, smallest), max_size=(largest, largest), **kwargs)
+
+    def cascade_kwargs(self):
+        """Keyword arguments of detectMultiScale on the downscaled image"""
+        kwargs = dict(scaleFactor=self.scale_factor, minNeighbors=self.min_neighbors)
+        if self.min_size is not None:
+            kwargs['minSize'] = tuple(int(v*self.downscale) for v in self.min_size)
+        if self.max_size is not None:
+            kwargs['maxSize'] = tuple(int(np.ceil(v*self.downscale)) for v in self.max_size)
+        return kwargs
+
+
+PROFILES = {
+    'accurate': dict(scale_factor=1.1, min_neighbors=5),
+    'balanced': dict(scale_factor=1.15, min_neighbors=4, downscale=0.75),
+    'fast': dict(scale_factor=1.2, min_neighbors=3, downscale=0.5),
+}
+
+
+def get_profile(profile):
+    """Return a DetectionProfile given a profile, a name of PROFILES or None for 'accurate'"""
+    if profile is None or isinstance(profile, str):
+        return DetectionProfile(**PROFILES[profile or 'accurate'])
+    return profile
+
+
 class FaceDetector:
-    def __init__(self, cascade=os.path.join(dirname, '../data/cascades/haarcascade_frontalface_alt.xml'), face_shape=(64,64)):
+    def __init__(self, cascade=os.path.join(dirname, '../data/cascades/haarcascade_frontalface_alt.xml'), face_shape=(64,64),
+                 profile=None):
         """ Creates a face detection object that finds faces using multiscale Haar cascades.
             In this implementation we use the pretrained Haar Cascade files provided by OpevCV
 
             Attributes:
+                cascade (str): path of the cascade file the classifier was loaded from
                 cf (cv2.CascadeClassifier): Cascade Classifier
                 face_shape (tuple): Height and Width of resulting faces should be output as
+                profile (DetectionProfile): search parameters, a name of PROFILES or None for 'accurate'
 
         """
+        self.cascade = cascade
         self.cf = cv2.CascadeClassifier()
         if not self.cf.load(cascade):
             raise FileNotFoundError(f"Cascade file not found at: {cascade}")
 
         self.face_shape = face_shape
+        self.profile = get_profile(profile)
 
-    def detectFaces(self, img):
+    def detectFaces(self, img, regions=None, gray=None):
         """
             Detect faces in an image
 
             Args:
                 img (np.array): Image to detect faces in
+                (Optional) regions (List): (x, y, width, height) regions to restrict the search to,
+                                           e.g. from a MotionGate. None searches the whole image
+                (Optional) gray (np.array): grayscale version of img if another stage already converted it
 
             Returns:
                 face_count (int): Number of faces detected
                 bboxes (List): list of (x, y, width, height) tuples representing bounding boxes of detected faces
                 faces (List): list of extracted face image subsets from image
         """
-        # Convert to Gray
-        img = cvt_to_gray(img)
+        with DETECT_SECONDS.time():
+            # Convert to Gray
+            img = cvt_to_gray(img) if gray is None else gray
 
-        # Detect Faces using multiscale detector
-        bboxes = self.cf.detectMultiScale(img, scaleFactor=1.1, minNeighbors=5)
-        faceCount = len(bboxes)
+            # Detect Faces using multiscale detector
+            if regions is None:
+                bboxes = self._detect(img)
+            else:
+                bboxes = self._detect_in_regions(img, regions)
+            faceCount = len(bboxes)
 
-        # Extract Faces
-        faces = _extract_faces_from_bbox(img, bboxes)
+            # Extract Faces
+            faces = _extract_faces_from_bbox(img, bboxes)
 
-        logging.info(f"{faceCount} faces detected")
+        FACES_DETECTED.inc(faceCount)
+        logging.debug(f"{faceCount} faces detected")
 
         return (faceCount, bboxes, faces)
 
+    def _detect_in_regions(self, img, regions):
+        """Detect faces in regions of an image, returning bboxes in image coordinates"""
+        bboxes = list()
+        for (x, y, w, h) in regions:
+            found = self._detect(img[y:y+h, x:x+w])
+            bboxes.extend((bx + x, by + y, bw, bh) for (bx, by, bw, bh) in found)
+
+        # Same result type as detectMultiScale
+        return np.array(bboxes, dtype=np.int32) if bboxes else tuple()
+
+    def _detect(self, img):
+        """Run the cascade on a grayscale image according to the profile, bboxes in img coordinates"""
+        scale = self.profile.downscale
+        if scale < 1:
+            small = cv2.resize(img, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        else:
+            small = img
+
+        bboxes = self.cf.detectMultiScale(small, **self.profile.cascade_kwargs())
+        if scale == 1 or len(bboxes) == 0:
+            return bboxes
+
+        # Back to full resolution, clipped to the image
+        height, width = img.shape[:2]
+        bboxes = np.round(np.asarray(bboxes, dtype=np.float64)/scale).astype(np.int32)
+        bboxes[:, 2] = np.minimum(bboxes[:, 2], width - bboxes[:, 0])
+        bboxes[:, 3] = np.minimum(bboxes[:, 3], height - bboxes[:, 1])
+        return bboxes
+
 
 def _extract_faces_from_bbox(img, bboxes):
     """
@@ -1,12 +1,30 @@
-import cv2
+import logging
+import threading
+
 import numpy as np
 
-from .util.eigenfaces import extract_facespace, project, distance_matrix
-from .util.image import load_images_from_folder
+from .metrics import REGISTRY
+from .util.gallery import FaceGallery, grow_capacity
+from .util.gallery_index import BruteForceIndex, create_index
+from .util.model import load_facespace, is_model, append_gallery, save_gallery
+from .util.projection import quantize_rows, project_quantized, PRECISIONS
+
+PROJECT_SECONDS = REGISTRY.histogram('pybell_project_seconds', 'Seconds spent projecting a batch of faces')
+SEARCH_SECONDS = REGISTRY.histogram('pybell_search_seconds', 'Seconds spent searching the known faces for a batch of faces')
+KNOWN_FACES = REGISTRY.counter('pybell_recognized_faces_total', 'Faces recognized', result='known')
+UNKNOWN_FACES = REGISTRY.counter('pybell_recognized_faces_total', 'Faces recognized', result='unknown')
+
+
+def register_gallery(recognizer):
+    """Export the number of known faces of the recognizer an application serves as a metric"""
+    # Read when collected, so faces loaded before the metrics are enabled are counted
+    REGISTRY.gauge('pybell_gallery_faces', 'Known faces in the gallery', func=lambda: len(recognizer.gallery))
+
 
 class FaceRecognizer:
     def __init__(self, mean_face, facespace, known_face_dict=None, img_shape=(64,64),
-                 thresh=0.1, contrast_coeff=1.0, brightness_coeff=50):
+                 thresh=0.1, contrast_coeff=1.0, brightness_coeff=50, index='brute', model_dir=None,
+                 precision=None, facespace_scales=None, cache=None):
         """Facial Recognition object finding similar faces using EigenFaces
 
            As the visual environment can be different than that of the facespace train set,
@@ -20,75 +38,365 @@ class FaceRecognizer:
                 thresh (float): threshold for eigenface recognition
                 contrast_coeff (float): coefficient used to change contrast of input face image
                 brightness_coeff (float): coefficient used to change brightness of input face image
+                index (str or index object): nearest neighbour index used to search the known
+                                             faces, one of 'brute', 'kdtree', 'balltree', 'ivfpq'
+                                             or an already constructed index
+                model_dir (str): model directory the known faces are saved to, None to keep
+                                 them in memory only
+                precision (str): 'float64', 'float32' or 'int8' arithmetic of the projection and
+                                 storage of the facespace, None for the type of facespace. int8
+                                 quantizes every component with its own scale, and projects
+                                 in float32 with the gallery stored in float32
+                facespace_scales (np.array): row scales of an int8 facespace, see quantize_rows
+                cache (EmbeddingCache): cache of the projections and matches of faces seen
+                                        again, None to project and search every face
         """
-        self.mean_face = mean_face
-        self.facespace = facespace
+        self.precision = precision or _precision_of(facespace)
+        assert self.precision in PRECISIONS, f"Unknown precision: {self.precision}"
+        self._dtype = np.float64 if self.precision == 'float64' else np.float32
+        self._contrast_coeff = contrast_coeff
+        self._brightness_coeff = brightness_coeff
+        self._mean_face = np.asarray(mean_face, dtype=self._dtype).reshape(-1)
+        self._buffers = threading.local()
+        self.cache = cache
+        self._gallery_version = 0
+        self._set_facespace(facespace, facespace_scales)
         self.known_face_dict = known_face_dict
         self.thresh = thresh
         self.img_shape = img_shape
-        self.contrast_coeff = contrast_coeff
-        self.brightness_coeff = brightness_coeff
-        self.index2name = list()
-        self.known_face_matrix = list()
+        self.gallery = FaceGallery(facespace.shape[0], dtype=self._dtype)
+        if index == 'brute':
+            # Scans the gallery projections in place rather than a copy of them
+            index = BruteForceIndex(self.gallery)
+        self.index = create_index(index) if isinstance(index, str) else index
+        self.model_dir = model_dir
 
         # If face dictionaryy is non-empty
         if known_face_dict:
-            for key, faceImg in known_face_dict.values():
-                self.index2name.append(key)
-                self.known_face_matrix.append(self._project_to_facespace(faceImg))
+            self.add_known_faces(list(known_face_dict.keys()), list(known_face_dict.values()))
+
+    @classmethod
+    def from_model(cls, path, save_gallery=True, mmap=True, **kwargs):
+        """ Create a recognizer from a model directory, with the known faces saved in it
 
-        self.known_face_matrix = np.array(self.known_face_matrix)
+            Args:
+                path (str): model directory, or legacy facespace pickle
+                save_gallery (bool): save faces added later to the model directory
+                mmap (bool): memory-map the model instead of reading it
+                kwargs: other FaceRecognizer arguments
+
+            Returns:
+                recognizer (FaceRecognizer)
+        """
+        model = load_facespace(path, mmap)
+        model_dir = path if save_gallery and is_model(path) else None
+        recognizer = cls(model['mean_face'], model['facespace'], img_shape=model['img_shape'],
+                         facespace_scales=model.get('facespace_scales'), **kwargs)
+
+        # Known faces are stored as projections, only comparable under the same settings
+        if len(model['names']):
+            if model['projection'] is None:
+                logging.warning(f"{path} does not record the settings its known faces were projected with")
+            else:
+                assert model['projection'] == recognizer.projection_settings, \
+                    f"Known faces of {path} were projected with {model['projection']}, " \
+                    f"not {recognizer.projection_settings}"
+        recognizer.add_known_projections(model['names'], model['vectors'], save=False)
+        recognizer.model_dir = model_dir
+        return recognizer
+
+    def _set_facespace(self, facespace, scales=None):
+        """Set FaceScape Attribute, stored in the recognizer's precision"""
+        if facespace.dtype == np.int8 and self.precision != 'int8':
+            assert scales is not None, "An int8 facespace needs its row scales"
+            facespace = scales[:, np.newaxis]*facespace.astype(self._dtype)
+            scales = None
+
+        if self.precision == 'int8':
+            if facespace.dtype != np.int8:
+                facespace, scales = quantize_rows(facespace)
+            assert scales is not None, "An int8 facespace needs its row scales"
+        else:
+            # A memory-mapped facespace of the right type is used as is
+            facespace = facespace.astype(self._dtype, copy=False)
 
-    def _set_facespace(self, facespace):
-        """Set FaceScape Attribute"""
         self.facespace = facespace
+        self.facespace_scales = scales
+        self._fuse_projection()
 
-    def add_known_face(self, name, faceImg):
-        """Add face to known face dictionary"""
-        faceImg = self._adjust_brightness_contrast(faceImg)
-        self.known_face_dict[name] = faceImg
-        self.index2name.append(name)
-        projection = project(self.facespace, faceImg.flatten())
-
-        # Handle if this is the first known image
-        if len(self.known_face_dict) == 1:
-            self.known_face_matrix = projection.reshape(1, -1)
+    @property
+    def contrast_coeff(self):
+        """Coefficient used to change contrast of input face images"""
+        return self._contrast_coeff
+
+    @contrast_coeff.setter
+    def contrast_coeff(self, value):
+        self._contrast_coeff = value
+        self._fuse_projection()
+
+    @property
+    def brightness_coeff(self):
+        """Coefficient used to change brightness of input face images"""
+        return self._brightness_coeff
+
+    @brightness_coeff.setter
+    def brightness_coeff(self, value):
+        self._brightness_coeff = value
+        self._fuse_projection()
+
+    @property
+    def projection_settings(self):
+        """(dict) settings projections depend on, stored with saved known faces"""
+        return {'contrast_coeff': float(self._contrast_coeff), 'brightness_coeff': float(self._brightness_coeff),
+                'precision': self.precision}
+
+    @property
+    def mean_face(self):
+        """Mean face of the facespace training data"""
+        return self._mean_face
+
+    @mean_face.setter
+    def mean_face(self, value):
+        self._mean_face = np.asarray(value, dtype=self._dtype).reshape(-1)
+        self._fuse_projection()
+
+    def _fuse_projection(self):
+        """ Precompute the projection of adjusted faces as a single affine map
+
+            Projecting contrast*x + brightness - mean_face is W(c*x + b - m) = (c*W)x + W(b - m),
+            so the scaled basis c*W and the offset W(b - m) are computed once here and a face
+            goes from pixels to facespace coefficients in one matrix product
+        """
+        offset_face = (self._brightness_coeff - self._mean_face).astype(self._dtype)
+        if self.precision == 'int8':
+            # The contrast folds into the row scales, the int8 basis is used as is
+            self._fused_scales = (self._contrast_coeff*self.facespace_scales).astype(np.float32)
+            self._fused_offset = project_quantized(offset_face[np.newaxis], self.facespace, self.facespace_scales)[0]
         else:
-            self.known_face_matrix = np.vstack((self.known_face_matrix, projection.reshape(1, -1)))
+            # Without a contrast change the, possibly memory-mapped, facespace is not copied
+            self._fused_basis = self.facespace if self._contrast_coeff == 1 else \
+                (self._contrast_coeff*self.facespace).astype(self._dtype, copy=False)
+            self._fused_offset = np.matmul(self.facespace, offset_face)
+
+        # Cached projections were made with the previous map
+        if self.cache is not None:
+            self.cache.clear()
+
+    def add_known_face(self, name, faceImg):
+        """Add face to the gallery of known faces"""
+        self.add_known_faces([name], [faceImg])
+
+    def add_known_faces(self, names, faceImgs, batch_size=1024):
+        """ Add many faces to the gallery of known faces
+
+            Faces are projected batch_size at a time and appended to the gallery storage,
+            whose capacity doubles when full, so enrolling K faces takes O(K) time
+
+            Args:
+                names (List): name of every face
+                faceImgs (List or (N x H x W) np.array): face images resized to img_shape
+                batch_size (int): number of faces projected at once
+
+            Returns:
+                ids (np.array): gallery ids of the added faces
+        """
+        assert len(names) == len(faceImgs), f"Got {len(names)} names for {len(faceImgs)} faces"
+
+        ids = list()
+        for start in range(0, len(names), batch_size):
+            projections = self._project_batch_to_facespace(faceImgs[start:start+batch_size])
+            ids.append(self.add_known_projections(names[start:start+batch_size], projections))
+
+        return np.concatenate(ids) if ids else np.empty(0, dtype=np.int64)
+
+    def add_known_projections(self, names, projections, save=True):
+        """ Add faces already projected to the facespace to the gallery of known faces
 
+            Args:
+                names (List): name of every face
+                projections ((N x components) np.array): facespace projections of the faces
+                save (bool): also append the faces to model_dir, if set
 
+            Returns:
+                ids (np.array): gallery ids of the added faces
+        """
+        if len(names) == 0:
+            return np.empty(0, dtype=np.int64)
+
+        ids = self.gallery.add(names, projections)
+        self.index.add(self.gallery.vectors[ids], ids)
+        if save and self.model_dir is not None:
+            append_gallery(self.model_dir, names, self.gallery.vectors[ids], self.projection_settings)
+        self._gallery_version += 1
+        return ids
+
+    def remove_known_face(self, name):
+        """ Remove every face of a person from the gallery of known faces
+
+            Returns:
+                removed (int): number of faces removed
+        """
+        ids = self.gallery.remove(name)
+        if len(ids) > 0:
+            self.index.remove(ids)
+            if self.model_dir is not None:
+                alive = self.gallery.alive
+                save_gallery(self.model_dir, self.gallery.names[alive], self.gallery.vectors[alive],
+                             self.projection_settings)
+        self._gallery_version += 1
+        return len(ids)
 
     def recognize(self, faceImg):
         """Check whether a face is recognized from the set of known faces.
             If face is unknown return none.
         """
-        faceImg = self._adjust_brightness_contrast(faceImg)
-        projection = self._project_to_facespace(faceImg)
-
-        # Find distance between projection and known faces
-        if self.known_face_matrix.shape[0] > 0:
-            dist = distance_matrix(self.known_face_matrix, projection)
-            min_idx = np.argmin(dist)
-            print(dist)
-            name = None
-            if dist[min_idx] <= self.thresh:
-                name = self.index2name[min_idx]
-            return name
+        names, _ = self.recognize_batch([faceImg])
+        return names[0]
 
-        else:
-            return None
+    def recognize_batch(self, faces, track_ids=None):
+        """Check whether each face in a list of faces is recognized from the set of known faces.
+
+            All faces are projected to the facespace with a single matrix multiplication
+            and compared against the known faces as one (N x K) distance matrix, so the
+            cost of a frame grows very slowly with the number of faces in it
+
+            Args:
+                faces (List): list of (H x W) face images, each resized to img_shape
+                track_ids (List): track id of every face, used as cache key, see EmbeddingCache
+
+            Returns:
+                names (List): recognized name for each face, None if the face is unknown
+                distances (np.array): (N) distance from each face to its closest known face,
+                                      inf if there are no known faces
+        """
+        names, distances = self.nearest_batch(faces, track_ids)
+        names = [name if d <= self.thresh else None for name, d in zip(names, distances)]
+
+        known = sum(name is not None for name in names)
+        KNOWN_FACES.inc(known)
+        UNKNOWN_FACES.inc(len(names) - known)
+        return names, distances
+
+    def nearest_batch(self, faces, track_ids=None):
+        """Find the closest known face of each face in a list of faces, regardless of thresh
+
+            With a cache, faces seen recently skip both the projection and the search, and
+            faces whose projection is cached but whose match predates a gallery change are
+            only searched again. Cached entries are only used for crops matching the cached
+            crop, see EmbeddingCache
+
+            Args:
+                faces (List): list of (H x W) face images, each resized to img_shape
+                track_ids (List): track id of every face, used as cache key, see EmbeddingCache
+
+            Returns:
+                names (List): name of the closest known face, None if there are no known faces
+                distances (np.array): (N) distance from each face to its closest known face,
+                                      inf if there are no known faces
+        """
+        n_faces = len(faces)
+        if n_faces == 0:
+            return list(), np.empty(0)
+        if self.cache is None:
+            return self._search(self._project_batch_to_facespace(faces))
+
+        names, distances = [None]*n_faces, np.empty(n_faces)
+        keys = [self.cache.key_of(face, track_ids[i] if track_ids is not None else None)
+                for i, face in enumerate(faces)]
+        missed, stale, stale_projections = list(), list(), list()
+        for i, key in enumerate(keys):
+            entry = self.cache.get(key, faces[i])
+            if entry is None:
+                missed.append(i)
+            elif entry.version != self._gallery_version:
+                stale.append(i)
+                stale_projections.append(entry.projection)
+            else:
+                names[i], distances[i] = entry.name, entry.distance
+
+        if not missed and not stale:
+            return names, distances
+
+        # Projections are a new array every call, so cached rows can be views of it
+        projections = self._project_batch_to_facespace([faces[i] for i in missed]) if missed else \
+                      np.empty((0, self.facespace.shape[0]), dtype=self._dtype)
+        if stale:
+            projections = np.concatenate([projections, stale_projections])
+        found, found_distances = self._search(projections)
+        for i, projection, name, distance in zip(missed + stale, projections, found, found_distances):
+            names[i], distances[i] = name, distance
+            self.cache.put(keys[i], projection, self._gallery_version, name, distance, faces[i])
+        return names, distances
+
+    def warm_up(self, n_faces=1):
+        """Project and search blank faces, so the first real faces do not page in the model"""
+        faces = np.zeros((n_faces,) + tuple(self.img_shape), dtype=np.uint8)
+        self._search(self._project_batch_to_facespace(faces))
+
+    def _search(self, projections):
+        """Closest known face of every projection, see nearest_batch"""
+        n_faces = len(projections)
+        if len(self.index) == 0:
+            return [None]*n_faces, np.full(n_faces, np.inf)
+
+        # Closest known face of every face
+        with SEARCH_SECONDS.time():
+            dist, idx = self.index.search(projections, k=1)
+        min_dist, min_idx = dist[:, 0], idx[:, 0]
+
+        names = [self.gallery.name(i) if i >= 0 else None for i in min_idx]
+        return names, min_dist
+
+    def find_matches(self, faceImg):
+        """Find every known face within thresh of a face
+
+            Returns:
+                matches (List): (name, distance) tuples sorted by increasing distance
+        """
+        projection = self._project_batch_to_facespace([faceImg])
+        ids, dist = self.index.radius_search(projection, self.thresh)[0]
+        return [(self.gallery.name(i), d) for i, d in zip(ids, dist)]
+
+    def _project_batch_to_facespace(self, faces):
+        """Project a list of face images to the face recognizer's face space
+
+            Faces are copied to a per-thread buffer reused across calls and projected with the
+            fused basis and offset, see _fuse_projection
+
+            Returns:
+                projections ((N x components) np.array): one projection per row, owned by the caller
+        """
+        with PROJECT_SECONDS.time():
+            face_matrix = self._face_matrix(len(faces))
+            if isinstance(faces, np.ndarray):
+                face_matrix[:] = faces.reshape(len(faces), -1)
+            else:
+                for i, faceImg in enumerate(faces):
+                    face_matrix[i] = faceImg.reshape(-1)
+
+            # Single GEMM for all faces
+            if self.precision == 'int8':
+                projections = project_quantized(face_matrix, self.facespace, self._fused_scales)
+            else:
+                projections = np.matmul(face_matrix, self._fused_basis.T)
+            projections += self._fused_offset
+        return projections
 
     def _project_to_facespace(self, faceImg):
         """Project Image of a face to the face recognizer's face space"""
-        # Mean center face
-        faceImg = self._adjust_brightness_contrast(faceImg)
-        mean_centered = faceImg.flatten() - self.mean_face
-        # Project to facespace
-        projection = project(self.facespace, mean_centered)
-        return projection
-
-    def _adjust_brightness_contrast(self, faceImg):
-        """Adjust image contrast and brightness based provided coefficients"""
-        # contrast*Image + brightness
-        adjusted = self.contrast_coeff*faceImg + np.full_like(faceImg, self.brightness_coeff)
-        return adjusted
+        return self._project_batch_to_facespace([faceImg])[0]
+
+    def _face_matrix(self, n_faces):
+        """(n_faces x H*W) view of the calling thread's face buffer, grown as needed"""
+        buffer = getattr(self._buffers, 'faces', None)
+        if buffer is None:
+            buffer = np.empty((0, self.facespace.shape[1]), dtype=self._dtype)
+        self._buffers.faces = buffer = grow_capacity(buffer, n_faces)
+        return buffer[:n_faces]
+
+
+def _precision_of(facespace):
+    """Precision matching the type a facespace is stored in"""
+    if facespace.dtype == np.int8:
+        return 'int8'
+    return 'float32' if facespace.dtype == np.float32 else 'float64'
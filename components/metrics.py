@@ -0,0 +1,319 @@
+""" Counters, gauges, histograms and timers describing where the live loop spends its time
+
+    Components record into the module registry REGISTRY, which is disabled by default. While
+    disabled every recording returns after checking a flag and timers are a shared no-op, so
+    instrumentation costs next to nothing. Once enabled, metrics are exported as Prometheus
+    text by a MetricsServer, or logged periodically as JSON by a MetricsLogger.
+"""
+import bisect
+import collections
+import json
+import logging
+import math
+import threading
+import time
+
+# Upper bounds in seconds, from a fast projection to a slow full frame detection
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0)
+
+
+class _Metric:
+    """ Base of the metric types
+
+        Attributes:
+            name (str): metric name, e.g. pybell_detect_seconds
+            help (str): description of the metric
+            labels (dict): label name -> value distinguishing metrics of the same name
+    """
+    type = None
+
+    def __init__(self, registry, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._registry = registry
+        self._lock = threading.Lock()
+
+    def samples(self):
+        """(name suffix, extra labels, value) of every exported sample"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """ Monotonically increasing count, e.g. of captured frames
+
+        A counter created with func reads its value from func whenever it is collected,
+        for counts another object already keeps.
+    """
+    type = 'counter'
+
+    def __init__(self, registry, name, help, labels, func=None):
+        super().__init__(registry, name, help, labels)
+        self.value = 0
+        self.func = func
+
+    def inc(self, amount=1):
+        if self._registry.enabled:
+            with self._lock:
+                self.value += amount
+
+    def samples(self):
+        yield '', dict(), self.func() if self.func is not None else self.value
+
+
+class Gauge(Counter):
+    """ Value going up and down, e.g. a queue depth, set directly or read from func """
+    type = 'gauge'
+
+    def set(self, value):
+        if self._registry.enabled:
+            self.value = value
+
+
+class Histogram(_Metric):
+    """ Distribution of observed values, e.g. durations, counted in cumulative buckets
+
+        Attributes:
+            buckets (tuple): increasing upper bounds of the buckets, +inf is implied
+            count (int): number of observations
+            sum (float): sum of the observations
+    """
+    type = 'histogram'
+
+    def __init__(self, registry, name, help, labels, buckets=DEFAULT_BUCKETS):
+        super().__init__(registry, name, help, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.count = 0
+        self.sum = 0.0
+        self._counts = [0]*(len(self.buckets) + 1)
+
+    def observe(self, value):
+        if not self._registry.enabled:
+            return
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self._counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds spent in its block"""
+        return Timer(self) if self._registry.enabled else _NULL_TIMER
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding quantile q of the observations, None if there are none"""
+        if self.count == 0:
+            return None
+        rank, cumulative = q*self.count, 0
+        for bound, count in zip(self.buckets + (math.inf,), self._counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return math.inf
+
+    def samples(self):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self._counts):
+            cumulative += count
+            yield '_bucket', {'le': _format_value(bound)}, cumulative
+        yield '_sum', dict(), self.sum
+        yield '_count', dict(), self.count
+
+
+class Timer:
+    """ Context manager observing the seconds spent in its block in a histogram
+
+        Example:
+            with DETECT_SECONDS.time():
+                bboxes = detector.detectMultiScale(img)
+    """
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self._start)
+        return False
+
+
+class _NullTimer:
+    """Timer of a disabled registry, shared by all threads as it has no state"""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_TIMER = _NullTimer()
+
+
+class MetricsRegistry:
+    """ Named metrics of the process
+
+        Getting a metric with the name and labels of an existing one returns it, so
+        components can get their metrics wherever convenient.
+
+        Attributes:
+            enabled (bool): whether metrics record anything
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def counter(self, name, help='', func=None, **labels):
+        """Get or create a Counter, func replaces the value source of an existing counter"""
+        return self._get(Counter, name, help, labels, func=func)
+
+    def gauge(self, name, help='', func=None, **labels):
+        """Get or create a Gauge, func replaces the value source of an existing gauge"""
+        return self._get(Gauge, name, help, labels, func=func)
+
+    def histogram(self, name, help='', buckets=DEFAULT_BUCKETS, **labels):
+        """Get or create a Histogram"""
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def _get(self, cls, name, help, labels, func=None, **kwargs):
+        labels = {key: str(value) for key, value in sorted(labels.items())}
+        key = (name, tuple(labels.items()))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = cls(self, name, help, labels, **kwargs)
+                self._metrics[key] = metric
+            assert type(metric) is cls, f"Metric {name} is a {metric.type}, not a {cls.type}"
+            if func is not None:
+                metric.func = func
+        return metric
+
+    def collect(self):
+        """All metrics, grouped by name"""
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return sorted(metrics, key=lambda metric: metric.name)
+
+    def render_prometheus(self):
+        """ Metrics in the Prometheus text exposition format
+
+            Returns:
+                text (str): HELP and TYPE lines of every metric name followed by its samples
+        """
+        lines, previous = list(), None
+        for metric in self.collect():
+            if metric.name != previous:
+                lines.append(f"# HELP {metric.name} {metric.help}")
+                lines.append(f"# TYPE {metric.name} {metric.type}")
+                previous = metric.name
+            for suffix, extra_labels, value in metric.samples():
+                lines.append(f"{metric.name}{suffix}{_format_labels(dict(metric.labels, **extra_labels))} "
+                             f"{_format_value(value)}")
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        """ Current values of the metrics, e.g. to log them as JSON
+
+            Returns:
+                snapshot (dict): metric name with its labels -> value, or count, sum, mean,
+                                 p50, p95 and p99 of histograms, whose quantiles are bucket upper bounds
+        """
+        snapshot = dict()
+        for metric in self.collect():
+            key = metric.name + _format_labels(metric.labels)
+            if isinstance(metric, Histogram):
+                snapshot[key] = {
+                    'count': metric.count,
+                    'sum': metric.sum,
+                    'mean': metric.sum/metric.count if metric.count else None,
+                    'p50': metric.quantile(0.5),
+                    'p95': metric.quantile(0.95),
+                    'p99': metric.quantile(0.99),
+                }
+            else:
+                snapshot[key] = next(metric.samples())[2]
+        return snapshot
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in labels.values())
+    return '{' + ','.join(f'{key}="{value}"' for key, value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+REGISTRY = MetricsRegistry()
+
+
+class MetricsServer:
+    """ Serves the metrics of a registry as Prometheus text on http://host:port/metrics
+
+        Attributes:
+            port (int): port the server listens on, the chosen free port if created with port 0
+    """
+    def __init__(self, registry=REGISTRY, host='127.0.0.1', port=9100):
+        # Only imported when metrics are served, it is a noticeable part of the startup time
+        import http.server
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = registry.render_prometheus().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                logging.debug(f"Metrics request from {self.address_string()}: {format % args}")
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.port = self.server.server_address[1]
+        self._thread = threading.Thread(target=self.server.serve_forever, name='metrics-server', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop serving and release the port"""
+        self.server.shutdown()
+        self.server.server_close()
+        self._thread.join()
+
+
+class MetricsLogger(threading.Thread):
+    """ Logs a JSON snapshot of the metrics of a registry every interval seconds """
+    def __init__(self, interval, registry=REGISTRY, logger=None):
+        super().__init__(name='metrics-logger', daemon=True)
+        self.interval = interval
+        self.registry = registry
+        self.logger = logger or logging.getLogger('pybell.metrics')
+        self._stop = threading.Event()
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            self.log()
+
+    def log(self):
+        """Log the current snapshot"""
+        self.logger.info(json.dumps(dict(self.registry.snapshot(), time=time.time())))
+
+    def stop(self):
+        self._stop.set()
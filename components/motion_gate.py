@@ -0,0 +1,173 @@
+""" Motion gating deciding whether and where to run face detection """
+import threading
+
+import numpy as np
+import cv2
+
+from .util.image import cvt_to_gray
+
+
+class MotionGate:
+    """ Finds the regions of a frame that changed, using a downscaled grayscale copy
+
+        A door camera sees an empty hallway most of the time, detection only needs to run
+        when something moves and only around what moved. Changed pixels are found by
+        differencing consecutive frames ('diff') or with a MOG2 background model ('mog2'),
+        grouped into boxes and grown by a margin. Regions stay active for hold_frames after
+        motion stops so that a person standing still at the door is still detected.
+
+        Attributes:
+            method (str): 'diff' or 'mog2'
+            scale (float): downscaling factor of the motion analysis frame
+            pixel_thresh (int): minimum absolute gray level change of a moving pixel ('diff')
+            min_area (float): minimum area of a moving region, as a fraction of the frame
+            margin (float): margin added around moving regions, relative to the region size
+            hold_frames (int): number of frames regions stay active after motion stops
+            full_frame_interval (int): run detection on the full frame every N frames, 0 never
+            hits (int): frames where detection had to run
+            skips (int): frames where detection was skipped
+            searched_area (float): sum over frames of the fraction of the frame searched
+    """
+    def __init__(self, method='diff', scale=0.25, pixel_thresh=25, min_area=0.002, margin=0.5,
+                 hold_frames=15, full_frame_interval=0):
+        assert method in ('diff', 'mog2'), f"Unknown motion gating method: {method}"
+        self.method = method
+        self.scale = scale
+        self.pixel_thresh = pixel_thresh
+        self.min_area = min_area
+        self.margin = margin
+        self.hold_frames = hold_frames
+        self.full_frame_interval = full_frame_interval
+
+        self.hits = 0
+        self.skips = 0
+        self.searched_area = 0.0
+
+        self._previous = None
+        self._subtractor = cv2.createBackgroundSubtractorMOG2(detectShadows=False) if method == 'mog2' else None
+        self._held_regions = list()
+        self._held_for = 0
+        self._frame_count = 0
+        self._lock = threading.Lock()
+
+    def stats(self):
+        """ Gating counters
+
+            Returns:
+                stats (dict): hits, skips, skip_ratio and mean fraction of the frame searched
+        """
+        frames = self.hits + self.skips
+        return {
+            'hits': self.hits,
+            'skips': self.skips,
+            'skip_ratio': self.skips/frames if frames else 0.0,
+            'searched_fraction': self.searched_area/frames if frames else 0.0,
+        }
+
+    def update(self, img):
+        """ Analyse a new frame and return where faces should be searched
+
+            Args:
+                img (np.array): frame, color or grayscale
+
+            Returns:
+                regions (List): (x, y, w, h) regions of the full resolution frame to search,
+                                empty if detection can be skipped, None for the whole frame
+        """
+        gray = cvt_to_gray(img)
+        height, width = gray.shape
+
+        with self._lock:
+            self._frame_count += 1
+            if self.full_frame_interval and self._frame_count % self.full_frame_interval == 0:
+                # Keep the motion model up to date even when searching everything
+                self._moving_regions(gray)
+                self._record(1.0)
+                return None
+
+            regions = self._moving_regions(gray)
+            if regions:
+                self._held_regions = regions
+                self._held_for = 0
+            elif self._held_for < self.hold_frames:
+                self._held_for += 1
+                regions = self._held_regions
+
+            area = sum(w*h for _, _, w, h in regions)/float(width*height)
+            self._record(area)
+            return regions
+
+    def _record(self, area):
+        if area > 0:
+            self.hits += 1
+        else:
+            self.skips += 1
+        self.searched_area += area
+
+    def _moving_regions(self, gray):
+        """Boxes around moving pixels, in full resolution coordinates"""
+        small = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        small = cv2.GaussianBlur(small, (5, 5), 0)
+
+        if self._subtractor is not None:
+            mask = self._subtractor.apply(small)
+        else:
+            if self._previous is None or self._previous.shape != small.shape:
+                self._previous = small
+                return list()
+            diff = cv2.absdiff(small, self._previous)
+            self._previous = small
+            _, mask = cv2.threshold(diff, self.pixel_thresh, 255, cv2.THRESH_BINARY)
+
+        mask = cv2.dilate(mask, None, iterations=2)
+        contours = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)[-2]
+
+        small_h, small_w = small.shape
+        min_area = self.min_area*small_h*small_w
+        boxes = [cv2.boundingRect(c) for c in contours if cv2.contourArea(c) >= min_area]
+
+        height, width = gray.shape
+        regions = [_grow_box(box, self.margin, 1.0/self.scale, width, height) for box in boxes]
+        return merge_overlapping_boxes(regions)
+
+
+def _grow_box(box, margin, scale, width, height):
+    """Scale a box to full resolution, add a relative margin and clip it to the frame"""
+    x, y, w, h = [v*scale for v in box]
+    dx, dy = margin*w, margin*h
+    x0, y0 = max(0, int(x - dx)), max(0, int(y - dy))
+    x1, y1 = min(width, int(np.ceil(x + w + dx))), min(height, int(np.ceil(y + h + dy)))
+    return (x0, y0, x1 - x0, y1 - y0)
+
+
+def merge_overlapping_boxes(boxes):
+    """ Merge overlapping (x, y, w, h) boxes into their bounding boxes until none overlap
+
+        Returns:
+            merged (List): non-overlapping boxes covering every input box
+    """
+    merged = list(boxes)
+    changed = True
+    while changed:
+        changed = False
+        result = list()
+        for box in merged:
+            for i, other in enumerate(result):
+                if _overlap(box, other):
+                    result[i] = _union(box, other)
+                    changed = True
+                    break
+            else:
+                result.append(box)
+        merged = result
+    return merged
+
+
+def _overlap(a, b):
+    return a[0] < b[0] + b[2] and b[0] < a[0] + a[2] and a[1] < b[1] + b[3] and b[1] < a[1] + a[3]
+
+
+def _union(a, b):
+    x0, y0 = min(a[0], b[0]), min(a[1], b[1])
+    x1, y1 = max(a[0] + a[2], b[0] + b[2]), max(a[1] + a[3], b[1] + b[3])
+    return (x0, y0, x1 - x0, y1 - y0)
@@ -0,0 +1,218 @@
+""" Several cameras sharing one pool of face detection and recognition workers """
+import logging
+import queue
+import threading
+import time
+
+import cv2
+
+from .camera import CameraStream
+from .face_detector import FaceDetector
+from .motion_gate import MotionGate
+from .metrics import REGISTRY
+from .pipeline import FramePacket, FrameQueue, StageStats, register_queue
+from .tracker import FaceTracker, apply_tracks
+
+
+class MultiCameraManager:
+    """ Runs detection and recognition for several cameras on a shared worker pool
+
+        Every camera runs a background grabber keeping only its newest frame. Workers pick
+        frames from the cameras round-robin, skipping cameras without a new frame or whose
+        fps target says the next frame is not due yet, so a fast camera can not starve a
+        slow one. A camera has at most one frame in flight, so its motion gate and tracker see
+        its frames one at a time and in order, while different cameras are processed in parallel.
+        Each worker owns a FaceDetector while the FaceRecognizer, with its facespace and gallery,
+        is shared, so memory and CPU scale with workers, not cameras.
+
+        Attributes:
+            cameras (List): CameraStream of every source
+            gates (List): MotionGate of every source, None when gating is disabled
+            trackers (List): FaceTracker of every source, None when tracking is disabled
+            sources (List): source identifiers, used to tag results
+            recognizer (FaceRecognizer): recognizer shared by the workers
+            fps_targets (List): maximum processed frames per second of every source, None for no limit
+            results (FrameQueue): processed FramePackets tagged with their source
+            stats (dict): source -> StageStats of the frames processed for that source
+    """
+    def __init__(self, sources, recognizer, workers=2, fps_targets=None, detector_kwargs=None,
+                 detector=None, camera_kwargs=None, gate_kwargs=None, tracker_kwargs=None, face_shape=(64,64),
+                 queue_size=8, cameras=None):
+        """ Open every camera and start the workers
+
+            Args:
+                sources (List): camera indices or video files
+                recognizer (FaceRecognizer): recognizer shared by every worker
+                workers (int): number of detection/recognition workers
+                fps_targets (List or float): fps target per source or for all sources
+                detector_kwargs (dict): keyword arguments of the workers' FaceDetectors
+                detector: thread safe detector shared by the workers instead of one FaceDetector
+                          each, e.g. a ParallelFaceDetector
+                camera_kwargs (dict): keyword arguments of the CameraStreams, e.g. calibration
+                gate_kwargs (dict): keyword arguments of a MotionGate per camera, None disables gating
+                tracker_kwargs (dict): keyword arguments of a FaceTracker per camera, None disables tracking
+                face_shape (tuple): shape faces are resized to before recognition
+                queue_size (int): capacity of the results queue, oldest results are dropped
+                cameras (List): threaded CameraStreams of the sources already opened, e.g. while
+                                the model was loading, None to open them
+        """
+        camera_kwargs = dict(camera_kwargs or dict(), threaded=True)
+        self.sources = list(sources)
+        if cameras is None:
+            cameras = [CameraStream(source, **camera_kwargs) for source in self.sources]
+        assert len(cameras) == len(self.sources), "One camera is needed per source"
+        self.cameras = list(cameras)
+        self.gates = [MotionGate(**gate_kwargs) if gate_kwargs is not None else None
+                      for _ in self.sources]
+        self.trackers = [FaceTracker(recognizer, **tracker_kwargs) if tracker_kwargs is not None else None
+                         for _ in self.sources]
+        self.recognizer = recognizer
+        self.face_shape = face_shape
+
+        if fps_targets is None or isinstance(fps_targets, (int, float)):
+            fps_targets = [fps_targets]*len(self.sources)
+        assert len(fps_targets) == len(self.sources), "One fps target is needed per source"
+        self.fps_targets = list(fps_targets)
+
+        self.results = FrameQueue(queue_size, drop_oldest=True)
+        self.stats = {source: StageStats() for source in self.sources}
+        register_queue(self.results, 'camera-worker')
+        self._seconds = {source: REGISTRY.histogram('pybell_source_seconds', 'Seconds spent processing a frame of a camera',
+                                                    source=source) for source in self.sources}
+        self._errors = {source: REGISTRY.counter('pybell_source_errors_total', 'Frames of a camera whose processing raised',
+                                                 source=source) for source in self.sources}
+
+        self._next_due = [0.0]*len(self.sources)
+        self._finished = [False]*len(self.sources)
+        self._in_flight = [False]*len(self.sources)
+        self._next_source = 0
+        self._schedule_lock = threading.Lock()
+        self._recognizer_lock = threading.Lock()
+        self._enrollments = queue.Queue()
+        self._stop = threading.Event()
+
+        detector_kwargs = detector_kwargs or dict()
+        self._workers = [threading.Thread(target=self._work, args=(detector or FaceDetector(**detector_kwargs),),
+                                          name=f'camera-worker-{i}', daemon=True)
+                         for i in range(workers)]
+        self._running = len(self._workers)
+        for worker in self._workers:
+            worker.start()
+
+    def stop(self):
+        """Stop the workers and release the cameras"""
+        self._stop.set()
+        for worker in self._workers:
+            worker.join()
+        for camera in self.cameras:
+            camera.stop()
+        self.results.close()
+
+    def enroll(self, name, face):
+        """Add a face to the shared recognizer's known faces without blocking the caller"""
+        self._enrollments.put((name, face))
+
+    def _next_frame(self):
+        """ Pick the next frame to process, round-robin over the sources that are due and
+            have no frame in flight. The frame is in flight until _done is called
+
+            Returns:
+                (source index, TimestampedFrame), (None, None) if no frame is ready, or
+                (-1, None) once every source has ended
+        """
+        with self._schedule_lock:
+            now = time.monotonic()
+            n_sources = len(self.sources)
+            for offset in range(n_sources):
+                i = (self._next_source + offset) % n_sources
+                if self._finished[i] or self._in_flight[i] or now < self._next_due[i]:
+                    continue
+
+                ended = not self.cameras[i].grabbing
+                frame = self.cameras[i].latest_frame(timeout=0)
+                if frame is None:
+                    # No new frame and the grabber had already stopped, the source has ended
+                    self._finished[i] = ended
+                    continue
+
+                if self.fps_targets[i]:
+                    self._next_due[i] = now + 1.0/self.fps_targets[i]
+                self._next_source = (i + 1) % n_sources
+                self._in_flight[i] = True
+                return i, frame
+
+            if all(self._finished):
+                return -1, None
+            return None, None
+
+    def _done(self, i):
+        """Let the next frame of source i be picked"""
+        with self._schedule_lock:
+            self._in_flight[i] = False
+
+    def _work(self, detector):
+        """Worker loop processing frames of every source"""
+        while not self._stop.is_set():
+            i, frame = self._next_frame()
+            if i is None:
+                time.sleep(0.002)
+                continue
+            if i < 0:
+                break
+
+            source = self.sources[i]
+            start = time.perf_counter()
+            try:
+                packet = self._process(detector, i, frame)
+            except Exception:
+                self.stats[source].record_error()
+                self._errors[source].inc()
+                logging.exception(f"Failed to process frame of source {source}")
+                continue
+            finally:
+                self._done(i)
+            duration = time.perf_counter() - start
+            self.stats[source].record(duration)
+            self._seconds[source].observe(duration)
+            self.results.put(packet)
+
+        with self._schedule_lock:
+            self._running -= 1
+            if self._running == 0:
+                self.results.close()
+
+    def _process(self, detector, i, frame):
+        """Undistort, detect and recognize faces of a single frame of source i"""
+        camera = self.cameras[i]
+        packet = FramePacket(frame.frame_id, frame.image, frame.timestamp, source=self.sources[i])
+        if camera.undistort_fisheye:
+            packet.image = camera.undistort(packet.image)
+
+        if self.gates[i] is not None:
+            packet.regions = self.gates[i].update(packet.gray)
+
+        _, packet.bboxes, faces = detector.detectFaces(packet.image, packet.regions, packet.gray)
+        packet.faces = [cv2.resize(face, self.face_shape) for face in faces]
+
+        with self._recognizer_lock:
+            enrolled = False
+            while not self._enrollments.empty():
+                name, face = self._enrollments.get_nowait()
+                self.recognizer.add_known_face(name, face)
+                enrolled = True
+            if enrolled:
+                for tracker in self.trackers:
+                    if tracker is not None:
+                        tracker.reset_recognition()
+
+            tracker = self.trackers[i]
+            if tracker is not None:
+                apply_tracks(packet, tracker.update(packet.gray, packet.bboxes, packet.faces))
+            else:
+                packet.names, packet.distances = self.recognizer.recognize_batch(packet.faces)
+
+        return packet
+
+    def get(self, timeout=None):
+        """Return the next processed FramePacket, see FrameQueue.get"""
+        return self.results.get(timeout)
@@ -0,0 +1,191 @@
+""" Face detection distributed over a process pool """
+import collections
+import multiprocessing
+import os
+import queue
+import threading
+from multiprocessing.sharedctypes import RawArray
+
+import numpy as np
+import cv2
+
+from .face_detector import FaceDetector, get_profile, _extract_faces_from_bbox, dirname, DETECT_SECONDS, FACES_DETECTED
+from .util.detection import non_max_suppression, tile_regions
+from .util.image import cvt_to_gray
+
+# Shared buffers and detector of a pool process, set by _init_worker
+_worker = dict()
+
+
+def _init_worker(buffers, cascade, face_shape, profile):
+    # One process per core already, OpenCV threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+    _worker['buffers'] = buffers
+    _worker['detector'] = FaceDetector(cascade, face_shape, profile=profile)
+
+
+def _detect_region(slot, shape, region):
+    """Detect faces in a region of the frame held in a shared buffer, bboxes in frame coordinates"""
+    height, width = shape
+    img = np.frombuffer(_worker['buffers'][slot], dtype=np.uint8, count=height*width).reshape(shape)
+    x, y, w, h = region
+    _, found, _ = _worker['detector'].detectFaces(img[y:y+h, x:x+w])
+    return [(int(bx) + x, int(by) + y, int(bw), int(bh)) for (bx, by, bw, bh) in found]
+
+
+class ParallelFaceDetector:
+    """ Haar cascade face detection on a pool of processes
+
+        Cascade detection holds a core for the whole frame, so frames, and tiles of large
+        frames, are spread over worker processes. Frames are copied once into shared memory
+        buffers that every worker maps, instead of being pickled to the workers. Faces found
+        twice in the overlap of neighbouring tiles are merged by non maximum suppression.
+
+        detectFaces can be called from several threads to keep several frames in flight,
+        detect_frames processes a sequence of frames and yields the results in frame order.
+
+        Attributes:
+            processes (int): number of worker processes
+            tiles (tuple): (rows, columns) of tiles frames are split into, (1, 1) for whole frames
+            overlap (int): pixels shared by neighbouring tiles, the largest face size of the
+                profile or a quarter of a tile if None
+            nms_thresh (float): IoU above which detections of overlapping tiles are merged
+            max_in_flight (int): number of shared frame buffers, i.e. frames processed at once
+            profile (DetectionProfile): search parameters of the workers' detectors
+    """
+    def __init__(self, processes=None, cascade=os.path.join(dirname, '../data/cascades/haarcascade_frontalface_alt.xml'),
+                 face_shape=(64,64), profile=None, tiles=(1, 1), overlap=None, nms_thresh=0.3, max_in_flight=None):
+        if not os.path.isfile(cascade):
+            raise FileNotFoundError(f"Cascade file not found at: {cascade}")
+
+        self.processes = processes or os.cpu_count()
+        self.cascade = cascade
+        self.face_shape = face_shape
+        self.profile = get_profile(profile)
+        self.tiles = tuple(tiles)
+        self.overlap = overlap
+        self.nms_thresh = nms_thresh
+        self.max_in_flight = max_in_flight or 2*self.processes
+
+        self._pool = None
+        self._buffers = None
+        self._capacity = 0
+        self._slots = queue.Queue()
+        self._resize_lock = threading.Lock()
+
+    def close(self):
+        """Stop the worker processes"""
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+            self._capacity = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def detectFaces(self, img, regions=None, gray=None):
+        """ Detect faces in an image using the worker processes, see FaceDetector.detectFaces
+
+            Args:
+                img (np.array): Image to detect faces in
+                (Optional) regions (List): (x, y, width, height) regions to restrict the search to,
+                                           None searches the whole image, split into tiles
+                (Optional) gray (np.array): grayscale version of img if another stage already converted it
+
+            Returns:
+                face_count (int): Number of faces detected
+                bboxes (List): list of (x, y, width, height) tuples representing bounding boxes of detected faces
+                faces (List): list of extracted face image subsets from image
+        """
+        with DETECT_SECONDS.time():
+            faceCount, bboxes, faces = self._collect(self._submit(img, regions, gray))
+        FACES_DETECTED.inc(faceCount)
+        return faceCount, bboxes, faces
+
+    def detect_frames(self, frames):
+        """ Detect faces in a sequence of frames, up to max_in_flight frames at a time
+
+            Args:
+                frames (iterable): images to detect faces in
+
+            Yields:
+                (face_count, bboxes, faces) of every frame, in frame order
+        """
+        pending = collections.deque()
+        for img in frames:
+            if img.shape[0]*img.shape[1] > self._capacity:
+                # Growing the buffers waits for every frame in flight, collect ours first
+                while pending:
+                    yield self._collect(pending.popleft())
+            elif len(pending) >= self.max_in_flight:
+                yield self._collect(pending.popleft())
+            pending.append(self._submit(img))
+
+        while pending:
+            yield self._collect(pending.popleft())
+
+    def regions(self, shape):
+        """Tiles a frame of a given shape is split into"""
+        height, width = shape[:2]
+        if self.tiles == (1, 1):
+            return [(0, 0, width, height)]
+
+        overlap = self.overlap
+        if overlap is None:
+            if self.profile.max_size is not None:
+                overlap = max(self.profile.max_size)
+            else:
+                overlap = min(height//self.tiles[0], width//self.tiles[1])//4
+        return tile_regions(shape, self.tiles, overlap)
+
+    def _submit(self, img, regions=None, gray=None):
+        """Copy a frame to a free shared buffer and queue detection of its regions"""
+        gray = np.ascontiguousarray(cvt_to_gray(img) if gray is None else gray, dtype=np.uint8)
+        height, width = gray.shape
+        slot = self._reserve_slot(height*width)
+        np.frombuffer(self._buffers[slot], dtype=np.uint8, count=height*width)[:] = gray.ravel()
+
+        regions = self.regions(gray.shape) if regions is None else regions
+        tasks = [self._pool.apply_async(_detect_region, (slot, gray.shape, tuple(int(v) for v in region)))
+                 for region in regions]
+        return gray, slot, tasks
+
+    def _collect(self, pending):
+        """Wait for the detections of a submitted frame and release its buffer"""
+        gray, slot, tasks = pending
+        try:
+            bboxes = [bbox for task in tasks for bbox in task.get()]
+        finally:
+            self._slots.put(slot)
+
+        if len(tasks) > 1:
+            bboxes = non_max_suppression(bboxes, self.nms_thresh)
+        # Same result type as FaceDetector.detectFaces
+        bboxes = np.array(bboxes, dtype=np.int32).reshape(-1, 4) if len(bboxes) else tuple()
+
+        return len(bboxes), bboxes, _extract_faces_from_bbox(gray, bboxes)
+
+    def _reserve_slot(self, size):
+        """Take a free shared buffer of at least size bytes, growing the buffers if needed"""
+        with self._resize_lock:
+            if size > self._capacity:
+                # Wait for the frames in flight, then restart the workers with larger buffers
+                if self._pool is not None:
+                    for _ in range(self.max_in_flight):
+                        self._slots.get()
+                    self.close()
+                self._start_pool(size)
+            return self._slots.get()
+
+    def _start_pool(self, size):
+        self._buffers = [RawArray('B', size) for _ in range(self.max_in_flight)]
+        self._pool = multiprocessing.Pool(self.processes, initializer=_init_worker,
+                                          initargs=(self._buffers, self.cascade, self.face_shape, self.profile))
+        self._capacity = size
+        self._slots = queue.Queue()
+        for slot in range(self.max_in_flight):
+            self._slots.put(slot)
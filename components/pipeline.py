@@ -0,0 +1,294 @@
+""" Staged multi-threaded frame processing pipeline
+
+    Frames flow through a chain of stages connected by bounded queues. Each stage runs
+    its function on one or more worker threads; OpenCV and numpy release the GIL in their
+    heavy calls, so capture, detection and recognition overlap in time. When a queue is
+    full the oldest frame is dropped by default so that the output stays real-time.
+"""
+import collections
+import logging
+import threading
+import time
+
+from .metrics import REGISTRY
+from .util.image import cvt_to_gray
+
+
+class FramePacket:
+    """ Data attached to a frame as it moves through the pipeline
+
+        Attributes:
+            frame_id (int): sequence number of the frame
+            timestamp (float): time.monotonic() at which the frame was captured
+            image (np.array): frame image
+            gray (np.array): grayscale frame image, converted once and shared by the stages
+            bboxes (List): face bounding boxes, set by detection
+            faces (List): face images, set by detection
+            names (List): recognized name per face, set by recognition
+            distances (np.array): distance to the closest known face per face
+            source: camera the frame comes from, when several cameras are processed
+            regions (List): regions to search for faces, None for the whole frame
+            track_ids (List): id of the track of every face, when faces are tracked
+    """
+    def __init__(self, frame_id, image, timestamp=None, source=None):
+        self.frame_id = frame_id
+        self.source = source
+        self.regions = None
+        self.track_ids = list()
+        self.timestamp = time.monotonic() if timestamp is None else timestamp
+        self.image = image
+        self.bboxes = list()
+        self.faces = list()
+        self.names = list()
+        self.distances = list()
+        self._gray = None
+        self._gray_source = None
+
+    @property
+    def gray(self):
+        """Grayscale image, converted again only if a stage replaced the image"""
+        if self._gray_source is not self.image:
+            self._gray = cvt_to_gray(self.image)
+            self._gray_source = self.image
+        return self._gray
+
+
+class Closed(Exception):
+    """Raised when getting from a queue that is closed and empty"""
+
+
+class FrameQueue:
+    """ Bounded queue between two stages
+
+        Attributes:
+            maxsize (int): maximum number of items held
+            drop_oldest (bool): when full, drop the oldest item instead of blocking the producer
+            dropped (int): number of items dropped
+    """
+    def __init__(self, maxsize=2, drop_oldest=True):
+        self.maxsize = maxsize
+        self.drop_oldest = drop_oldest
+        self.dropped = 0
+        self._items = collections.deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return len(self._items)
+
+    def put(self, item):
+        """Add an item, dropping the oldest one or waiting for room if the queue is full"""
+        with self._cond:
+            while len(self._items) >= self.maxsize and not self._closed:
+                if self.drop_oldest:
+                    self._items.popleft()
+                    self.dropped += 1
+                else:
+                    self._cond.wait()
+
+            if self._closed:
+                return
+            self._items.append(item)
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """ Remove and return the oldest item
+
+            Raises:
+                Closed: if the queue was closed and is empty
+                TimeoutError: if no item arrived within timeout seconds
+        """
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items or self._closed, timeout):
+                raise TimeoutError
+            if not self._items:
+                raise Closed
+            item = self._items.popleft()
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        """Wake up waiting consumers and producers, consumers get remaining items then Closed"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class StageStats:
+    """ Throughput statistics of a stage
+
+        Attributes:
+            processed (int): number of items processed
+            busy_time (float): total seconds spent in the stage function
+            errors (int): number of items whose processing raised
+    """
+    def __init__(self):
+        self.processed = 0
+        self.busy_time = 0.0
+        self.errors = 0
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+
+    def record(self, duration):
+        with self._lock:
+            self.processed += 1
+            self.busy_time += duration
+
+    def record_error(self):
+        with self._lock:
+            self.errors += 1
+
+    def as_dict(self):
+        elapsed = time.monotonic() - self._start
+        return {
+            'processed': self.processed,
+            'errors': self.errors,
+            'fps': self.processed/elapsed if elapsed > 0 else 0.0,
+            'mean_latency_ms': 1000*self.busy_time/self.processed if self.processed else 0.0,
+        }
+
+
+def register_queue(queue, stage, **labels):
+    """Export the depth and dropped items of the queue a stage writes to as metrics"""
+    REGISTRY.gauge('pybell_queue_depth', 'Items waiting in the queue a stage writes to',
+                   func=lambda: len(queue), stage=stage, **labels)
+    REGISTRY.counter('pybell_queue_dropped_total', 'Items dropped from the full queue a stage writes to',
+                     func=lambda: queue.dropped, stage=stage, **labels)
+
+
+class Stage:
+    """ Pipeline stage running func on items of in_queue and putting results in out_queue
+
+        func returns the item to pass on, or None to drop it. A source stage raises
+        StopIteration once it has no more items, which closes the downstream queues.
+
+        Attributes:
+            name (str): name of the stage used in stats and thread names
+            func (callable): function applied to every item
+            workers (int): number of worker threads
+            in_queue (FrameQueue): queue items are read from, None for a source stage
+            out_queue (FrameQueue): queue results are written to, None for a sink stage
+            stats (StageStats): throughput statistics
+    """
+    def __init__(self, name, func, workers=1, in_queue=None, out_queue=None):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.in_queue = in_queue
+        self.out_queue = out_queue
+        self.stats = StageStats()
+        self._seconds = REGISTRY.histogram('pybell_stage_seconds', 'Seconds spent processing an item in a stage', stage=name)
+        self._errors = REGISTRY.counter('pybell_stage_errors_total', 'Items whose processing raised', stage=name)
+        self._stop = threading.Event()
+        self._threads = list()
+        self._running = 0
+        self._running_lock = threading.Lock()
+
+    def start(self):
+        self._running = self.workers
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, name=f'{self.name}-{i}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self._stop.set()
+
+    def join(self, timeout=None):
+        for thread in self._threads:
+            thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            # Source stages produce items from nothing
+            if self.in_queue is None:
+                item = None
+            else:
+                try:
+                    item = self.in_queue.get(timeout=0.1)
+                except TimeoutError:
+                    continue
+                except Closed:
+                    break
+
+            start = time.perf_counter()
+            try:
+                result = self.func(item)
+            except StopIteration:
+                # Source ran out of items, e.g. end of a video file
+                break
+            except Exception:
+                self.stats.record_error()
+                self._errors.inc()
+                logging.exception(f"Stage {self.name} failed to process an item")
+                continue
+            duration = time.perf_counter() - start
+            self.stats.record(duration)
+            self._seconds.observe(duration)
+
+            if result is not None and self.out_queue is not None:
+                self.out_queue.put(result)
+
+        # Let downstream stages finish once every worker of this stage is done
+        with self._running_lock:
+            self._running -= 1
+            last_worker = self._running == 0
+        if last_worker and self.out_queue is not None:
+            self.out_queue.close()
+
+
+class Pipeline:
+    """ Chain of stages connected by bounded queues
+
+        The output of the last stage is read with get(), typically from the main thread
+        which owns GUI or terminal output.
+
+        Args:
+            stages (List): (name, func, workers) tuples in processing order, the first stage
+                           is a source called with None
+            queue_size (int): capacity of the queues between stages
+            drop_oldest (bool): drop the oldest item of full queues instead of blocking
+    """
+    def __init__(self, stages, queue_size=2, drop_oldest=True):
+        self.queues = list()
+        self.stages = list()
+
+        in_queue = None
+        for name, func, workers in stages:
+            out_queue = FrameQueue(queue_size, drop_oldest)
+            self.stages.append(Stage(name, func, workers, in_queue, out_queue))
+            self.queues.append(out_queue)
+            register_queue(out_queue, name)
+            in_queue = out_queue
+
+        self.output = in_queue
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+        for queue in self.queues:
+            queue.close()
+        for stage in self.stages:
+            stage.join(timeout=1)
+
+    def get(self, timeout=None):
+        """Return the next processed item, see FrameQueue.get"""
+        return self.output.get(timeout)
+
+    def stats(self):
+        """ Per stage throughput statistics
+
+            Returns:
+                stats (dict): stage name -> dict of processed, errors, fps, mean_latency_ms,
+                              queue_depth and dropped for the queue the stage writes to
+        """
+        stats = dict()
+        for stage, queue in zip(self.stages, self.queues):
+            stats[stage.name] = stage.stats.as_dict()
+            stats[stage.name]['queue_depth'] = len(queue)
+            stats[stage.name]['dropped'] = queue.dropped
+        return stats
@@ -0,0 +1,433 @@
+""" Local HTTP service sharing one detector and recognizer between the processes of the box
+
+    Requests are served by asyncio over localhost TCP or a Unix socket, and queued for a
+    batcher that groups the requests arriving together into one batch. Batches are decoded,
+    detected and recognized on an executor, with a single recognize_batch call per batch.
+
+        POST /recognize     faces of an image, with the name and distance of each
+        POST /detect        faces of an image, without recognition
+        POST /enroll?name=  add a face image, resized for recognition, to the known faces
+        GET  /health        gallery size, pending and in flight requests
+
+    Images are sent encoded (JPEG, PNG, ...) or as raw uint8 pixels with Content-Type
+    application/octet-stream and ?width=&height=&channels= query parameters. A request whose
+    X-Deadline-Ms header, or the default deadline, passes before its result is ready gets
+    504, and requests arriving while max_pending requests are waiting get 503.
+"""
+import asyncio
+import contextlib
+import http
+import json
+import logging
+import os
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+from .face_detector import FaceDetector
+from .metrics import REGISTRY
+
+BATCH_SIZE = REGISTRY.histogram('pybell_service_batch_size', 'Requests processed per batch',
+                                buckets=(1, 2, 4, 8, 16, 32, 64))
+QUEUE_SECONDS = REGISTRY.histogram('pybell_service_queue_seconds', 'Seconds requests wait for their batch')
+
+MAX_HEADERS = 100
+
+
+class HTTPError(Exception):
+    """A request that cannot be served, answered with its status"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ReadWriteLock:
+    """ Lock held by any number of readers at once, or by a single writer
+
+        Waiting writers keep new readers out, so a steady stream of readers can not starve them.
+    """
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writing = False
+        self._waiting_writers = 0
+
+    @contextlib.contextmanager
+    def reading(self):
+        with self._cond:
+            self._cond.wait_for(lambda: not self._writing and not self._waiting_writers)
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def writing(self):
+        with self._cond:
+            self._waiting_writers += 1
+            self._cond.wait_for(lambda: not self._writing and self._readers == 0)
+            self._waiting_writers -= 1
+            self._writing = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writing = False
+                self._cond.notify_all()
+
+
+class Job:
+    """ A detection or recognition request waiting for its batch
+
+        Attributes:
+            body (bytes): encoded image or raw pixels
+            content_type (str): Content-Type of the body
+            query (dict): query parameters, the raw image shape
+            recognize (bool): also recognize the faces found
+            queued (float): event loop time the request was queued at
+            deadline (float): event loop time after which the result is not needed anymore
+            future (asyncio.Future): result of the request
+    """
+    def __init__(self, body, content_type, query, recognize, queued, deadline, future):
+        self.body = body
+        self.content_type = content_type
+        self.query = query
+        self.recognize = recognize
+        self.queued = queued
+        self.deadline = deadline
+        self.future = future
+
+
+class FaceService:
+    """ Detection and recognition requests of local clients, processed in micro-batches
+
+        Attributes:
+            recognizer (FaceRecognizer): recognizer shared by every request
+            detector: shared detector, e.g. a ParallelFaceDetector, or None for one
+                      FaceDetector per executor thread
+            profile (DetectionProfile): search parameters of the per thread detectors
+            workers (int): executor threads, i.e. batches processed at once
+            max_batch (int): maximum number of requests per batch
+            batch_window (float): seconds the batcher waits for more requests to join a batch
+            max_pending (int): requests waiting for a batch before new ones get 503
+            deadline (float): seconds a request may take when it does not set X-Deadline-Ms
+            max_body (int): largest request body in bytes
+    """
+    def __init__(self, recognizer, detector=None, profile=None, workers=None, max_batch=16, batch_window=0.002,
+                 max_pending=64, deadline=1.0, max_body=16*2**20):
+        self.recognizer = recognizer
+        self.detector = detector
+        self.profile = profile
+        self.workers = workers or os.cpu_count()
+        self.max_batch = max_batch
+        self.batch_window = batch_window
+        self.max_pending = max_pending
+        self.deadline = deadline
+        self.max_body = max_body
+        self.server = None
+        self.address = None
+
+        self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='face-service')
+        self._detectors = threading.local()
+        # Batches recognize concurrently as recognition only reads the gallery, enrollment
+        # changes it and waits for the recognitions in progress
+        self._gallery_lock = ReadWriteLock()
+        self._in_flight = 0
+        self._pending = None
+        self._slots = None
+        self._batcher = None
+
+    async def start(self, host='127.0.0.1', port=8080, unix_socket=None):
+        """ Start serving on localhost TCP, or on a Unix socket if given
+
+            Args:
+                (Optional) host (str): address to listen on
+                (Optional) port (int): TCP port, 0 for any free port
+                (Optional) unix_socket (str): path of a Unix socket to listen on instead
+
+            Returns:
+                server (asyncio.AbstractServer)
+        """
+        self._pending = asyncio.Queue(self.max_pending)
+        self._slots = asyncio.Semaphore(self.workers)
+        self._batcher = asyncio.ensure_future(self._batch_requests())
+
+        if unix_socket is not None:
+            # A socket file left by a previous run would make binding fail
+            if os.path.exists(unix_socket):
+                os.unlink(unix_socket)
+            self.server = await asyncio.start_unix_server(self._handle_connection, path=unix_socket)
+            self.address = unix_socket
+        else:
+            self.server = await asyncio.start_server(self._handle_connection, host, port)
+            self.address = self.server.sockets[0].getsockname()[:2]
+        return self.server
+
+    async def close(self):
+        """Stop accepting connections and wait for the batches in flight"""
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        if self._batcher is not None:
+            self._batcher.cancel()
+        self._executor.shutdown(wait=True)
+
+    def health(self):
+        return {'status': 'ok', 'gallery': len(self.recognizer.gallery),
+                'pending': self._pending.qsize() if self._pending is not None else 0,
+                'in_flight': self._in_flight}
+
+    async def _batch_requests(self):
+        """Group queued requests into batches and process them on the executor"""
+        loop = asyncio.get_running_loop()
+        while True:
+            jobs = [await self._pending.get()]
+            # Requests arriving within the window join the batch
+            if self.batch_window > 0 and self._pending.qsize() < self.max_batch - 1:
+                await asyncio.sleep(self.batch_window)
+            while len(jobs) < self.max_batch and not self._pending.empty():
+                jobs.append(self._pending.get_nowait())
+
+            # Waiting for an executor thread keeps the queue full, which is the backpressure
+            await self._slots.acquire()
+            now = loop.time()
+            batch = list()
+            for job in jobs:
+                if job.future.done():
+                    # The client gave up or its deadline passed in the handler
+                    continue
+                if job.deadline <= now:
+                    job.future.set_exception(HTTPError(504, "Deadline exceeded before processing"))
+                    continue
+                QUEUE_SECONDS.observe(now - job.queued)
+                batch.append(job)
+
+            if not batch:
+                self._slots.release()
+                continue
+
+            BATCH_SIZE.observe(len(batch))
+            self._in_flight += len(batch)
+            future = loop.run_in_executor(self._executor, self._process_batch, batch)
+            future.add_done_callback(lambda future, batch=batch: self._finish_batch(batch, future))
+
+    def _finish_batch(self, batch, future):
+        self._in_flight -= len(batch)
+        self._slots.release()
+        if future.cancelled():
+            return
+        error = future.exception()
+        results = future.result() if error is None else [error]*len(batch)
+        for job, result in zip(batch, results):
+            if job.future.done():
+                continue
+            if isinstance(result, Exception):
+                job.future.set_exception(result)
+            else:
+                job.future.set_result(result)
+
+    def _detector(self):
+        """Detector of the calling executor thread"""
+        if self.detector is not None:
+            return self.detector
+        detector = getattr(self._detectors, 'detector', None)
+        if detector is None:
+            detector = self._detectors.detector = FaceDetector(profile=self.profile)
+        return detector
+
+    def _process_batch(self, batch):
+        """ Decode and detect the images of a batch, then recognize all their faces at once
+
+            Returns:
+                results (List): result dict, or the exception to answer with, of every request
+        """
+        # cv2.resize takes (W, H)
+        face_shape = tuple(self.recognizer.img_shape[::-1])
+        detector = self._detector()
+
+        results, found, faces = list(), list(), list()
+        for i, job in enumerate(batch):
+            try:
+                image = decode_image(job.body, job.content_type, job.query)
+            except ValueError as e:
+                results.append(HTTPError(400, str(e)))
+                continue
+
+            _, bboxes, crops = detector.detectFaces(image)
+            results.append({'faces': [{'bbox': [int(v) for v in bbox]} for bbox in bboxes], 'batch_size': len(batch)})
+            if job.recognize:
+                found.extend(results[-1]['faces'])
+                faces.extend(cv2.resize(crop, face_shape) for crop in crops)
+
+        if faces:
+            with self._gallery_lock.reading():
+                names, distances = self.recognizer.recognize_batch(faces)
+            for face, name, distance in zip(found, names, distances):
+                # Faces without a known face to compare with have an infinite distance
+                face.update(name=name, distance=float(distance) if np.isfinite(distance) else None)
+        return results
+
+    def _enroll(self, name, body, content_type, query):
+        image = decode_image(body, content_type, query)
+        face = cv2.resize(image, tuple(self.recognizer.img_shape[::-1]))
+        with self._gallery_lock.writing():
+            self.recognizer.add_known_face(name, face)
+            return len(self.recognizer.gallery)
+
+    async def _dispatch(self, method, path, query, headers, body):
+        """ Answer a request
+
+            Returns:
+                status (int), response (dict), extra headers (dict)
+        """
+        loop = asyncio.get_running_loop()
+        if method == 'GET' and path == '/health':
+            return 200, self.health(), dict()
+
+        if method == 'POST' and path in ('/detect', '/recognize'):
+            try:
+                deadline = float(headers['x-deadline-ms'])/1000 if 'x-deadline-ms' in headers else self.deadline
+            except ValueError:
+                raise HTTPError(400, "X-Deadline-Ms must be a number")
+            now = loop.time()
+            job = Job(body, headers.get('content-type', ''), query, path == '/recognize', now, now + deadline,
+                      loop.create_future())
+            try:
+                self._pending.put_nowait(job)
+            except asyncio.QueueFull:
+                return 503, {'error': "Too many pending requests"}, {'Retry-After': '1'}
+
+            try:
+                result = await asyncio.wait_for(job.future, max(0, job.deadline - loop.time()))
+            except asyncio.TimeoutError:
+                raise HTTPError(504, "Deadline exceeded")
+            return 200, result, dict()
+
+        if method == 'POST' and path == '/enroll':
+            name = query.get('name')
+            if not name:
+                raise HTTPError(400, "Missing name query parameter")
+            try:
+                size = await loop.run_in_executor(self._executor, self._enroll, name, body,
+                                                  headers.get('content-type', ''), query)
+            except ValueError as e:
+                raise HTTPError(400, str(e))
+            return 200, {'name': name, 'gallery': size}, dict()
+
+        raise HTTPError(404, f"No {method} {path}")
+
+    async def _handle_connection(self, reader, writer):
+        """Serve the requests of a connection, kept alive until the client closes it"""
+        try:
+            while True:
+                keep_alive = False
+                try:
+                    request = await read_request(reader, self.max_body)
+                    if request is None:
+                        break
+                    method, path, query, headers, body = request
+                    keep_alive = headers.get('connection', '').lower() != 'close'
+                    status, response, extra = await self._dispatch(method, path, query, headers, body)
+                except HTTPError as e:
+                    status, response, extra = e.status, {'error': str(e)}, dict()
+                    # The rest of a malformed request cannot be told apart from the next one
+                    keep_alive = keep_alive and e.status not in (400, 413)
+                except Exception:
+                    logging.exception("Face service request failed")
+                    status, response, extra = 500, {'error': "Internal error"}, dict()
+
+                REGISTRY.counter('pybell_service_requests_total', 'Requests answered', status=str(status)).inc()
+                await write_response(writer, status, response, extra, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+
+def decode_image(body, content_type, query):
+    """ Grayscale image of a request body
+
+        Args:
+            body (bytes): encoded image, or raw uint8 pixels
+            content_type (str): application/octet-stream for raw pixels
+            query (dict): width, height and channels (default 1) of raw pixels
+
+        Returns:
+            image (np.array): uint8 grayscale image
+    """
+    if content_type.split(';')[0].strip() == 'application/octet-stream':
+        try:
+            height, width = int(query['height']), int(query['width'])
+            channels = int(query.get('channels', 1))
+        except (KeyError, ValueError):
+            raise ValueError("Raw pixels need integer width and height query parameters")
+        if channels not in (1, 3) or len(body) != width*height*channels:
+            raise ValueError(f"Body of {len(body)} bytes is not a {width}x{height}x{channels} image")
+        image = np.frombuffer(body, dtype=np.uint8).reshape((height, width, channels))
+        return image[:, :, 0] if channels == 1 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+
+    # Decode straight to grayscale, see load_image
+    image = cv2.imdecode(np.frombuffer(body, dtype=np.uint8), cv2.IMREAD_GRAYSCALE) if body else None
+    if image is None:
+        raise ValueError("Body is not an image")
+    return image
+
+
+async def read_request(reader, max_body):
+    """ Read an HTTP/1.1 request
+
+        Returns:
+            (method, path, query, headers, body), None if the connection was closed
+    """
+    line = await reader.readline()
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode('latin-1').split()
+    except ValueError:
+        raise HTTPError(400, "Malformed request line")
+
+    headers = dict()
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        if len(headers) >= MAX_HEADERS:
+            raise HTTPError(400, "Too many headers")
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    try:
+        length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise HTTPError(400, "Malformed Content-Length")
+    if length < 0:
+        raise HTTPError(400, "Negative Content-Length")
+    if length > max_body:
+        raise HTTPError(413, f"Body larger than {max_body} bytes")
+    body = await reader.readexactly(length) if length else b''
+
+    url = urllib.parse.urlsplit(target)
+    query = dict(urllib.parse.parse_qsl(url.query))
+    return method.upper(), url.path, query, headers, body
+
+
+async def write_response(writer, status, response, headers=None, keep_alive=True):
+    """Write a JSON response"""
+    body = json.dumps(response).encode()
+    lines = [f'HTTP/1.1 {status} {http.HTTPStatus(status).phrase}',
+             'Content-Type: application/json',
+             f'Content-Length: {len(body)}',
+             f"Connection: {'keep-alive' if keep_alive else 'close'}"]
+    lines += [f'{name}: {value}' for name, value in (headers or dict()).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body)
+    await writer.drain()
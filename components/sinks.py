@@ -0,0 +1,213 @@
+""" Outputs processed frames are written to: preview window, video file, JSON events or a callback
+
+    Labels are only drawn on frames when one of the sinks needs pixels, so headless outputs
+    such as JSON events add no drawing or GUI cost to the frame loop.
+"""
+import json
+import logging
+import os
+import queue
+import sys
+import threading
+
+import numpy as np
+import cv2
+
+from .util.detection import draw_detection_with_label
+
+
+class Sink:
+    """ Base of the outputs of the frame loop
+
+        Attributes:
+            needs_pixels (bool): whether write needs frames with the detections drawn on them
+    """
+    needs_pixels = False
+
+    def write(self, packet):
+        """Output a processed FramePacket, its image is annotated if needs_pixels"""
+
+    def poll(self):
+        """Handle pending events of the sink, returns False once the user asked to quit"""
+        return True
+
+    def close(self):
+        """Release the resources of the sink"""
+
+
+class NullSink(Sink):
+    """Discards every frame, e.g. to only export metrics"""
+
+
+class PreviewSink(Sink):
+    """Shows frames in one window per camera, pressing q quits"""
+    needs_pixels = True
+
+    def __init__(self, title='Face Detections'):
+        self.title = title
+
+    def write(self, packet):
+        window = self.title if packet.source is None else f'{self.title} [{packet.source}]'
+        cv2.imshow(window, packet.image)
+
+    def poll(self):
+        return cv2.waitKey(1) & 0xFF != ord('q')
+
+    def close(self):
+        cv2.destroyAllWindows()
+
+
+class VideoFileSink(Sink):
+    """ Encodes frames to a video file, one file per camera when there are several
+
+        Frames of a camera named source are written to path with -source inserted before
+        the extension, e.g. door-1.avi.
+    """
+    needs_pixels = True
+
+    def __init__(self, path, fps=15, fourcc='MJPG'):
+        self.path = path
+        self.fps = fps
+        self.fourcc = cv2.VideoWriter_fourcc(*fourcc)
+        self._writers = dict()
+
+    def write(self, packet):
+        image = packet.image
+        if image.ndim == 2:
+            image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+
+        writer = self._writers.get(packet.source)
+        if writer is None:
+            path = self.path_of(packet.source)
+            writer = cv2.VideoWriter(path, self.fourcc, self.fps, (image.shape[1], image.shape[0]))
+            assert writer.isOpened(), f"Could not open {path} for writing"
+            self._writers[packet.source] = writer
+        writer.write(image)
+
+    def path_of(self, source):
+        """File frames of a camera are written to"""
+        if source is None:
+            return self.path
+        root, ext = os.path.splitext(self.path)
+        name = os.path.basename(str(source)) if isinstance(source, str) else str(source)
+        return f'{root}-{name}{ext}'
+
+    def close(self):
+        for writer in self._writers.values():
+            writer.release()
+        self._writers = dict()
+
+
+class JsonEventSink(Sink):
+    """ Writes one JSON line per frame with faces, from a background thread
+
+        Events hold the frame id, source, capture timestamp and the bounding box, name,
+        distance and track id of every face. When the writer falls behind events are
+        dropped instead of blocking the frame loop.
+
+        Attributes:
+            dropped (int): number of events dropped
+    """
+    def __init__(self, stream=None, all_frames=False, queue_size=256):
+        """ Args:
+                stream: file object or path to write to, '-' or None for stdout
+                all_frames (bool): also write events of frames without faces
+                queue_size (int): events waiting to be written before new ones are dropped
+        """
+        self._owned = isinstance(stream, str) and stream != '-'
+        if self._owned:
+            stream = open(stream, 'a')
+        self.stream = sys.stdout if stream in (None, '-') else stream
+        self.all_frames = all_frames
+        self.dropped = 0
+        self._events = queue.Queue(maxsize=queue_size)
+        self._writer = threading.Thread(target=self._write_events, name='json-events', daemon=True)
+        self._writer.start()
+
+    def write(self, packet):
+        if len(packet.bboxes) == 0 and not self.all_frames:
+            return
+        try:
+            self._events.put_nowait(event_of(packet))
+        except queue.Full:
+            self.dropped += 1
+
+    def _write_events(self):
+        while True:
+            event = self._events.get()
+            if event is None:
+                break
+            self.stream.write(json.dumps(event) + '\n')
+            if self._events.empty():
+                self.stream.flush()
+
+    def close(self):
+        self._events.put(None)
+        self._writer.join()
+        if self._owned:
+            self.stream.close()
+
+
+class CallbackSink(Sink):
+    """ Calls callback(packet) with every processed frame
+
+        The callback runs in the frame loop, it should hand work off rather than block
+    """
+    def __init__(self, callback, needs_pixels=False):
+        self.callback = callback
+        self.needs_pixels = needs_pixels
+
+    def write(self, packet):
+        self.callback(packet)
+
+
+class SinkGroup:
+    """ Writes frames to several sinks, drawing the detections once if any of them needs pixels """
+    def __init__(self, sinks):
+        self.sinks = list(sinks)
+        self.needs_pixels = any(sink.needs_pixels for sink in self.sinks)
+
+    def write(self, packet):
+        if self.needs_pixels:
+            annotate(packet)
+        for sink in self.sinks:
+            try:
+                sink.write(packet)
+            except Exception:
+                logging.exception(f"{type(sink).__name__} failed to write frame {packet.frame_id}")
+
+    def poll(self):
+        """False once any sink asked to quit"""
+        # Every sink is polled, e.g. so preview windows keep refreshing
+        return all([sink.poll() for sink in self.sinks])
+
+    def close(self):
+        for sink in self.sinks:
+            sink.close()
+
+
+def annotate(packet):
+    """Draw the bounding box and name of every face on the image of a FramePacket"""
+    for bbox, name in zip(packet.bboxes, packet.names):
+        if name:
+            draw_detection_with_label(packet.image, bbox, name, known=True)
+        else:
+            draw_detection_with_label(packet.image, bbox, 'UNKNOWN', known=False)
+    return packet.image
+
+
+def event_of(packet):
+    """JSON serializable description of the faces of a FramePacket"""
+    n_faces = len(packet.bboxes)
+    names = list(packet.names) + [None]*(n_faces - len(packet.names))
+    # Faces without a known face to compare with have an infinite distance
+    distances = [float(d) if np.isfinite(d) else None for d in packet.distances]
+    distances += [None]*(n_faces - len(distances))
+    track_ids = list(packet.track_ids) + [None]*(n_faces - len(packet.track_ids))
+    return {
+        'frame_id': packet.frame_id,
+        'source': packet.source,
+        'timestamp': packet.timestamp,
+        'faces': [{'bbox': [int(v) for v in bbox], 'name': name, 'distance': distance, 'track_id': track_id}
+                  for bbox, name, distance, track_id in zip(packet.bboxes, names, distances, track_ids)],
+    }
@@ -0,0 +1,99 @@
+""" Cold start of the door unit: concurrent initialization, warm-up and startup timing """
+import collections
+import contextlib
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import cv2
+
+
+class StartupTimer:
+    """ Durations of the startup phases
+
+        Attributes:
+            start (float): time.perf_counter() startup is measured from, e.g. before the imports
+            phases (OrderedDict): seconds taken by every phase, in the order they were recorded
+    """
+    def __init__(self, start=None):
+        self.start = time.perf_counter() if start is None else start
+        self.phases = collections.OrderedDict()
+
+    @property
+    def elapsed(self):
+        """Seconds since start"""
+        return time.perf_counter() - self.start
+
+    def record(self, name, seconds):
+        self.phases[name] = seconds
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Record the duration of a with block as a phase"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def run_concurrently(self, **tasks):
+        """ Run initialization functions on threads, e.g. opening the camera while the model loads
+
+            Camera opening, cascade parsing and model reading mostly wait on devices and files or
+            run in OpenCV and numpy code releasing the GIL, so they overlap well on threads.
+
+            Args:
+                tasks: functions called without arguments, by phase name
+
+            Returns:
+                results (dict): result of every function, by phase name
+        """
+        def timed(func):
+            start = time.perf_counter()
+            result = func()
+            return result, time.perf_counter() - start
+
+        with self.phase('concurrent'), ThreadPoolExecutor(len(tasks), thread_name_prefix='startup') as executor:
+            futures = collections.OrderedDict((name, executor.submit(timed, func)) for name, func in tasks.items())
+            # Every task finishes before the first error is raised, so no thread outlives startup
+            outcomes = [(name, future.exception()) for name, future in futures.items()]
+
+        results = dict()
+        for name, error in outcomes:
+            if error is not None:
+                raise error
+            results[name], seconds = futures[name].result()
+            self.record(name, seconds)
+        return results
+
+    def report(self):
+        """One line summary of the startup time"""
+        phases = ', '.join(f'{name} {seconds:.3f}s' for name, seconds in self.phases.items())
+        return f"Started in {self.elapsed:.3f}s: {phases}"
+
+
+def warm_up(detector, recognizer, frame_shape=(480, 640), cameras=()):
+    """ Run a blank frame and a blank face through detection and recognition
+
+        The first call of each stage otherwise pays for lazy initialization on the first real
+        frame: OpenCV buffers and thread pool, detector processes, undistortion maps, BLAS and
+        the pages of the memory-mapped model and gallery.
+
+        Args:
+            detector: FaceDetector or ParallelFaceDetector, None to skip detection
+            recognizer (FaceRecognizer): recognizer to warm up
+            (Optional) frame_shape (tuple): (H, W) of the frames, the size reported by the first camera if known
+            (Optional) cameras (List): CameraStreams whose undistortion maps are prepared
+    """
+    for i, camera in enumerate(cameras):
+        width = int(camera.video_capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        height = int(camera.video_capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        if height > 0 and width > 0:
+            if i == 0:
+                frame_shape = (height, width)
+            if camera.undistort_fisheye:
+                camera.undistort_maps((height, width))
+
+    if detector is not None:
+        detector.detectFaces(np.zeros(frame_shape[:2], dtype=np.uint8))
+    recognizer.warm_up()
@@ -0,0 +1,229 @@
+""" Track-by-detection carrying face identities across frames """
+import numpy as np
+import cv2
+
+from .metrics import REGISTRY
+from .util.image import cvt_to_gray
+
+ACTIVE_TRACKS = REGISTRY.gauge('pybell_tracks', 'Faces being tracked')
+TRACK_RECOGNITIONS = REGISTRY.counter('pybell_track_recognitions_total', 'Recognitions run on tracked faces')
+
+
+class Track:
+    """ A face followed across frames
+
+        Attributes:
+            track_id (int): unique id of the track
+            bbox (tuple): (x, y, w, h) latest bounding box
+            face (np.array): latest detected face image, resized for recognition
+            name (str): smoothed identity of the track, None if unknown
+            distance (float): smoothed distance to the known face of that identity
+            scores (dict): name -> exponentially smoothed distance of every identity seen
+            hits (int): number of frames the face was detected in
+            missed (int): consecutive frames the face was not detected in
+            since_recognition (int): frames since recognition last ran on the track
+            template (np.array): gray face patch used by the template motion model
+    """
+    def __init__(self, track_id, bbox, face):
+        self.track_id = track_id
+        self.bbox = tuple(int(v) for v in bbox)
+        self.face = face
+        self.name = None
+        self.distance = np.inf
+        self.scores = dict()
+        self.hits = 1
+        self.missed = 0
+        self.since_recognition = None
+        self.template = None
+
+
+def iou(a, b):
+    """Intersection over union of two (x, y, w, h) boxes"""
+    x0, y0 = max(a[0], b[0]), max(a[1], b[1])
+    x1, y1 = min(a[0] + a[2], b[0] + b[2]), min(a[1] + a[3], b[1] + b[3])
+    intersection = max(0, x1 - x0)*max(0, y1 - y0)
+    union = a[2]*a[3] + b[2]*b[3] - intersection
+    return intersection/float(union) if union > 0 else 0.0
+
+
+class FaceTracker:
+    """ Associates detections with tracks so recognition runs once per person, not per frame
+
+        Detections are matched to tracks by greedy IoU association. Recognition only runs on
+        new tracks and then every recognize_every frames, and its distances are smoothed per
+        identity over the track, which both saves work and removes label flicker. Optionally
+        tracks are moved between frames with Lucas-Kanade optical flow ('flow') or template
+        matching ('template'), so they follow faces the detector missed in a frame.
+
+        Attributes:
+            recognizer (FaceRecognizer): recognizer used on new and stale tracks
+            iou_thresh (float): minimum IoU between a detection and a track to match them
+            max_missed (int): frames a track survives without detections
+            recognize_every (int): frames between recognitions of a track
+            smoothing (float): weight of a new distance in the exponential smoothing
+            motion (str): None, 'flow' or 'template' to predict track motion between frames
+            tracks (List): active tracks
+    """
+    def __init__(self, recognizer, iou_thresh=0.3, max_missed=10, recognize_every=15,
+                 smoothing=0.3, motion=None):
+        assert motion in (None, 'flow', 'template'), f"Unknown motion model: {motion}"
+        self.recognizer = recognizer
+        self.iou_thresh = iou_thresh
+        self.max_missed = max_missed
+        self.recognize_every = recognize_every
+        self.smoothing = smoothing
+        self.motion = motion
+        self.tracks = list()
+        self.recognitions = 0
+        self._next_id = 0
+        self._previous_gray = None
+
+    def reset_recognition(self):
+        """Recognize every track again on the next frame, e.g. after the known faces changed"""
+        for track in self.tracks:
+            track.since_recognition = None
+            track.scores = dict()
+
+    def update(self, img, bboxes, faces):
+        """ Update the tracks with the detections of a new frame
+
+            Args:
+                img (np.array): frame the detections come from, used by the motion model
+                bboxes (List): (x, y, w, h) detected face bounding boxes
+                faces (List): detected face images resized for recognition
+
+            Returns:
+                tracks (List): tracks visible in the frame, detected or predicted by the motion model
+        """
+        gray = cvt_to_gray(img) if self.motion else None
+        if self.motion and self._previous_gray is not None and self._previous_gray.shape == gray.shape:
+            for track in self.tracks:
+                self._predict(track, self._previous_gray, gray)
+
+        matches, new_detections = self._associate(bboxes)
+
+        for track in self.tracks:
+            track.missed += 1
+            if track.since_recognition is not None:
+                track.since_recognition += 1
+
+        for track, i in matches:
+            track.bbox = tuple(int(v) for v in bboxes[i])
+            track.face = faces[i]
+            track.hits += 1
+            track.missed = 0
+
+        for i in new_detections:
+            track = Track(self._next_id, bboxes[i], faces[i])
+            self._next_id += 1
+            track.missed = 0
+            self.tracks.append(track)
+
+        self.tracks = [t for t in self.tracks if t.missed <= self.max_missed]
+        ACTIVE_TRACKS.set(len(self.tracks))
+        self._recognize([t for t in self.tracks if t.missed == 0 and
+                         (t.since_recognition is None or t.since_recognition >= self.recognize_every)])
+
+        if self.motion:
+            self._previous_gray = gray
+            if self.motion == 'template':
+                for track in self.tracks:
+                    if track.missed == 0:
+                        x, y, w, h = track.bbox
+                        track.template = gray[y:y+h, x:x+w].copy()
+
+        # Without a motion model tracks that were not detected have a stale position
+        return [t for t in self.tracks if t.missed == 0 or self.motion]
+
+    def _associate(self, bboxes):
+        """ Greedily match detections to tracks by decreasing IoU
+
+            Returns:
+                matches (List): (track, detection index) pairs
+                new_detections (List): indices of unmatched detections
+        """
+        pairs = sorted(((iou(track.bbox, bbox), t, d) for t, track in enumerate(self.tracks)
+                        for d, bbox in enumerate(bboxes)), reverse=True)
+
+        used_tracks, used_detections, matches = set(), set(), list()
+        for overlap, t, d in pairs:
+            if overlap < self.iou_thresh:
+                break
+            if t in used_tracks or d in used_detections:
+                continue
+            used_tracks.add(t)
+            used_detections.add(d)
+            matches.append((self.tracks[t], d))
+
+        new_detections = [d for d in range(len(bboxes)) if d not in used_detections]
+        return matches, new_detections
+
+    def _recognize(self, tracks):
+        """Run batched recognition on tracks and smooth their per-identity distances"""
+        if not tracks:
+            return
+
+        # Track ids restart at every tracker, e.g. one per camera, so they are cached per tracker.
+        # A periodic recognition reuses the cached match only while the face still looks the same
+        names, distances = self.recognizer.nearest_batch([t.face for t in tracks],
+                                                         [(id(self), t.track_id) for t in tracks])
+        self.recognitions += len(tracks)
+        TRACK_RECOGNITIONS.inc(len(tracks))
+
+        for track, name, distance in zip(tracks, names, distances):
+            track.since_recognition = 0
+            previous = track.scores.get(name)
+            if previous is None or not np.isfinite(previous):
+                track.scores[name] = distance
+            else:
+                track.scores[name] = (1 - self.smoothing)*previous + self.smoothing*distance
+
+            best = min(track.scores, key=track.scores.get)
+            track.distance = track.scores[best]
+            track.name = best if track.distance <= self.recognizer.thresh else None
+
+    def _predict(self, track, previous_gray, gray):
+        """Move a track to where its face moved since the previous frame"""
+        x, y, w, h = track.bbox
+        height, width = gray.shape
+
+        if self.motion == 'flow':
+            points = cv2.goodFeaturesToTrack(previous_gray[y:y+h, x:x+w], maxCorners=30,
+                                             qualityLevel=0.01, minDistance=3)
+            if points is None:
+                return
+            points = (points + np.array([x, y], dtype=np.float32)).astype(np.float32)
+            moved, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, gray, points, None)
+            good = status.ravel() == 1
+            if np.count_nonzero(good) < 3:
+                return
+            dx, dy = np.median((moved - points)[good].reshape(-1, 2), axis=0)
+
+        elif self.motion == 'template' and track.template is not None:
+            # Search the face in a window twice its size around its previous position
+            x0, y0 = max(0, x - w//2), max(0, y - h//2)
+            x1, y1 = min(width, x + w + w//2), min(height, y + h + h//2)
+            window = gray[y0:y1, x0:x1]
+            if window.shape[0] < h or window.shape[1] < w:
+                return
+            response = cv2.matchTemplate(window, track.template, cv2.TM_CCOEFF_NORMED)
+            _, score, _, (best_x, best_y) = cv2.minMaxLoc(response)
+            if score < 0.5:
+                return
+            dx, dy = x0 + best_x - x, y0 + best_y - y
+
+        else:
+            return
+
+        new_x = int(np.clip(round(x + dx), 0, max(0, width - w)))
+        new_y = int(np.clip(round(y + dy), 0, max(0, height - h)))
+        track.bbox = (new_x, new_y, w, h)
+
+
+def apply_tracks(packet, tracks):
+    """Replace the detections of a FramePacket with the faces of the visible tracks"""
+    packet.bboxes = [t.bbox for t in tracks]
+    packet.faces = [t.face for t in tracks]
+    packet.names = [t.name for t in tracks]
+    packet.distances = np.array([t.distance for t in tracks])
+    packet.track_ids = [t.track_id for t in tracks]
@@ -1,57 +1,174 @@
+import logging
+import multiprocessing
+import os
 import pickle
+import re
 
 import numpy as np
 import cv2
 
 from .image import cvt_to_gray
 
-def calculate_calibration_coefficients(images, board_size = (7,7)):
-    """ Kind distortion coefficients K, D for fisheye camera model
+# Undistortion maps already computed, keyed by calibration and image size
+_undistort_maps = dict()
+
+# Largest side of the images chessboards are first searched in
+SEARCH_SIZE = 800
+
+def find_chessboard_corners(img, board_size=(7,7), downscale=None):
+    """ Find the inner corners of a chessboard with sub-pixel accuracy
+
+        The board is searched on a downscaled image, which is much faster, then the corners
+        are refined at full resolution. Boards too small to be found in the downscaled image
+        are searched again at full resolution
 
         Args:
-            images (List): List of images with Chessboard Calibration pattern
-            board_size (tuple): Chessboard Size
+            img (np.array): image of a chessboard calibration pattern
+            (Optional) board_size (tuple): number of inner corners per row and column
+            (Optional) downscale (float): scale of the image the board is first searched in,
+                                          None to search it at most SEARCH_SIZE pixels wide
 
         Returns:
-            K (3x3 np.ndarray): Calibration camera matrix
-            D (4x1 np.ndarray): distortion coefficients
+            corners ((N x 1 x 2) np.float32 array): corners in full resolution image coordinates,
+                                                    None if no board was found
+    """
+    img = cvt_to_gray(img)
+    if downscale is None:
+        downscale = min(1.0, SEARCH_SIZE/max(img.shape))
+
+    found = False
+    if downscale < 1:
+        small = cv2.resize(img, None, fx=downscale, fy=downscale, interpolation=cv2.INTER_AREA)
+        found, corners = cv2.findChessboardCorners(small, board_size)
+        if found:
+            # Pixel centers of the downscaled image do not fall on full resolution pixel centers
+            corners = ((corners + 0.5)/downscale - 0.5).astype(np.float32)
+
+    if not found:
+        downscale = 1.0
+        flags = cv2.CALIB_CB_ADAPTIVE_THRESH + cv2.CALIB_CB_NORMALIZE_IMAGE + cv2.CALIB_CB_FAST_CHECK
+        found, corners = cv2.findChessboardCorners(img, board_size, flags=flags)
+        if not found:
+            return None
 
+    # A window covering the uncertainty of the downscaled corners, smaller than a square
+    grid = corners.reshape(board_size[1], board_size[0], 2)
+    spacing = np.linalg.norm(np.diff(grid, axis=1), axis=2).min()
+    half_window = int(np.clip(min(spacing/2 - 1, 1/downscale + 3), 2, 11))
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.01)
+    cv2.cornerSubPix(img, corners, (half_window, half_window), (-1, -1), criteria)
+    return corners
+
+
+def _find_corners_in_file(task):
+    """Corners of the chessboard in an image file, run by the calibration pool"""
+    path, board_size, downscale = task
+    img = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+    if img is None:
+        return path, None, None
+    return path, img.shape, find_chessboard_corners(img, board_size, downscale)
+
+
+def _init_calibration_worker():
+    # One process per core already, OpenCV threads would only oversubscribe the cores
+    cv2.setNumThreads(1)
+
+
+def find_corners_in_files(paths, board_size=(7,7), downscale=None, processes=None):
+    """ Find chessboard corners in image files on a pool of processes
+
+        Args:
+            paths (List): image files
+            (Optional) board_size (tuple): number of inner corners per row and column
+            (Optional) downscale (float): see find_chessboard_corners
+            (Optional) processes (int): number of worker processes, all cores if None
+
+        Returns:
+            views (List): (path, corners) of the images a board was found in, in paths order
+            image_size (tuple): (width, height) of the images
     """
-    N_OK = 0
-    subpix_criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 30, 0.1)
-    # Read in image input
+    tasks = [(path, tuple(board_size), downscale) for path in paths]
+    with multiprocessing.Pool(processes, initializer=_init_calibration_worker) as pool:
+        results = pool.map(_find_corners_in_file, tasks, chunksize=max(1, len(tasks)//(4*(processes or os.cpu_count()))))
 
-    imgPoints = list()
-    for img in images:
+    image_size, views = None, list()
+    for path, shape, corners in results:
+        if shape is None:
+            logging.warning(f"Could not read calibration image {path}")
+            continue
+        size = (shape[1], shape[0])
+        assert image_size is None or size == image_size, f"{path} is {size}, other images are {image_size}"
+        image_size = size
+        if corners is not None:
+            views.append((path, corners))
+    return views, image_size
+
+
+def calibrate_fisheye(image_points, image_size, board_size=(7,7), square_size=1.0):
+    """ Fisheye calibration from the chessboard corners of every view
 
-        img = cvt_to_gray(img)
+        Views making the calibration ill-conditioned, e.g. boards seen almost edge-on, are
+        dropped and the calibration is repeated without them
+
+        Args:
+            image_points (List): (N x 1 x 2) chessboard corners of every view
+            image_size (tuple): (width, height) of the images
+            (Optional) board_size (tuple): number of inner corners per row and column
+            (Optional) square_size (float): side of a chessboard square, sets the unit of the extrinsics
 
-        # Find Chessboard Corners
-        retval, corners = cv2.findChessboardCorners(img, board_size)
+        Returns:
+            K (3x3 np.ndarray): Calibration camera matrix
+            D (1x4 np.ndarray): distortion coefficients
+            rms (float): root mean square reprojection error in pixels
+            used (List): indices of the views the calibration used
+    """
+    object_points = np.zeros((1, board_size[0]*board_size[1], 3), dtype=np.float64)
+    object_points[0, :, :2] = np.mgrid[0:board_size[0], 0:board_size[1]].T.reshape(-1, 2)*square_size
 
-        #Check if corners were found
-        if retval:
-            N_OK += 1
-            cv2.cornerSubPix(img, corners, winSize=(5,5), zeroZone=(-1,-1), criteria=subpix_criteria)
+    used = list(range(len(image_points)))
+    flags = cv2.fisheye.CALIB_RECOMPUTE_EXTRINSIC + cv2.fisheye.CALIB_CHECK_COND + cv2.fisheye.CALIB_FIX_SKEW
+    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 100, 1e-6)
+    while True:
+        assert len(used) >= 3, f"Only {len(used)} usable views, at least 3 are needed"
+        points = [np.asarray(image_points[i], dtype=np.float64).reshape(1, -1, 2) for i in used]
+        try:
+            rms, K, D, _, _ = cv2.fisheye.calibrate([object_points]*len(used), points, tuple(image_size),
+                                                    np.zeros((3, 3)), np.zeros((4, 1)), flags=flags, criteria=criteria)
+            return K, D.reshape(1, 4), rms, used
+        except cv2.error as e:
+            # The message names the view, e.g. "Ill-conditioned matrix for input array 12"
+            match = re.search(r'input array (\d+)', str(e))
+            if match is None:
+                raise
+            logging.info(f"Dropping ill-conditioned calibration view {used[int(match.group(1))]}")
+            del used[int(match.group(1))]
 
-            corners = np.transpose(corners, (1,0,2))
-            imgPoints.append(corners)
 
-    objPoints = np.zeros((1, board_size[0]*board_size[1], 3))
-    objPoints[0,:,:2] = np.mgrid[0:board_size[0],0:board_size[1]].T.reshape(-1,2)
+def calculate_calibration_coefficients(images, board_size=(7,7), downscale=None):
+    """ Kind distortion coefficients K, D for fisheye camera model
 
-    corners = corners[np.newaxis,:,:,:]
-    objPoints = objPoints[np.newaxis,:,:,:]
+        Args:
+            images (List): List of images with Chessboard Calibration pattern
+            board_size (tuple): Chessboard Size
+            (Optional) downscale (float): scale of the images the boards are searched in, see find_chessboard_corners
 
-    K = np.zeros((3,3))
-    D = np.zeros((1,4))
+        Returns:
+            K (3x3 np.ndarray): Calibration camera matrix
+            D (1x4 np.ndarray): distortion coefficients
 
-    cv2.fisheye.calibrate(objPoints, corners, img.shape, K, D)
+    """
+    image_points = list()
+    for img in images:
+        corners = find_chessboard_corners(img, board_size, downscale)
+        if corners is not None:
+            image_points.append(corners)
 
+    image_size = (images[0].shape[1], images[0].shape[0])
+    K, D, _, _ = calibrate_fisheye(image_points, image_size, board_size)
     return (K, D)
 
 
-def save_calibration_coefficients(K, D, file_path):
+def save_calibration_coefficients(K, D, file_path, **extra):
     """ Save calibration matrix, K, and distortion coefficients, D, to file as a dict
         {
             K: np.array,
@@ -60,12 +177,13 @@ def save_calibration_coefficients(K, D, file_path):
 
         Args:
             K (3x3 np.ndarray): Calibration camera matrix
-            D (4x1 np.ndarray): distortion coefficients
+            D (1x4 np.ndarray): distortion coefficients
             file_path (str): path to output file
+            extra: other values stored in the dict, e.g. the reprojection error
     """
-    calib_dict = {'K': K, 'D': D}
+    calib_dict = dict(extra, K=np.asarray(K), D=np.asarray(D).reshape(1, 4))
 
-    with open(filename, 'wb') as f:
+    with open(file_path, 'wb') as f:
         pickle.dump(calib_dict, f)
 
 
@@ -96,3 +214,122 @@ def load_calibration_coefficients(file_path):
     assert d_shape == (1, 4), f'Distortion coefficients is wrong shape {d_shape} != (1,4)'
 
     return calib
+
+
+def build_undistort_maps(K, D, image_size, new_K=None):
+    """ Compute fixed-point fisheye undistortion maps for cv2.remap
+
+        Applying these maps with cv2.remap gives the same result as cv2.fisheye.undistortImage,
+        which rebuilds them on every call
+
+        Args:
+            K (3x3 np.ndarray): Calibration camera matrix
+            D (4x1 np.ndarray): distortion coefficients
+            image_size (tuple): (width, height) of the images to undistort
+            new_K (3x3 np.ndarray): camera matrix of the undistorted image, None uses the
+                                    same default as cv2.fisheye.undistortImage
+
+        Returns:
+            map1 ((H x W x 2) np.int16 array): integer source coordinates
+            map2 ((H x W) np.uint16 array): interpolation table indices
+    """
+    return cv2.fisheye.initUndistortRectifyMap(K, D, np.eye(3), new_K, tuple(image_size), cv2.CV_16SC2)
+
+
+def get_undistort_maps(K, D, image_size, new_K=None, cache_file=None):
+    """ Return undistortion maps, computing them only once per calibration and image size
+
+        Maps are cached in memory, and on disk in cache_file if provided. A cache file
+        computed from a different calibration is recomputed.
+
+        Args:
+            K (3x3 np.ndarray): Calibration camera matrix
+            D (4x1 np.ndarray): distortion coefficients
+            image_size (tuple): (width, height) of the images to undistort
+            new_K (3x3 np.ndarray): camera matrix of the undistorted image, see build_undistort_maps
+            cache_file (str): optional .npz file to load the maps from or save them to
+
+        Returns:
+            map1, map2: see build_undistort_maps
+    """
+    new_K_key = None if new_K is None else np.asarray(new_K, dtype=np.float64).tobytes()
+    key = (np.asarray(K, dtype=np.float64).tobytes(), np.asarray(D, dtype=np.float64).tobytes(),
+           tuple(image_size), new_K_key)
+
+    if key in _undistort_maps:
+        return _undistort_maps[key]
+
+    maps = None
+    if cache_file and os.path.exists(cache_file):
+        maps = _load_undistort_maps(cache_file, K, D, image_size, new_K)
+
+    if maps is None:
+        maps = build_undistort_maps(K, D, image_size, new_K)
+        if cache_file:
+            save_undistort_maps(maps, K, D, image_size, cache_file, new_K)
+
+    _undistort_maps[key] = maps
+    return maps
+
+
+def undistort_maps_file(calibration_file, image_size):
+    """Path of the undistortion maps cache stored next to a calibration file"""
+    root, _ = os.path.splitext(calibration_file)
+    return f'{root}.maps_{image_size[0]}x{image_size[1]}.npz'
+
+
+def save_undistort_maps(maps, K, D, image_size, file_path, new_K=None):
+    """Save undistortion maps along with the calibration they were computed from"""
+    map1, map2 = maps
+    new_K = np.zeros((0, 0)) if new_K is None else new_K
+    np.savez(file_path, map1=map1, map2=map2, K=K, D=D, image_size=image_size, new_K=new_K)
+
+
+def _load_undistort_maps(file_path, K, D, image_size, new_K=None):
+    """Load undistortion maps, None if they were computed from another calibration"""
+    with np.load(file_path) as cached:
+        cached_new_K = cached['new_K'] if cached['new_K'].size else None
+
+        same_new_K = (new_K is None and cached_new_K is None) or \
+                     (new_K is not None and cached_new_K is not None and np.allclose(cached_new_K, new_K))
+        if not (same_new_K and np.allclose(cached['K'], K) and np.allclose(cached['D'], D) and
+                tuple(cached['image_size']) == tuple(image_size)):
+            return None
+
+        return cached['map1'], cached['map2']
+
+
+def undistort_roi(img, bbox, maps, K, D, new_K=None):
+    """ Undistort only the region of a distorted image around a bounding box
+
+        Args:
+            img (np.array): distorted image
+            bbox (tuple): (x, y, w, h) bounding box in distorted image coordinates
+            maps (tuple): undistortion maps of the full image, see build_undistort_maps
+            K (3x3 np.ndarray): Calibration camera matrix
+            D (4x1 np.ndarray): distortion coefficients
+            new_K (3x3 np.ndarray): camera matrix the maps were computed with
+
+        Returns:
+            roi (np.array): undistorted region enclosing the bounding box
+    """
+    map1, map2 = maps
+    x, y, w, h = bbox
+
+    # Map points along the bbox border to the undistorted image
+    t = np.linspace(0, 1, 8)
+    border = np.concatenate([
+        np.stack([x + t*w, np.full_like(t, y)], axis=1),
+        np.stack([x + t*w, np.full_like(t, y + h)], axis=1),
+        np.stack([np.full_like(t, x), y + t*h], axis=1),
+        np.stack([np.full_like(t, x + w), y + t*h], axis=1),
+    ]).reshape(-1, 1, 2)
+    undistorted = cv2.fisheye.undistortPoints(border, K, D, P=new_K).reshape(-1, 2)
+
+    # Clip the undistorted bbox to the maps
+    map_h, map_w = map2.shape
+    x0, y0 = np.clip(np.floor(undistorted.min(axis=0)).astype(int), 0, [map_w - 1, map_h - 1])
+    x1, y1 = np.clip(np.ceil(undistorted.max(axis=0)).astype(int) + 1, [x0 + 1, y0 + 1], [map_w, map_h])
+
+    return cv2.remap(img, map1[y0:y1, x0:x1], map2[y0:y1, x0:x1], cv2.INTER_LINEAR,
+                     borderMode=cv2.BORDER_CONSTANT)
@@ -0,0 +1,213 @@
+""" Packed face datasets: a folder of face images decoded once into a memory-mapped array
+
+    A dataset is a directory holding faces.npy, an (N x H x W) uint8 array, and manifest.json
+    listing the source image of every row with its modification time and size. Opening a
+    dataset maps the array without reading it, and repacking only decodes new or changed images.
+"""
+import json
+import logging
+import os
+import time
+
+import numpy as np
+
+from .image import list_images, load_image, load_images_into
+
+FACES_FILE = 'faces.npy'
+MANIFEST_FILE = 'manifest.json'
+DATASET_VERSION = 1
+
+
+class FaceDataset:
+    """ Faces of a packed dataset
+
+        Attributes:
+            faces ((N x H x W) np.memmap): read-only uint8 face images
+            paths (List): source image of every face, relative to folder
+            folder (str): folder the faces were packed from
+    """
+    def __init__(self, faces, paths, folder):
+        self.faces = faces
+        self.paths = paths
+        self.folder = folder
+
+    @property
+    def shape(self):
+        """(H, W) of the faces"""
+        return self.faces.shape[1:]
+
+    def __len__(self):
+        return len(self.faces)
+
+    def batches(self, batch_size, max_number=None):
+        """ Iterate over the faces in batches, without copying them
+
+            Args:
+                batch_size (int): number of faces per batch
+                (Optional) max_number (int): maximum number of faces
+
+            Yields:
+                faces ((n x H x W) np.memmap): views of at most batch_size faces
+        """
+        count = min(len(self), max_number) if max_number else len(self)
+        for i in range(0, count, batch_size):
+            yield self.faces[i:min(i + batch_size, count)]
+
+
+def open_faces(dataset_dir):
+    """ Open a packed dataset, mapping the faces instead of reading them
+
+        Args:
+            dataset_dir (str): directory written by pack_faces
+
+        Returns:
+            dataset (FaceDataset)
+    """
+    manifest = _load_manifest(dataset_dir)
+    assert manifest is not None, f"No packed dataset found in {dataset_dir}"
+
+    faces = np.load(os.path.join(dataset_dir, FACES_FILE), mmap_mode='r')
+    assert len(faces) == len(manifest['files']), f"Manifest of {dataset_dir} does not match its faces"
+
+    return FaceDataset(faces, [entry['path'] for entry in manifest['files']], manifest['folder'])
+
+
+def pack_faces(image_folder, dataset_dir, shape=None, max_number=None, workers=None, batch_size=4096,
+               progress=None):
+    """ Decode a folder of face images into a packed dataset
+
+        Images already packed with the same modification time and size are copied from the
+        previous dataset instead of being decoded again. The new dataset replaces the previous
+        one only once it is complete.
+
+        Args:
+            image_folder (str): folder holding face images
+            dataset_dir (str): directory to write the dataset to
+            (Optional) shape (int, int): height and width faces are resized and cropped to, the
+                                         shape of the previous dataset or of the first image if None
+            (Optional) max_number (int): maximum number of images to pack
+            (Optional) workers (int): number of decoding threads
+            (Optional) batch_size (int): number of images decoded at a time
+            (Optional) progress (callable): called with the number of faces packed so far
+
+        Returns:
+            stats (dict): number of faces packed, reused from the previous dataset, decoded,
+                          removed since the previous dataset and unreadable images
+    """
+    paths = list_images(image_folder, max_number)
+    assert paths, f"No images found in {image_folder}"
+    os.makedirs(dataset_dir, exist_ok=True)
+
+    previous = _load_manifest(dataset_dir)
+    if shape is None:
+        shape = tuple(previous['shape']) if previous else _first_shape(paths)
+    shape = tuple(shape)
+
+    # Rows of the previous dataset that are still valid, by relative path
+    reusable, previous_faces = dict(), None
+    if previous and tuple(previous['shape']) == shape:
+        previous_faces = np.load(os.path.join(dataset_dir, FACES_FILE), mmap_mode='r')
+        reusable = {entry['path']: (row, entry) for row, entry in enumerate(previous['files'])}
+
+    entries = list()
+    for path in paths:
+        stat = os.stat(path)
+        entries.append({'path': os.path.relpath(path, image_folder), 'mtime': stat.st_mtime, 'size': stat.st_size})
+
+    reused_rows, decoded_rows = list(), list()
+    for row, entry in enumerate(entries):
+        old = reusable.get(entry['path'])
+        if old is not None and old[1]['mtime'] == entry['mtime'] and old[1]['size'] == entry['size']:
+            reused_rows.append((row, old[0]))
+        else:
+            decoded_rows.append(row)
+
+    tmp_file = os.path.join(dataset_dir, FACES_FILE + '.tmp')
+    faces = np.lib.format.open_memmap(tmp_file, mode='w+', dtype=np.uint8, shape=(len(paths),) + shape)
+    read = np.ones(len(paths), dtype=bool)
+    done = 0
+
+    for i in range(0, len(reused_rows), batch_size):
+        rows, old_rows = zip(*reused_rows[i:i+batch_size])
+        faces[list(rows)] = previous_faces[list(old_rows)]
+        done += len(rows)
+        if progress is not None:
+            progress(done)
+
+    batch = np.empty((batch_size,) + shape, dtype=np.uint8)
+    for i in range(0, len(decoded_rows), batch_size):
+        rows = decoded_rows[i:i+batch_size]
+        read[rows] = load_images_into([paths[row] for row in rows], batch[:len(rows)], workers)
+        faces[rows] = batch[:len(rows)]
+        done += len(rows)
+        if progress is not None:
+            progress(done)
+
+    for row in np.flatnonzero(~read):
+        logging.warning(f"Could not read image {paths[row]}, it is not packed")
+
+    faces.flush()
+    if not read.all():
+        _compact(faces, read, tmp_file, batch_size)
+    del faces, previous_faces
+
+    manifest = {
+        'version': DATASET_VERSION,
+        'folder': os.path.abspath(image_folder),
+        'shape': list(shape),
+        'packed': time.time(),
+        'files': [entry for entry, ok in zip(entries, read) if ok],
+    }
+    manifest_file = os.path.join(dataset_dir, MANIFEST_FILE)
+    with open(manifest_file + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+
+    # Replace the dataset only once the new one is complete. Without a manifest the next
+    # pack starts over, so an interruption never pairs faces with the wrong manifest
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    os.replace(tmp_file, os.path.join(dataset_dir, FACES_FILE))
+    os.replace(manifest_file + '.tmp', manifest_file)
+
+    return {
+        'faces': int(read.sum()),
+        'reused': len(reused_rows),
+        'decoded': int(read[decoded_rows].sum()),
+        'removed': len(set(reusable) - set(entry['path'] for entry in entries)),
+        'unreadable': int((~read).sum()),
+    }
+
+
+def _load_manifest(dataset_dir):
+    path = os.path.join(dataset_dir, MANIFEST_FILE)
+    if not os.path.isfile(path) or not os.path.isfile(os.path.join(dataset_dir, FACES_FILE)):
+        return None
+
+    with open(path) as f:
+        manifest = json.load(f)
+    assert manifest.get('version') == DATASET_VERSION, f"Unsupported dataset version in {path}"
+    return manifest
+
+
+def _first_shape(paths):
+    for path in paths:
+        image = load_image(path)
+        if image is not None:
+            return image.shape
+    raise FileNotFoundError(f"None of the {len(paths)} images could be read")
+
+
+def _compact(faces, keep, tmp_file, batch_size):
+    """Rewrite a packed array without the rows of unreadable images"""
+    kept = np.flatnonzero(keep)
+    assert len(kept) > 0, "None of the images could be read"
+
+    compact_file = tmp_file + '.compact'
+    compact = np.lib.format.open_memmap(compact_file, mode='w+', dtype=np.uint8,
+                                        shape=(len(kept),) + faces.shape[1:])
+    for i in range(0, len(kept), batch_size):
+        compact[i:i+batch_size] = faces[kept[i:i+batch_size]]
+
+    compact.flush()
+    del compact
+    os.replace(compact_file, tmp_file)
@@ -1,5 +1,6 @@
 """ Utility functions for """
 import cv2
+import numpy as np
 
 def draw_detection_with_label(img, bbox, label, known, font=cv2.FONT_HERSHEY_SIMPLEX, fontScale=0.5, fontThickness=1):
     """ Draw bounding box and label around detection in an image
@@ -31,3 +32,65 @@ def draw_detection_with_label(img, bbox, label, known, font=cv2.FONT_HERSHEY_SIM
     cv2.putText(img, label, (x, y-1), font, fontScale, (0,0,0), fontThickness, cv2.LINE_AA)
 
     return img
+
+
+def non_max_suppression(bboxes, iou_thresh=0.3):
+    """ Merge duplicate detections, e.g. of a face found in two overlapping tiles
+
+        Haar cascades do not score detections, so larger boxes are kept over the
+        smaller boxes overlapping them
+
+        Args:
+            bboxes (N x 4 np.array): (x, y, w, h) bounding boxes
+            iou_thresh (float): boxes overlapping a kept box by more are suppressed
+
+        Returns:
+            kept (M x 4 np.array): bounding boxes left after suppression
+    """
+    bboxes = np.asarray(bboxes, dtype=np.int32).reshape(-1, 4)
+    if len(bboxes) < 2:
+        return bboxes
+
+    x0, y0 = bboxes[:, 0], bboxes[:, 1]
+    x1, y1 = x0 + bboxes[:, 2], y0 + bboxes[:, 3]
+    areas = bboxes[:, 2].astype(np.int64)*bboxes[:, 3]
+    order = np.argsort(-areas, kind='stable')
+
+    keep = list()
+    while len(order) > 0:
+        i, rest = order[0], order[1:]
+        keep.append(i)
+        w = np.maximum(0, np.minimum(x1[i], x1[rest]) - np.maximum(x0[i], x0[rest]))
+        h = np.maximum(0, np.minimum(y1[i], y1[rest]) - np.maximum(y0[i], y0[rest]))
+        intersection = w*h
+        overlap = intersection/(areas[i] + areas[rest] - intersection).astype(np.float64)
+        order = rest[overlap <= iou_thresh]
+
+    return bboxes[np.sort(keep)]
+
+
+def tile_regions(shape, tiles=(2, 2), overlap=0):
+    """ Split an image into a grid of overlapping tiles
+
+        A face is only found in a tile if it fits in it entirely, so overlap should be at
+        least the largest face searched
+
+        Args:
+            shape (tuple): (H, W) of the image
+            tiles (tuple): number of (rows, columns) of tiles
+            overlap (int): pixels shared by neighbouring tiles
+
+        Returns:
+            regions (List): (x, y, w, h) tiles covering the image
+    """
+    height, width = shape[:2]
+    rows, cols = tiles
+    regions = list()
+    for r in range(rows):
+        y0 = max(0, r*height//rows - overlap//2)
+        y1 = min(height, (r + 1)*height//rows + overlap - overlap//2)
+        for c in range(cols):
+            x0 = max(0, c*width//cols - overlap//2)
+            x1 = min(width, (c + 1)*width//cols + overlap - overlap//2)
+            regions.append((x0, y0, x1 - x0, y1 - y0))
+    return regions
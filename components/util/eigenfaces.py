@@ -1,9 +1,9 @@
 import pickle
-import math
 
-import cv2
 import numpy as np
-from sklearn.decomposition import PCA
+
+# Runtime functions, re-exported for the training scripts
+from .projection import PRECISIONS, quantize_rows, project_quantized, project, distance_matrix, pairwise_distance_matrix
 
 def pca(X, nb_components):
     """ Find principal components of a matrix X using SVD
@@ -27,7 +27,8 @@ def pca(X, nb_components):
 
     centered_X = X - mean_X
 
-    u, s, vh = np.linalg.svd(centered_X)
+    # Only the first min(N, H*W) singular vectors exist, the full U matrix is never needed
+    u, s, vh = np.linalg.svd(centered_X, full_matrices=False)
     principal_components = vh[:nb_components]
     return principal_components, mean_X
 
@@ -47,6 +48,8 @@ def extract_facespace(face_imgs, components, project=False):
             (Optional) projections ((N x components) np.array) Projections of face_imgs
                 onto face_space if project is True
     """
+    from sklearn.decomposition import PCA
+
     n_faces, H, W = face_imgs.shape
 
     # Flatten Images to feature vector
@@ -67,18 +70,132 @@ def extract_facespace(face_imgs, components, project=False):
 
     return facespace, mean_face
 
-def project(facespace, x):
-    """ Project vector on to basis
+STREAMING_METHODS = ('covariance', 'randomized', 'incremental')
+
+
+def extract_facespace_streaming(batches, components, method='covariance', progress=None):
+    """ Create basis for facespace from batches of faces, never holding the whole train set in memory
+
+        'covariance' accumulates the sum of the faces and of their outer products in a single
+        pass and keeps the top eigenvectors of the resulting covariance matrix. This is the
+        exact PCA and needs (H*W)^2 floats whatever the number of faces. 'randomized' finds
+        the top eigenvectors of the same matrix by randomized SVD, much faster than the full
+        eigendecomposition and accurate for the quickly decaying spectrum of faces.
+        'incremental' fits sklearn's IncrementalPCA batch by batch, memory only depends on
+        the batch size.
+
+        Args:
+            batches (iterable): (n x H x W) arrays of grayscale face images
+            components (int): number of principal components to keep
+            (Optional) method (str): 'covariance', 'randomized' or 'incremental'
+            (Optional) progress (callable): called with the number of faces processed after every batch
+
+        Returns:
+            face_space ((components x H*W) np.array): Basis of face space to be used
+                    for projection
+            mean_face: ((H*W x 1) np.array): Mean face of face images
+    """
+    assert method in STREAMING_METHODS, f"Unknown streaming PCA method: {method}"
+    if method == 'incremental':
+        fit = _StreamingIncrementalPCA(components)
+    else:
+        fit = _StreamingCovariance(components, randomized=method == 'randomized')
+
+    n_faces = 0
+    for batch in batches:
+        fit.partial_fit(batch.reshape((len(batch), -1)))
+        n_faces += len(batch)
+        if progress is not None:
+            progress(n_faces)
+
+    assert n_faces >= components, f"At least {components} faces are needed, got {n_faces}"
+    return fit.result()
+
+
+def streaming_batch_size(n_features, components, method='covariance', memory_mb=1024):
+    """ Largest batch of faces keeping extract_facespace_streaming within a memory budget
 
         Args:
-            facespace ((N x H*W) np.array): Matrix representing basis
-            x (H*W np.array): vector to project
+            n_features (int): number of pixels of a face
+            components (int): number of principal components to keep
+            method (str): 'covariance', 'randomized' or 'incremental'
+            memory_mb (float): memory budget in megabytes
 
         Returns:
-            projection (N dim np.array): projection of x onto face_space
+            batch_size (int): number of faces per batch
     """
-    projection = np.matmul(facespace, x)
-    return projection
+    budget = memory_mb*2**20
+    if method != 'incremental':
+        # Scatter matrix, and covariance and eigenvectors for the final decomposition
+        fixed = 3*n_features**2*8
+    else:
+        # Components, and the components stacked on top of each batch by IncrementalPCA
+        fixed = 3*components*n_features*8
+    # A float64 copy of the batch and its centered copy
+    per_face = 2*n_features*8
+
+    batch_size = int((budget - fixed)//per_face)
+    assert batch_size >= components, f"A memory budget of {memory_mb} MB is too small for {method} PCA"
+    return batch_size
+
+
+class _StreamingCovariance:
+    """Exact PCA from the scatter matrix of the faces, accumulated batch by batch"""
+    def __init__(self, components, randomized=False):
+        self.components = components
+        self.randomized = randomized
+        self.n = 0
+        self.shift = None
+        self.sum = None
+        self.scatter = None
+
+    def partial_fit(self, X):
+        X = X.astype(np.float64)
+        if self.shift is None:
+            # Centering on an estimate of the mean avoids cancellation in the final subtraction
+            self.shift = X.mean(axis=0)
+            self.sum = np.zeros_like(self.shift)
+            self.scatter = np.zeros((X.shape[1], X.shape[1]))
+
+        X -= self.shift
+        self.n += len(X)
+        self.sum += X.sum(axis=0)
+        self.scatter += np.matmul(X.T, X)
+
+    def result(self):
+        mean = self.sum/self.n
+        covariance = self.scatter/self.n - np.outer(mean, mean)
+        if self.randomized:
+            from sklearn.utils.extmath import randomized_svd
+
+            # The covariance is symmetric positive semi-definite, its SVD is its eigendecomposition
+            _, _, eigenvectors = randomized_svd(covariance, self.components, n_iter=7, random_state=0)
+            return eigenvectors, mean + self.shift
+
+        eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+        order = np.argsort(eigenvalues)[::-1][:self.components]
+        return eigenvectors[:, order].T, mean + self.shift
+
+
+class _StreamingIncrementalPCA:
+    """sklearn IncrementalPCA, holding back faces so that every partial fit has enough of them"""
+    def __init__(self, components):
+        from sklearn.decomposition import IncrementalPCA
+
+        self.components = components
+        self.pca = IncrementalPCA(n_components=components)
+        self.held = None
+
+    def partial_fit(self, X):
+        self.held = X if self.held is None else np.concatenate([self.held, X])
+        # Keep the last faces back, the final partial fit must have at least components faces
+        if len(self.held) >= 2*self.components:
+            self.pca.partial_fit(self.held[:-self.components])
+            self.held = self.held[-self.components:]
+
+    def result(self):
+        self.pca.partial_fit(self.held)
+        return self.pca.components_, self.pca.mean_
 
 
 def save_facespace_dict(facespace, mean_face, output_file):
@@ -98,10 +215,3 @@ def load_facespace_dict(input_file):
     assert 'mean_face' in facespace_dict, f'mean_face not stored in {input_file}'
 
     return facespace_dict
-
-
-def distance_matrix(vec, vecs):
-    """Calculate distance between a vector and all other vectors"""
-
-    result = np.sqrt(np.sum((vecs - vec)**2, axis=1))
-    return result
@@ -0,0 +1,124 @@
+""" Compact storage of the known-face gallery """
+import numpy as np
+
+
+def grow_capacity(array, required):
+    """ Return array with at least required rows, doubling its capacity when it is too small
+
+        Doubling keeps the total copying done by n appends linear in n
+
+        Args:
+            array (np.array): array whose first dimension is the capacity
+            required (int): number of rows needed
+
+        Returns:
+            array (np.array): array itself if large enough, else a larger copy
+    """
+    capacity = len(array)
+    if required <= capacity:
+        return array
+
+    new_capacity = max(required, 2*capacity, 16)
+    grown = np.empty((new_capacity,) + array.shape[1:], dtype=array.dtype)
+    grown[:capacity] = array
+    return grown
+
+
+class FaceGallery:
+    """ Projections of known faces stored in a preallocated array
+
+        Face ids are row numbers of the array and never change, removed faces are
+        tombstoned rather than deleted so that ids held by indexes stay valid.
+
+        Attributes:
+            dim (int): dimension of the face projections
+            dtype (np.dtype): storage type of the projections
+            size (int): number of rows in use, including removed faces
+    """
+    def __init__(self, dim, capacity=64, dtype=np.float32):
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.size = 0
+        self._vectors = np.empty((capacity, dim), dtype=self.dtype)
+        self._labels = np.empty(capacity, dtype=np.int32)
+        self._alive = np.zeros(capacity, dtype=bool)
+        # Unique names, faces store the position of their name in this table
+        self._label_names = list()
+        self._name2label = dict()
+
+    def __len__(self):
+        """Number of faces that have not been removed"""
+        return int(np.count_nonzero(self._alive[:self.size]))
+
+    @property
+    def capacity(self):
+        return len(self._vectors)
+
+    @property
+    def vectors(self):
+        """((size x dim) np.array) view of the stored projections, including removed faces"""
+        return self._vectors[:self.size]
+
+    @property
+    def alive(self):
+        """(size np.array) boolean mask of faces that have not been removed"""
+        return self._alive[:self.size]
+
+    @property
+    def names(self):
+        """(size np.array) name of every stored face"""
+        return np.array(self._label_names, dtype=object)[self._labels[:self.size]]
+
+    def name(self, face_id):
+        """Return the name of the face with id face_id"""
+        return self._label_names[self._labels[face_id]]
+
+    def add(self, names, vectors):
+        """ Append faces to the gallery
+
+            Args:
+                names (List): name of every face
+                vectors ((N x dim) np.array): projections of the faces
+
+            Returns:
+                ids (N np.array): ids of the added faces
+        """
+        vectors = np.atleast_2d(vectors)
+        n_faces = len(vectors)
+        assert len(names) == n_faces, f"Got {len(names)} names for {n_faces} faces"
+        assert vectors.shape[1] == self.dim, f"Face dimension {vectors.shape[1]} != {self.dim}"
+
+        start, end = self.size, self.size + n_faces
+        self._vectors = grow_capacity(self._vectors, end)
+        self._labels = grow_capacity(self._labels, end)
+        self._alive = grow_capacity(self._alive, end)
+
+        self._vectors[start:end] = vectors
+        self._labels[start:end] = [self._label(name) for name in names]
+        self._alive[start:end] = True
+        self.size = end
+
+        return np.arange(start, end)
+
+    def _label(self, name):
+        """Return the label of a name, adding it to the name table if new"""
+        label = self._name2label.get(name)
+        if label is None:
+            label = len(self._label_names)
+            self._name2label[name] = label
+            self._label_names.append(name)
+        return label
+
+    def remove(self, name):
+        """ Tombstone every face of a person
+
+            Returns:
+                ids (np.array): ids of the removed faces
+        """
+        label = self._name2label.get(name)
+        if label is None:
+            return np.empty(0, dtype=np.int64)
+
+        ids = np.flatnonzero((self._labels[:self.size] == label) & self._alive[:self.size])
+        self._alive[ids] = False
+        return ids
@@ -0,0 +1,576 @@
+""" Nearest neighbour indexes over the projections of known faces
+
+    Every index stores (id, vector) pairs where id is the position of the face in the
+    recognizer's gallery, and supports incremental inserts, k-nearest neighbour and
+    radius queries. Distances returned are always euclidean distances.
+
+    Available indexes:
+        brute: exact brute force scan using a single matrix multiplication
+        kdtree / balltree: exact tree search (sklearn.neighbors), inserts are buffered
+                           and the tree is rebuilt once the buffer grows too large
+        ivfpq: approximate inverted file index with product quantized residuals
+"""
+import numpy as np
+
+from .gallery import grow_capacity
+from .projection import pairwise_distance_matrix
+
+
+def _empty_result(n_queries, k):
+    """Distances and ids returned when there is nothing to search"""
+    return np.full((n_queries, k), np.inf), np.full((n_queries, k), -1, dtype=np.int64)
+
+
+def _k_smallest(dist, ids, k):
+    """ Select the k smallest distances of every row of dist
+
+        Args:
+            dist ((N x M) np.array): distances between queries and candidates
+            ids (M np.array): id of each candidate
+            k (int): number of neighbours to keep
+
+        Returns:
+            distances ((N x k) np.array): sorted distances, inf padded
+            ids ((N x k) np.array): ids of the neighbours, -1 padded
+    """
+    n_queries, n_candidates = dist.shape
+    if n_candidates == 0:
+        return _empty_result(n_queries, k)
+
+    kk = min(k, n_candidates)
+    if kk < n_candidates:
+        part = np.argpartition(dist, kk - 1, axis=1)[:, :kk]
+    else:
+        part = np.tile(np.arange(n_candidates), (n_queries, 1))
+
+    part_dist = np.take_along_axis(dist, part, axis=1)
+    order = np.argsort(part_dist, axis=1)
+    part = np.take_along_axis(part, order, axis=1)
+
+    distances = np.take_along_axis(part_dist, order, axis=1)
+    neighbours = ids[part]
+    # Masked candidates have an infinite distance
+    neighbours[np.isinf(distances)] = -1
+    return _pad_results(distances, neighbours, k)
+
+
+def _pad_results(dist, ids, k):
+    """Pad sorted (N x kk) results with missing neighbours up to k columns"""
+    n_queries, kk = dist.shape
+    if kk == k:
+        return dist, ids
+
+    distances, neighbours = _empty_result(n_queries, k)
+    distances[:, :kk] = dist
+    neighbours[:, :kk] = ids
+    return distances, neighbours
+
+
+def _merge_results(results, k):
+    """Merge several (distances, ids) search results keeping the k nearest neighbours"""
+    dist = np.hstack([d for d, _ in results])
+    ids = np.hstack([i for _, i in results])
+    order = np.argsort(dist, axis=1)[:, :k]
+    return np.take_along_axis(dist, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def _radius_filter(dist, ids, radius):
+    """ Convert a (N x M) distance matrix to per query lists of neighbours within radius
+
+        Returns:
+            matches (List): for every query a tuple (ids, distances) sorted by distance
+    """
+    matches = list()
+    for row in dist:
+        within = np.flatnonzero(row <= radius)
+        order = np.argsort(row[within])
+        matches.append((ids[within[order]], row[within[order]]))
+    return matches
+
+
+class BruteForceIndex:
+    """ Exact nearest neighbour search by comparing queries to every stored vector
+
+        Vectors are stored in a preallocated array whose capacity doubles when full,
+        removed vectors are masked out of the results. Given a FaceGallery, the index
+        stores nothing and scans the gallery projections in place, masking its removed
+        faces, ids are then the gallery ids.
+
+        Attributes:
+            gallery (FaceGallery): gallery searched in place, None to store the vectors
+            vectors ((K x D) np.array): stored vectors, including removed ones
+            ids (K np.array): id of each stored vector
+            alive (K np.array): boolean mask of the vectors that have not been removed
+    """
+    def __init__(self, gallery=None):
+        self.gallery = gallery
+        self._vectors = None
+        self._ids = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._size = 0
+        self._n_removed = 0
+
+    def __len__(self):
+        if self.gallery is not None:
+            return len(self.gallery)
+        return self._size - self._n_removed
+
+    @property
+    def vectors(self):
+        if self.gallery is not None:
+            return self.gallery.vectors
+        return self._vectors[:self._size] if self._vectors is not None else None
+
+    @property
+    def ids(self):
+        if self.gallery is not None:
+            return np.arange(self.gallery.size)
+        return self._ids[:self._size]
+
+    @property
+    def alive(self):
+        if self.gallery is not None:
+            return self.gallery.alive
+        return self._alive[:self._size]
+
+    def add(self, vectors, ids):
+        """ Insert vectors in the index
+
+            Args:
+                vectors ((N x D) np.array): vectors to insert
+                ids (N np.array): ids of the inserted vectors
+        """
+        if self.gallery is not None:
+            # Faces are added to the gallery itself
+            return
+
+        vectors = np.atleast_2d(vectors)
+        if self._vectors is None:
+            self._vectors = np.empty((0, vectors.shape[1]), dtype=vectors.dtype)
+
+        start, end = self._size, self._size + len(vectors)
+        self._vectors = grow_capacity(self._vectors, end)
+        self._ids = grow_capacity(self._ids, end)
+        self._alive = grow_capacity(self._alive, end)
+
+        self._vectors[start:end] = vectors
+        self._ids[start:end] = ids
+        self._alive[start:end] = True
+        self._size = end
+
+    def remove(self, ids):
+        """ Remove vectors from the index
+
+            Args:
+                ids (np.array): ids of the vectors to remove
+        """
+        if self.gallery is not None:
+            # Removed faces are tombstoned in the gallery itself
+            return
+
+        removed = np.isin(self.ids, ids) & self.alive
+        self._alive[:self._size][removed] = False
+        self._n_removed += int(np.count_nonzero(removed))
+
+    def live(self):
+        """ Return the vectors and ids that have not been removed
+
+            Returns:
+                vectors ((K x D) np.array): live vectors
+                ids (K np.array): their ids
+        """
+        alive = self.alive
+        return self.vectors[alive], self.ids[alive]
+
+    def _distances(self, queries):
+        """(N x K) distances from queries to stored vectors, inf for removed vectors"""
+        vectors = self.vectors
+        dist = pairwise_distance_matrix(queries.astype(vectors.dtype, copy=False), vectors)
+        if len(self) < len(vectors):
+            dist[:, ~self.alive] = np.inf
+        return dist
+
+    def search(self, queries, k=1):
+        """ Find the k nearest stored vectors of every query
+
+            Args:
+                queries ((N x D) np.array): query vectors
+                k (int): number of neighbours to return
+
+            Returns:
+                distances ((N x k) np.array): distances to the neighbours, inf if missing
+                ids ((N x k) np.array): ids of the neighbours, -1 if missing
+        """
+        queries = np.atleast_2d(queries)
+        if len(self) == 0:
+            return _empty_result(len(queries), k)
+
+        return _k_smallest(self._distances(queries), self.ids, k)
+
+    def radius_search(self, queries, radius):
+        """ Find every stored vector within radius of every query
+
+            Args:
+                queries ((N x D) np.array): query vectors
+                radius (float): maximum distance of a match
+
+            Returns:
+                matches (List): for every query a tuple (ids, distances) sorted by distance
+        """
+        queries = np.atleast_2d(queries)
+        if len(self) == 0:
+            return [(np.empty(0, dtype=np.int64), np.empty(0)) for _ in queries]
+
+        return _radius_filter(self._distances(queries), self.ids, radius)
+
+
+class TreeIndex:
+    """ Exact nearest neighbour search using a KD-tree or a ball tree
+
+        sklearn trees can not be modified once built, so inserted vectors are kept in a
+        brute force buffer which is merged into a rebuilt tree when it holds more than
+        rebuild_ratio times the number of vectors in the tree. This amortizes the cost
+        of rebuilding over many inserts while queries stay close to tree speed. Removed
+        vectors are masked until they make up rebuild_ratio of the tree.
+
+        Attributes:
+            kind (str): 'kdtree' or 'balltree'
+            leaf_size (int): leaf size of the tree
+            rebuild_ratio (float): buffer to tree size ratio that triggers a rebuild
+            min_tree_size (int): number of vectors before a first tree is built
+    """
+    def __init__(self, kind='kdtree', leaf_size=40, rebuild_ratio=0.1, min_tree_size=256):
+        from sklearn.neighbors import BallTree, KDTree
+
+        assert kind in ('kdtree', 'balltree'), f"Unknown tree kind: {kind}"
+        self.kind = kind
+        self.leaf_size = leaf_size
+        self.rebuild_ratio = rebuild_ratio
+        self.min_tree_size = min_tree_size
+        self._tree_class = KDTree if kind == 'kdtree' else BallTree
+        self._tree = None
+        self._tree_vectors = None
+        self._tree_ids = np.empty(0, dtype=np.int64)
+        self._tree_alive = np.empty(0, dtype=bool)
+        self._n_removed = 0
+        self._pending = BruteForceIndex()
+
+    def __len__(self):
+        return len(self._tree_ids) - self._n_removed + len(self._pending)
+
+    def add(self, vectors, ids):
+        """Insert vectors in the index, see BruteForceIndex.add"""
+        self._pending.add(vectors, ids)
+
+        if self._tree is None:
+            rebuild_size = self.min_tree_size
+        else:
+            rebuild_size = self.rebuild_ratio*len(self._tree_ids)
+
+        if len(self._pending) >= rebuild_size:
+            self._rebuild()
+
+    def remove(self, ids):
+        """Remove vectors from the index, see BruteForceIndex.remove"""
+        self._pending.remove(ids)
+
+        removed = np.isin(self._tree_ids, ids) & self._tree_alive
+        self._tree_alive[removed] = False
+        self._n_removed += int(np.count_nonzero(removed))
+
+        if self._n_removed > self.rebuild_ratio*len(self._tree_ids):
+            self._rebuild()
+
+    def _rebuild(self):
+        """Rebuild the tree from its live vectors and the pending buffer"""
+        vectors, ids = list(), list()
+        if self._tree_vectors is not None:
+            vectors.append(self._tree_vectors[self._tree_alive])
+            ids.append(self._tree_ids[self._tree_alive])
+        if self._pending.vectors is not None:
+            pending_vectors, pending_ids = self._pending.live()
+            vectors.append(pending_vectors)
+            ids.append(pending_ids)
+
+        self._n_removed = 0
+        self._pending = BruteForceIndex()
+        if sum(len(i) for i in ids) == 0:
+            # Every vector was removed, trees can not be built on 0 samples
+            self._tree = None
+            self._tree_vectors = None
+            self._tree_ids = np.empty(0, dtype=np.int64)
+            self._tree_alive = np.empty(0, dtype=bool)
+            return
+
+        self._tree_vectors = np.vstack(vectors)
+        self._tree_ids = np.concatenate(ids)
+        self._tree_alive = np.ones(len(self._tree_ids), dtype=bool)
+        self._tree = self._tree_class(self._tree_vectors, leaf_size=self.leaf_size)
+
+    def search(self, queries, k=1):
+        """Find the k nearest stored vectors of every query, see BruteForceIndex.search"""
+        queries = np.atleast_2d(queries)
+        results = [self._pending.search(queries, k)]
+
+        if self._tree is not None and len(self._tree_ids) > 0:
+            # Query extra neighbours so that k live ones remain after masking removed vectors
+            kk = min(k + self._n_removed, len(self._tree_ids))
+            dist, idx = self._tree.query(queries, k=kk)
+            dist[~self._tree_alive[idx]] = np.inf
+            results.append((dist, self._tree_ids[idx]))
+
+        distances, neighbours = _merge_results(results, k)
+        neighbours[np.isinf(distances)] = -1
+        return _pad_results(distances, neighbours, k)
+
+    def radius_search(self, queries, radius):
+        """Find every stored vector within radius of every query, see BruteForceIndex.radius_search"""
+        queries = np.atleast_2d(queries)
+        matches = self._pending.radius_search(queries, radius)
+
+        if self._tree is None:
+            return matches
+
+        idx, dist = self._tree.query_radius(queries, r=radius, return_distance=True, sort_results=True)
+        merged = list()
+        for (p_ids, p_dist), t_idx, t_dist in zip(matches, idx, dist):
+            alive = self._tree_alive[t_idx]
+            all_ids = np.concatenate((p_ids, self._tree_ids[t_idx[alive]]))
+            all_dist = np.concatenate((p_dist, t_dist[alive]))
+            order = np.argsort(all_dist)
+            merged.append((all_ids[order], all_dist[order]))
+        return merged
+
+
+def _kmeans(X, n_clusters, n_iter=20, seed=0):
+    """ Lloyd's k-means used to train coarse and product quantizers
+
+        Returns:
+            centroids ((n_clusters x D) np.array)
+    """
+    rng = np.random.RandomState(seed)
+    n_clusters = min(n_clusters, len(X))
+    centroids = X[rng.choice(len(X), n_clusters, replace=False)].copy()
+
+    for _ in range(n_iter):
+        assignment = np.argmin(pairwise_distance_matrix(X, centroids), axis=1)
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignment, X)
+
+        # Keep previous centroid for empty clusters
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, np.newaxis]
+
+    return centroids
+
+
+class IVFPQIndex:
+    """ Approximate nearest neighbour search with an inverted file of product quantized codes
+
+        Vectors are assigned to their closest coarse centroid (inverted list), and the residual
+        to that centroid is compressed to n_subvectors codes of n_bits each. Queries only scan
+        the n_probe closest lists, and distances are computed from per-list lookup tables
+        (asymmetric distance computation) instead of from the full vectors.
+
+        Quantized distances overestimate the true distance, which matters for radius queries at
+        a recognition threshold, so the rerank closest candidates of every query are refined
+        using their exact distance while the others keep their quantized distance. This requires
+        keeping the original vectors, set rerank to 0 for a purely quantized index.
+
+        Until train_size vectors have been inserted the index behaves as a brute force index,
+        after which the quantizers are trained on the stored vectors and every vector is encoded.
+        Inverted lists are preallocated arrays whose capacity doubles when full, like the gallery.
+
+        Attributes:
+            n_lists (int): number of coarse centroids / inverted lists
+            n_subvectors (int): number of sub-quantizers
+            n_bits (int): bits per sub-quantizer code (at most 8)
+            n_probe (int): number of inverted lists scanned per query
+            rerank (int): number of candidates refined with exact distances
+            train_size (int): number of vectors needed to train the quantizers
+    """
+    def __init__(self, n_lists=64, n_subvectors=10, n_bits=8, n_probe=8, rerank=32, train_size=None):
+        assert n_bits <= 8, "Codes are stored as uint8, n_bits must be at most 8"
+        self.n_lists = n_lists
+        self.n_subvectors = n_subvectors
+        self.n_bits = n_bits
+        self.n_probe = n_probe
+        self.rerank = rerank
+        self.train_size = train_size or max(40*n_lists, 4*2**n_bits)
+
+        self.centroids = None
+        self.codebooks = None
+        self._subspaces = None
+        self._list_codes = None
+        self._list_ids = None
+        self._list_vectors = None
+        self._list_sizes = None
+        self._untrained = BruteForceIndex()
+
+    def __len__(self):
+        if not self.is_trained:
+            return len(self._untrained)
+        return int(self._list_sizes.sum())
+
+    @property
+    def is_trained(self):
+        return self.centroids is not None
+
+    def add(self, vectors, ids):
+        """Insert vectors in the index, see BruteForceIndex.add"""
+        vectors = np.atleast_2d(vectors)
+        ids = np.asarray(ids, dtype=np.int64)
+
+        if not self.is_trained:
+            self._untrained.add(vectors, ids)
+            if len(self._untrained) >= self.train_size:
+                vectors, ids = self._untrained.live()
+                self._train(vectors)
+                self._untrained = BruteForceIndex()
+            else:
+                return
+
+        assignment, codes = self._encode(vectors)
+        for list_no in np.unique(assignment):
+            members = assignment == list_no
+            start = self._list_sizes[list_no]
+            end = start + np.count_nonzero(members)
+            self._list_codes[list_no] = grow_capacity(self._list_codes[list_no], end)
+            self._list_ids[list_no] = grow_capacity(self._list_ids[list_no], end)
+            self._list_codes[list_no][start:end] = codes[members]
+            self._list_ids[list_no][start:end] = ids[members]
+            if self.rerank:
+                self._list_vectors[list_no] = grow_capacity(self._list_vectors[list_no], end)
+                self._list_vectors[list_no][start:end] = vectors[members]
+            self._list_sizes[list_no] = end
+
+    def remove(self, ids):
+        """Remove vectors from the index, see BruteForceIndex.remove"""
+        if not self.is_trained:
+            self._untrained.remove(ids)
+            return
+
+        for list_no, size in enumerate(self._list_sizes):
+            kept = ~np.isin(self._list_ids[list_no][:size], ids)
+            if np.all(kept):
+                continue
+            # Compact the kept entries at the start of the list, keeping its capacity
+            n_kept = np.count_nonzero(kept)
+            self._list_ids[list_no][:n_kept] = self._list_ids[list_no][:size][kept]
+            self._list_codes[list_no][:n_kept] = self._list_codes[list_no][:size][kept]
+            if self.rerank:
+                self._list_vectors[list_no][:n_kept] = self._list_vectors[list_no][:size][kept]
+            self._list_sizes[list_no] = n_kept
+
+    def _train(self, X):
+        """Train the coarse quantizer and the product quantizer of the residuals"""
+        self.centroids = _kmeans(X, self.n_lists)
+        residuals = X - self.centroids[np.argmin(pairwise_distance_matrix(X, self.centroids), axis=1)]
+
+        self._subspaces = np.array_split(np.arange(X.shape[1]), self.n_subvectors)
+        self.codebooks = [_kmeans(residuals[:, dims], 2**self.n_bits, seed=m)
+                          for m, dims in enumerate(self._subspaces)]
+
+        n_lists = len(self.centroids)
+        self._list_codes = [np.empty((0, self.n_subvectors), dtype=np.uint8) for _ in range(n_lists)]
+        self._list_ids = [np.empty(0, dtype=np.int64) for _ in range(n_lists)]
+        self._list_vectors = [np.empty((0, X.shape[1]), dtype=X.dtype) for _ in range(n_lists)]
+        self._list_sizes = np.zeros(n_lists, dtype=np.int64)
+
+    def _encode(self, X):
+        """Assign vectors to inverted lists and quantize their residuals"""
+        assignment = np.argmin(pairwise_distance_matrix(X, self.centroids), axis=1)
+        residuals = X - self.centroids[assignment]
+
+        codes = np.empty((len(X), self.n_subvectors), dtype=np.uint8)
+        for m, dims in enumerate(self._subspaces):
+            codes[:, m] = np.argmin(pairwise_distance_matrix(residuals[:, dims], self.codebooks[m]), axis=1)
+        return assignment, codes
+
+    def _scan(self, query):
+        """ Distances from a query to the vectors of its n_probe closest lists
+
+            Returns:
+                ids (np.array): ids of the scanned vectors
+                distances (np.array): quantized distances of every scanned vector, exact
+                                      distances for the rerank closest candidates
+        """
+        coarse = pairwise_distance_matrix(query[np.newaxis, :], self.centroids)[0]
+        probes = np.argsort(coarse)[:self.n_probe]
+
+        # (probes x subvectors x codes) lookup tables of squared residual to code distances
+        residuals = query - self.centroids[probes]
+        tables = np.stack([pairwise_distance_matrix(residuals[:, dims], codebook)**2
+                           for dims, codebook in zip(self._subspaces, self.codebooks)], axis=1)
+        subvectors = np.arange(self.n_subvectors)
+
+        ids, sq_dist, probed = list(), list(), list()
+        for p, list_no in enumerate(probes):
+            size = self._list_sizes[list_no]
+            if size == 0:
+                continue
+            codes = self._list_codes[list_no][:size]
+            ids.append(self._list_ids[list_no][:size])
+            sq_dist.append(tables[p][subvectors, codes].sum(axis=1))
+            probed.append(list_no)
+
+        if not ids:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        ids = np.concatenate(ids)
+        dist = np.sqrt(np.concatenate(sq_dist))
+
+        if self.rerank:
+            # Other candidates keep their quantized distance, so radius queries still return them
+            candidates = np.argsort(dist)[:self.rerank]
+            vectors = np.vstack([self._list_vectors[list_no][:self._list_sizes[list_no]] for list_no in probed])[candidates]
+            dist[candidates] = np.sqrt(np.sum((vectors - query)**2, axis=1))
+
+        return ids, dist
+
+    def search(self, queries, k=1):
+        """Find the (approximate) k nearest stored vectors of every query, see BruteForceIndex.search"""
+        queries = np.atleast_2d(queries)
+        if not self.is_trained:
+            return self._untrained.search(queries, k)
+
+        distances, neighbours = _empty_result(len(queries), k)
+        for i, query in enumerate(queries):
+            ids, dist = self._scan(query)
+            distances[i], neighbours[i] = [r[0] for r in _k_smallest(dist[np.newaxis, :], ids, k)]
+        return distances, neighbours
+
+    def radius_search(self, queries, radius):
+        """Find (approximately) every stored vector within radius of every query, see BruteForceIndex.radius_search"""
+        queries = np.atleast_2d(queries)
+        if not self.is_trained:
+            return self._untrained.radius_search(queries, radius)
+
+        matches = list()
+        for query in queries:
+            ids, dist = self._scan(query)
+            matches.append(_radius_filter(dist[np.newaxis, :], ids, radius)[0])
+        return matches
+
+
+INDEX_TYPES = ('brute', 'kdtree', 'balltree', 'ivfpq')
+
+def create_index(kind='brute', **kwargs):
+    """ Create a gallery index by name
+
+        Args:
+            kind (str): one of INDEX_TYPES
+            kwargs: keyword arguments passed to the index constructor
+
+        Returns:
+            index: BruteForceIndex, TreeIndex or IVFPQIndex
+    """
+    if kind == 'brute':
+        return BruteForceIndex(**kwargs)
+    elif kind in ('kdtree', 'balltree'):
+        return TreeIndex(kind, **kwargs)
+    elif kind == 'ivfpq':
+        return IVFPQIndex(**kwargs)
+
+    raise ValueError(f"Unknown index type {kind}, expected one of {INDEX_TYPES}")
@@ -1,43 +1,154 @@
 import logging
 import glob
+import os
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
+import numpy as np
 
-def load_image(image_path):
+def load_image(image_path, shape=None):
     """
         Load image as grayscale image
         Args:
             image_path (str): Folder containing images to be loade
+            (Optional) shape (int, int): Height and width to resize and crop the image to
 
         Returns
-            image
+            image, None if the image could not be read
     """
-    # Read Image
-    image = cv2.imread(image_path)
+    # Decode straight to grayscale instead of decoding color and converting it
+    image = cv2.imread(image_path, cv2.IMREAD_GRAYSCALE)
 
-    # Convert to grayscale
-    image = cvt_to_gray(image)
+    if image is not None and shape is not None and image.shape != tuple(shape):
+        image = resize_image(image, shape)
 
     return image
 
-def load_images_from_folder(image_folder, max_number=None):
+def load_images_from_folder(image_folder, max_number=None, shape=None, workers=None):
     """
         Load folder of images as grayscale images
         Args:
             image_folder (str): Folder containing images to be processed
             (Optional) max_number (int): maximum number of images to return
+            (Optional) shape (int, int): Height and width images are resized and cropped to
+            (Optional) workers (int): number of decoding threads
 
         Returns
-            images (list): list of imported images
+            images (list): list of imported images, or one (N x H x W) uint8 array if shape is given
     """
-    paths = glob.glob(image_folder + '/*')
-    paths = paths[:max_number] if max_number else paths
+    paths = list_images(image_folder, max_number)
 
-    imgs = [load_image(p) for p in paths]
+    if shape is not None:
+        return next(load_image_batches(paths, max(1, len(paths)), shape=shape, workers=workers),
+                    np.empty((0,) + tuple(shape), dtype=np.uint8))
+
+    with ThreadPoolExecutor(workers) as executor:
+        imgs = [img for img in executor.map(load_image, paths) if img is not None]
 
     return imgs
 
 
+def list_images(image_folder, max_number=None):
+    """Sorted paths of the files of a folder, at most max_number of them"""
+    paths = sorted(glob.glob(image_folder + '/*'))
+    return paths[:max_number] if max_number else paths
+
+
+def load_image_batches(images, batch_size, max_number=None, shape=None, workers=None):
+    """
+        Load images as batches of grayscale images, holding only a couple of batches in memory
+
+        Images are decoded by a pool of threads, OpenCV releases the GIL while decoding, and
+        the next batch is decoded while the current one is being used.
+
+        Args:
+            images (str or List): Folder containing images to be processed, or image paths
+            batch_size (int): number of images per batch
+            (Optional) max_number (int): maximum number of images to load
+            (Optional) shape (int, int): Height and width images are resized and cropped to,
+                                         the shape of the first image if None
+            (Optional) workers (int): number of decoding threads
+
+        Yields
+            images ((n x H x W) np.array): batch of at most batch_size uint8 images, images
+                                           that could not be read are left out
+    """
+    paths = list_images(images, max_number) if isinstance(images, str) else list(images)[:max_number or None]
+    if not paths:
+        return
+
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(workers) as executor:
+        if shape is None:
+            shape = _first_image_shape(paths)
+
+        pending = _submit_batch(executor, workers, paths[:batch_size], shape)
+        for i in range(batch_size, len(paths) + batch_size, batch_size):
+            # Decode the next batch while the current one is used
+            following = _submit_batch(executor, workers, paths[i:i+batch_size], shape) if i < len(paths) else None
+            yield _collect_batch(*pending)
+            pending = following
+
+
+def load_images_into(paths, out, workers=None):
+    """
+        Decode images into the rows of a preallocated array on a pool of threads
+
+        Args:
+            paths (List): image paths
+            out ((N x H x W) np.array): uint8 array with one row per path, images are resized
+                                        and cropped to its H x W
+            (Optional) workers (int): number of decoding threads
+
+        Returns
+            read (N np.array): boolean mask of the images that could be read
+    """
+    workers = workers or min(32, (os.cpu_count() or 1) + 4)
+    with ThreadPoolExecutor(workers) as executor:
+        _, futures = _submit_batch(executor, workers, paths, out.shape[1:], out)
+        return _read_mask(futures)
+
+
+def _first_image_shape(paths):
+    for path in paths:
+        image = load_image(path)
+        if image is not None:
+            return image.shape
+    raise FileNotFoundError(f"None of the {len(paths)} images could be read")
+
+
+def _read_into(batch, start, paths, shape):
+    """Decode images into consecutive rows of a preallocated batch, returning which were read"""
+    read = np.ones(len(paths), dtype=bool)
+    for i, path in enumerate(paths):
+        image = load_image(path, shape)
+        if image is None:
+            logging.warning(f"Could not read image {path}")
+            read[i] = False
+        else:
+            batch[start + i] = image
+    return read
+
+
+def _submit_batch(executor, workers, paths, shape, batch=None):
+    if batch is None:
+        batch = np.empty((len(paths),) + tuple(shape), dtype=np.uint8)
+    # A few chunks per thread, one task per image would cost more than decoding small faces
+    chunk = max(1, -(-len(paths)//(4*workers)))
+    futures = [executor.submit(_read_into, batch, i, paths[i:i+chunk], shape)
+               for i in range(0, len(paths), chunk)]
+    return batch, futures
+
+
+def _read_mask(futures):
+    return np.concatenate([future.result() for future in futures]) if futures else np.ones(0, dtype=bool)
+
+
+def _collect_batch(batch, futures):
+    read = _read_mask(futures)
+    return batch if read.all() else batch[read]
+
+
 def cvt_to_gray(image):
     """
         Converts image to grayscale.
@@ -75,9 +186,9 @@ def crop_to_center(image, target_shape):
     assert target_h <= source_h,"Crop target height is greater than source image height"
     assert target_w <= source_w,"Crop target width is greater than source image width"
 
-    # Get excess
-    top_margin = (source_h - target_h)
-    left_margin = (source_w - target_w)
+    # Split the excess evenly between both sides
+    top_margin = (source_h - target_h)//2
+    left_margin = (source_w - target_w)//2
 
     crop = image[top_margin:top_margin+target_h, left_margin:left_margin+target_w]
 
@@ -85,15 +196,41 @@ def crop_to_center(image, target_shape):
 
 def resize_image(image, shape):
     """
-        Resize an image while keeping aspect ratio
+        Resize an image while keeping aspect ratio, cropping the excess of the longer side
 
         Args:
-            images (np.array): Image to crop
+            images (np.array): Image to resize
             shape (int, int): Height and width of the resulting image
-            keep_aspect_ratio (bool): Keep the aspect ratio of original image
 
         Returns:
             resized (np.array): resize_image
     """
     source_h, source_w = image.shape
     target_h, target_w = shape
+
+    # Scale the image to cover the target, then crop the excess of the other side
+    scale = max(target_h/source_h, target_w/source_w)
+    size = (max(target_w, int(round(source_w*scale))), max(target_h, int(round(source_h*scale))))
+    interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+    resized = cv2.resize(image, size, interpolation=interpolation)
+
+    return crop_to_center(resized, shape)
+
+
+def dhash(image, hash_size=8):
+    """
+        Difference hash of an image, equal for identical and near-identical images
+
+        The image is shrunk to (hash_size x hash_size+1) and every bit tells whether a pixel
+        is brighter than its right neighbour, so noise, small shifts and global brightness
+        changes rarely change the hash
+
+        Args:
+            image (np.array): grayscale image
+            (Optional) hash_size (int): the hash has hash_size**2 bits
+
+        Returns:
+            hash (bytes): packed hash bits
+    """
+    small = cv2.resize(image, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    return np.packbits(small[:, 1:] > small[:, :-1]).tobytes()
@@ -0,0 +1,283 @@
+""" Versioned on-disk format of the facespace and of the gallery of known faces
+
+    A model is a directory holding header.json and one raw binary file per array. The header
+    records the format version, the image shape, the number of components and the file,
+    dtype and shape of every array, so arrays are memory-mapped instead of being read or
+    unpickled. Worker processes mapping the same model share its pages.
+
+    The gallery is stored as float vectors and int32 labels indexing a table of names kept
+    in the header. Enrolled faces are appended to the end of the gallery files and the header
+    is then replaced, so an interrupted append leaves the previous gallery intact. The vectors
+    are projections, which depend on the contrast and brightness coefficients and the precision
+    of the recognizer that projected them, so the header records these with the gallery.
+"""
+import json
+import logging
+import os
+
+import numpy as np
+
+from .eigenfaces import load_facespace_dict
+from .projection import quantize_rows, PRECISIONS
+
+MODEL_FORMAT = 'pybell-model'
+MODEL_VERSION = 1
+HEADER_FILE = 'header.json'
+
+
+def is_model(path):
+    """True if path is a model directory written by save_model"""
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def save_model(model_dir, facespace, mean_face, img_shape, names=None, vectors=None, gallery_dtype=np.float32,
+               precision=None, projection=None):
+    """ Write a facespace and optionally a gallery of known faces to a model directory
+
+        Args:
+            model_dir (str): directory to write, created if needed
+            facespace ((components x H*W) np.array): basis of the facespace
+            mean_face ((H*W) np.array): mean face of the training set
+            img_shape (tuple): (H, W) of the faces
+            (Optional) names (List): name of every known face
+            (Optional) vectors ((K x components) np.array): facespace projections of the known faces
+            (Optional) gallery_dtype (np.dtype): storage type of the gallery vectors
+            (Optional) precision (str): 'float64', 'float32' or 'int8' storage of the facespace,
+                                        None keeps its type. int8 stores row scales with it
+            (Optional) projection (dict): settings the gallery vectors were projected with, see
+                                          FaceRecognizer.projection_settings
+    """
+    assert precision in (None,) + PRECISIONS, f"Unknown precision: {precision}"
+    facespace = np.ascontiguousarray(facespace)
+    mean_face = np.ascontiguousarray(mean_face).reshape(-1)
+
+    scales = None
+    if precision == 'int8':
+        facespace, scales = quantize_rows(facespace)
+    if precision in ('float32', 'int8'):
+        mean_face = mean_face.astype(np.float32)
+    if precision == 'float32':
+        facespace = facespace.astype(np.float32)
+    assert facespace.shape[1] == mean_face.size == img_shape[0]*img_shape[1], \
+        f"Facespace {facespace.shape} does not match faces of shape {img_shape}"
+
+    os.makedirs(model_dir, exist_ok=True)
+    header = {
+        'format': MODEL_FORMAT,
+        'version': MODEL_VERSION,
+        'img_shape': list(img_shape),
+        'components': int(facespace.shape[0]),
+        'arrays': {
+            'facespace': _write_array(model_dir, 'facespace', facespace),
+            'mean_face': _write_array(model_dir, 'mean_face', mean_face),
+        },
+    }
+    if scales is not None:
+        header['arrays']['facespace_scales'] = _write_array(model_dir, 'facespace_scales', scales)
+
+    header['gallery'] = _write_gallery(model_dir, names or list(), vectors, facespace.shape[0], gallery_dtype,
+                                       projection=projection)
+    _write_header(model_dir, header)
+
+
+def load_model(model_dir, mmap=True):
+    """ Load a model directory
+
+        Args:
+            model_dir (str): directory written by save_model
+            (Optional) mmap (bool): memory-map the arrays instead of reading them
+
+        Returns:
+            model (dict): facespace, mean_face, img_shape, components, and the gallery as
+                          names (List) and vectors ((K x components) np.array) with the
+                          projection (dict) settings of the vectors, None if not recorded.
+                          An int8 facespace comes with its facespace_scales
+    """
+    header = _read_header(model_dir)
+    arrays = header['arrays']
+    gallery = header['gallery']
+
+    labels = _read_array(model_dir, gallery['labels'], mmap)
+    model = {
+        'facespace': _read_array(model_dir, arrays['facespace'], mmap),
+        'mean_face': _read_array(model_dir, arrays['mean_face'], mmap),
+        'img_shape': tuple(header['img_shape']),
+        'components': header['components'],
+        'names': [gallery['names'][label] for label in labels],
+        'vectors': _read_array(model_dir, gallery['vectors'], mmap),
+        'projection': gallery.get('projection'),
+    }
+    if 'facespace_scales' in arrays:
+        model['facespace_scales'] = _read_array(model_dir, arrays['facespace_scales'], mmap)
+    return model
+
+
+def load_facespace(path, mmap=True):
+    """ Load a facespace from a model directory, or from a legacy facespace pickle
+
+        Pickles can run arbitrary code when loaded, only load pickles from trusted sources
+        and convert them with save_model. When path does not exist but path.pkl does, e.g.
+        the default model directory of an install with the provided facespace.pkl, the
+        pickle is loaded.
+
+        Returns:
+            model (dict): see load_model, the gallery of a pickle is empty
+    """
+    if is_model(path):
+        return load_model(path, mmap)
+    if not os.path.exists(path) and os.path.isfile(path + '.pkl'):
+        path = path + '.pkl'
+
+    logging.warning(f"Loading legacy pickle facespace {path}, convert it to a model directory with save_model")
+    facespace_dict = load_facespace_dict(path)
+    facespace = facespace_dict['facespace']
+    side = int(np.sqrt(facespace.shape[1]))
+    return {
+        'facespace': facespace,
+        'mean_face': facespace_dict['mean_face'],
+        'img_shape': tuple(facespace_dict.get('img_shape', (side, side))),
+        'components': facespace.shape[0],
+        'names': list(),
+        'vectors': np.empty((0, facespace.shape[0]), dtype=np.float32),
+        'projection': None,
+    }
+
+
+def gallery_version(path):
+    """ Generation and number of faces of the gallery of a model directory
+
+        Enrollments append faces and removals write a new generation, so the pair changes
+        whenever the known faces change. The gallery of a legacy pickle is always empty.
+
+        Returns:
+            version (dict): generation and faces of the gallery
+    """
+    if not is_model(path):
+        return {'generation': 0, 'faces': 0}
+    gallery = _read_header(path)['gallery']
+    return {'generation': gallery.get('generation', 0), 'faces': gallery['vectors']['shape'][0]}
+
+
+def append_gallery(model_dir, names, vectors, projection=None):
+    """ Append known faces to the gallery of a model directory
+
+        Args:
+            model_dir (str): directory written by save_model
+            names (List): name of every face
+            vectors ((N x components) np.array): facespace projections of the faces
+            (Optional) projection (dict): settings the vectors were projected with, which must be
+                                          those of the faces already in the gallery
+    """
+    header = _read_header(model_dir)
+    gallery = header['gallery']
+    if projection is not None:
+        if gallery['vectors']['shape'][0] == 0 or gallery.get('projection') is None:
+            gallery['projection'] = projection
+        assert gallery['projection'] == projection, \
+            f"Gallery of {model_dir} was projected with {gallery['projection']}, not {projection}"
+    vectors_info, labels_info = gallery['vectors'], gallery['labels']
+
+    vectors = np.atleast_2d(np.asarray(vectors, dtype=vectors_info['dtype']))
+    assert len(names) == len(vectors), f"Got {len(names)} names for {len(vectors)} faces"
+    assert vectors.shape[1] == header['components'], \
+        f"Face dimension {vectors.shape[1]} != {header['components']}"
+
+    name2label = {name: label for label, name in enumerate(gallery['names'])}
+    labels = list()
+    for name in names:
+        if name not in name2label:
+            name2label[name] = len(gallery['names'])
+            gallery['names'].append(name)
+        labels.append(name2label[name])
+
+    count = vectors_info['shape'][0]
+    _append_rows(model_dir, vectors_info, count, vectors)
+    _append_rows(model_dir, labels_info, count, np.array(labels, dtype=labels_info['dtype']))
+    vectors_info['shape'][0] = labels_info['shape'][0] = count + len(vectors)
+
+    # The new rows only become part of the gallery once the header is replaced
+    _write_header(model_dir, header)
+
+
+def save_gallery(model_dir, names, vectors, projection=None):
+    """Replace the gallery of a model directory, e.g. after known faces were removed"""
+    header = _read_header(model_dir)
+    previous = header['gallery']
+    dtype = np.dtype(previous['vectors']['dtype'])
+
+    # New files are written next to the current ones, the header then switches to them
+    header['gallery'] = _write_gallery(model_dir, list(names), vectors, header['components'], dtype,
+                                       generation=previous.get('generation', 0) + 1,
+                                       projection=projection or previous.get('projection'))
+    _write_header(model_dir, header)
+
+    for info in (previous['vectors'], previous['labels']):
+        os.remove(os.path.join(model_dir, info['file']))
+
+
+def _write_gallery(model_dir, names, vectors, components, dtype, generation=0, projection=None):
+    if vectors is None:
+        vectors = np.empty((0, components), dtype=dtype)
+    vectors = np.ascontiguousarray(vectors, dtype=dtype).reshape(-1, components)
+    assert len(names) == len(vectors), f"Got {len(names)} names for {len(vectors)} faces"
+
+    table = list(dict.fromkeys(names))
+    name2label = {name: label for label, name in enumerate(table)}
+    labels = np.array([name2label[name] for name in names], dtype=np.int32)
+
+    suffix = f'.{generation}' if generation else ''
+    return {
+        'generation': generation,
+        'projection': projection,
+        'names': table,
+        'vectors': _write_array(model_dir, 'gallery_vectors' + suffix, vectors),
+        'labels': _write_array(model_dir, 'gallery_labels' + suffix, labels),
+    }
+
+
+def _write_array(model_dir, name, array):
+    """Write an array as raw bytes, returning its header entry"""
+    file = f'{name}.bin'
+    with open(os.path.join(model_dir, file), 'wb') as f:
+        f.write(np.ascontiguousarray(array).tobytes())
+    return {'file': file, 'dtype': array.dtype.str, 'shape': list(array.shape)}
+
+
+def _read_array(model_dir, info, mmap=True):
+    """Read or memory-map an array described by a header entry"""
+    dtype, shape = np.dtype(info['dtype']), tuple(info['shape'])
+    path = os.path.join(model_dir, info['file'])
+    count = int(np.prod(shape))
+
+    if count == 0:
+        return np.empty(shape, dtype=dtype)
+    if mmap:
+        # Rows appended after the header was written are ignored
+        return np.memmap(path, dtype=dtype, mode='r', shape=shape)
+    return np.fromfile(path, dtype=dtype, count=count).reshape(shape)
+
+
+def _append_rows(model_dir, info, count, rows):
+    """Append rows to an array file, dropping bytes left by an interrupted append"""
+    row_bytes = np.dtype(info['dtype']).itemsize*int(np.prod(info['shape'][1:]))
+    with open(os.path.join(model_dir, info['file']), 'r+b') as f:
+        f.truncate(count*row_bytes)
+        f.seek(0, os.SEEK_END)
+        f.write(np.ascontiguousarray(rows).tobytes())
+
+
+def _read_header(model_dir):
+    with open(os.path.join(model_dir, HEADER_FILE)) as f:
+        header = json.load(f)
+
+    assert header.get('format') == MODEL_FORMAT, f"{model_dir} is not a {MODEL_FORMAT} directory"
+    assert header.get('version', 0) <= MODEL_VERSION, \
+        f"{model_dir} has model version {header.get('version')}, newer than supported version {MODEL_VERSION}"
+    return header
+
+
+def _write_header(model_dir, header):
+    path = os.path.join(model_dir, HEADER_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(header, f, indent=2)
+    os.replace(path + '.tmp', path)
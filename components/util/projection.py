@@ -0,0 +1,92 @@
+""" Runtime projection and distance computations of the recognizer, with numpy only
+
+    Training the facespace, see eigenfaces.py, needs scikit-learn, projecting faces onto
+    it and comparing the projections does not.
+"""
+import numpy as np
+
+
+PRECISIONS = ('float64', 'float32', 'int8')
+
+
+def quantize_rows(X):
+    """ Quantize every row of a matrix to int8 with its own scale
+
+        Args:
+            X ((N x D) np.array): matrix to quantize, e.g. a facespace
+
+        Returns:
+            quantized ((N x D) np.array): int8 matrix
+            scales (N np.array): float32 scale of every row, X ~= scales[:, None]*quantized
+    """
+    scales = np.abs(X).max(axis=1)/127.
+    scales[scales == 0] = 1
+    quantized = np.round(X/scales[:, np.newaxis]).astype(np.int8)
+    return quantized, scales.astype(np.float32)
+
+
+def project_quantized(X, quantized, scales, chunk=1024):
+    """ Project rows of X onto an int8 row-quantized basis
+
+        Columns of the basis are converted to float32 a chunk at a time, so the full
+        precision basis never needs to be held in memory
+
+        Args:
+            X ((N x D) np.array): float32 vectors to project
+            quantized ((K x D) np.array): int8 basis
+            scales (K np.array): scale of every row of the basis
+            (Optional) chunk (int): number of columns converted at a time
+
+        Returns:
+            projections ((N x K) np.array): float32 projections
+    """
+    projections = np.zeros((len(X), len(quantized)), dtype=np.float32)
+    for start in range(0, quantized.shape[1], chunk):
+        basis = quantized[:, start:start+chunk].astype(np.float32)
+        projections += np.matmul(X[:, start:start+chunk], basis.T)
+    projections *= scales
+    return projections
+
+
+def project(facespace, x):
+    """ Project vector on to basis
+
+        Args:
+            facespace ((N x H*W) np.array): Matrix representing basis
+            x (H*W np.array): vector to project
+
+        Returns:
+            projection (N dim np.array): projection of x onto face_space
+    """
+    projection = np.matmul(facespace, x)
+    return projection
+
+
+def distance_matrix(vec, vecs):
+    """Calculate distance between a vector and all other vectors"""
+
+    result = np.sqrt(np.sum((vecs - vec)**2, axis=1))
+    return result
+
+
+def pairwise_distance_matrix(X, Y):
+    """ Calculate distances between every row of X and every row of Y
+
+        Uses the expansion ||x - y||^2 = ||x||^2 + ||y||^2 - 2x.y so that the only
+        heavy operation is a single matrix multiplication
+
+        Args:
+            X ((N x D) np.array): Query vectors
+            Y ((K x D) np.array): Reference vectors
+
+        Returns:
+            distances ((N x K) np.array): Euclidean distance between X[i] and Y[j]
+    """
+    sq_dist = np.matmul(X, Y.T)
+    sq_dist *= -2
+    sq_dist += np.einsum('ij,ij->i', X, X)[:, np.newaxis]
+    sq_dist += np.einsum('ij,ij->i', Y, Y)[np.newaxis, :]
+
+    # Rounding can make distances between near identical vectors slightly negative
+    np.maximum(sq_dist, 0, out=sq_dist)
+    return np.sqrt(sq_dist, out=sq_dist)
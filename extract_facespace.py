@@ -1,29 +1,85 @@
 """ Helper file create facespace from folder of face images """
 import argparse
+import sys
+import time
 
 import numpy as np
 import cv2
 
-from components.util.eigenfaces import extract_facespace, save_facespace_dict
-from components.util.image import load_images_from_folder
+from components.util.dataset import open_faces
+from components.util.eigenfaces import extract_facespace, extract_facespace_streaming, streaming_batch_size, save_facespace_dict, STREAMING_METHODS, PRECISIONS
+from components.util.model import save_model
+from components.util.image import list_images, load_images_from_folder, load_image_batches, load_image
 
 parser = argparse.ArgumentParser(description="Extract FaceSpace from folder of"
                                  "Face Images of the same dimensions")
 
 parser.add_argument("--folder", default='./data/training/faces', help="Folder holding face images")
-parser.add_argument("--max-images", type=int, default=1000, dest="nb_images", help="Maximum number of images to use")
+parser.add_argument("--dataset", default=None, help="Dataset packed by pack_faces.py to use instead of --folder")
+parser.add_argument("--max-images", type=int, default=1000, dest="nb_images", help="Maximum number of images to use, 0 for all")
 parser.add_argument("--components", type=int, default=250, dest="nb_components", help="Numbed of Principal Components to keep for face space")
-parser.add_argument("--out", default='./data/faces/facespace.pkl', help="Output pickle file for facespace information")
+parser.add_argument("--out", default='./data/faces/facespace', help="Output model directory, or legacy pickle file if it ends with .pkl")
+parser.add_argument("--shape", type=int, nargs=2, default=None, metavar=('H', 'W'), help="Resize and crop faces to this shape, the shape of the first face if omitted")
+parser.add_argument("--workers", type=int, default=None, help="Number of image decoding threads")
+parser.add_argument("--precision", choices=PRECISIONS, default='float64', help="Storage type of the facespace in the model directory, int8 is quantized per component")
+parser.add_argument("--streaming", choices=STREAMING_METHODS, default=None, help="Read the faces in batches and fit PCA out of core: exact covariance, randomized SVD of the covariance or IncrementalPCA")
+parser.add_argument("--memory-mb", type=float, default=1024, dest="memory_mb", help="Memory budget of streaming extraction in megabytes")
+parser.add_argument("--batch-size", type=int, default=None, dest="batch_size", help="Faces per batch of streaming extraction, derived from --memory-mb if omitted")
+
+
+def report_progress(total):
+    """Progress callback printing the number of faces processed and the throughput"""
+    start = time.perf_counter()
+
+    def progress(n_faces):
+        rate = n_faces/max(time.perf_counter() - start, 1e-9)
+        sys.stdout.write(f"\r{n_faces}/{total} faces {rate:8.1f} faces/s")
+        sys.stdout.flush()
+
+    return progress
+
 
 if __name__ == '__main__':
     # Parse Arguments
     args = parser.parse_args()
 
-    # Load Images
-    face_imgs = load_images_from_folder(args.folder, max_number=args.nb_images)
-    assert len(face_imgs) > 0, f"No faces found in {args.folder}"
-    #Extract facespace
-    face_space, mean_face = extract_facespace(np.array(face_imgs), args.nb_components, project=False)
+    if args.dataset:
+        # Faces packed by pack_faces.py are mapped, not decoded
+        dataset = open_faces(args.dataset)
+        assert args.shape is None or tuple(args.shape) == dataset.shape, \
+            f"Faces of {args.dataset} are {dataset.shape}, repack them to change their shape"
+        shape = dataset.shape
+        n_faces = min(len(dataset), args.nb_images) if args.nb_images else len(dataset)
+    else:
+        paths = list_images(args.folder, args.nb_images)
+        assert len(paths) > 0, f"No faces found in {args.folder}"
+        shape = args.shape or load_image(paths[0]).shape
+        n_faces = len(paths)
+
+    if args.streaming:
+        batch_size = args.batch_size
+        if batch_size is None:
+            n_features = shape[0]*shape[1]
+            batch_size = streaming_batch_size(n_features, args.nb_components, args.streaming, args.memory_mb)
+
+        if args.dataset:
+            batches = dataset.batches(batch_size, n_faces)
+        else:
+            batches = load_image_batches(paths, batch_size, shape=shape, workers=args.workers)
+        face_space, mean_face = extract_facespace_streaming(batches, args.nb_components, args.streaming,
+                                                            progress=report_progress(n_faces))
+        print()
+    else:
+        # Load Images
+        if args.dataset:
+            face_imgs = dataset.faces[:n_faces]
+        else:
+            face_imgs = load_images_from_folder(args.folder, args.nb_images, shape=shape, workers=args.workers)
+        #Extract facespace
+        face_space, mean_face = extract_facespace(face_imgs, args.nb_components, project=False)
 
-    # Save facespace to dictionary for future use
-    save_facespace_dict(face_space, mean_face, args.out)
+    # Save facespace for future use
+    if args.out.endswith('.pkl'):
+        save_facespace_dict(face_space, mean_face, args.out)
+    else:
+        save_model(args.out, face_space, mean_face, shape, precision=args.precision)
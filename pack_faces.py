@@ -0,0 +1,28 @@
+""" Pack a folder of face images into a memory-mapped dataset for extract_facespace.py """
+import argparse
+import sys
+import time
+
+from components.util.dataset import pack_faces
+
+parser = argparse.ArgumentParser(description="Decode a folder of face images once into a packed, "
+                                 "memory-mapped dataset. Repacking only decodes new or changed images")
+
+parser.add_argument("--folder", default='./data/training/faces', help="Folder holding face images")
+parser.add_argument("--out", default='./data/training/faces.pack', help="Dataset directory to write")
+parser.add_argument("--shape", type=int, nargs=2, default=None, metavar=('H', 'W'), help="Resize and crop faces to this shape, the shape of the existing dataset or of the first face if omitted")
+parser.add_argument("--max-images", type=int, default=0, dest="nb_images", help="Maximum number of images to pack, 0 for all")
+parser.add_argument("--workers", type=int, default=None, help="Number of image decoding threads")
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    start = time.perf_counter()
+
+    def progress(n_faces):
+        sys.stdout.write(f"\r{n_faces} faces packed")
+        sys.stdout.flush()
+
+    stats = pack_faces(args.folder, args.out, shape=args.shape, max_number=args.nb_images,
+                       workers=args.workers, progress=progress)
+    print(f"\n{stats['faces']} faces in {time.perf_counter() - start:.2f}s: {stats['reused']} reused, "
+          f"{stats['decoded']} decoded, {stats['removed']} removed, {stats['unreadable']} unreadable")
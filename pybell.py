@@ -1,70 +1,371 @@
 #! user/bin/env python
 """Main file used to run facial recognition and detection
 
-Usage: python pybell.py
+Usage: python pybell.py [--camera 0 [1 entrance.mp4 ...]]
 
+Capture, undistortion, detection and recognition run as pipeline stages on their own
+threads, the main thread only hands the processed frames to the output sinks: preview
+window, video file, JSON events or none. Unknown faces are added to the known faces with
+commands read from the terminal or a named pipe on another thread, without pausing the
+stream. With several cameras, frames of every camera are scheduled fairly on a shared pool
+of workers.
+
+The model, the cascade and the cameras are loaded concurrently and warmed up with a blank
+frame before the first real one, the time every startup phase took is reported.
 """
+import time
+
+# Startup time is measured from before the imports
+STARTED = time.perf_counter()
+
+import argparse
+import logging
+import queue
+import sys
+import threading
 
 import cv2
 
 from components.camera import CameraStream
-from components.face_detector import FaceDetector
-from components.face_recognizer import FaceRecognizer
-from components.util.eigenfaces import load_facespace_dict
-from components.util.detection import draw_detection_with_label
+from components.commands import CommandChannel
+from components.embedding_cache import EmbeddingCache
+from components.face_detector import FaceDetector, DetectionProfile, PROFILES
+from components.parallel_detector import ParallelFaceDetector
+from components.face_recognizer import FaceRecognizer, register_gallery
+from components.metrics import REGISTRY, MetricsServer, MetricsLogger
+from components.motion_gate import MotionGate
+from components.multi_camera import MultiCameraManager
+from components.pipeline import Pipeline, FramePacket, Closed
+from components.sinks import SinkGroup, NullSink, PreviewSink, VideoFileSink, JsonEventSink
+from components.startup import StartupTimer, warm_up
+from components.tracker import FaceTracker, apply_tracks
+from components.util.camera import load_calibration_coefficients
+from components.util.projection import PRECISIONS
+from components.util.image import cvt_to_gray
+
+IMPORTED = time.perf_counter()
+
+parser = argparse.ArgumentParser(description="Detect and recognize faces from a camera")
+
+parser.add_argument("--camera", nargs='+', default=['0'], help="Camera indices or video files to read from, several sources share the detection workers")
+parser.add_argument("--fps", type=float, default=None, help="Maximum processed frames per second of each camera when reading several cameras")
+parser.add_argument("--calibration", default=None, help="Fisheye calibration pickle file, frames are undistorted if given")
+parser.add_argument("--roi-undistort", action="store_true", dest="roi_undistort", help="Undistort only detected face regions instead of whole frames")
+parser.add_argument("--facespace", default='./data/faces/facespace', help="Model directory written by extract_facespace.py, or legacy facespace pickle file")
+parser.add_argument("--precision", choices=PRECISIONS, default=None, help="Projection precision, the storage type of the facespace if omitted")
+parser.add_argument("--no-save-gallery", action="store_true", dest="no_save_gallery", help="Keep faces added at the prompt in memory instead of saving them to the model directory")
+parser.add_argument("--queue-size", type=int, default=2, dest="queue_size", help="Capacity of the queues between stages")
+parser.add_argument("--no-drop", action="store_true", dest="no_drop", help="Block slow stages instead of dropping the oldest frames")
+parser.add_argument("--detect-workers", type=int, default=1, dest="detect_workers", help="Number of face detection threads, one with --track and a single camera, or of shared workers with several cameras")
+parser.add_argument("--detect-processes", type=int, default=0, dest="detect_processes", help="Run face detection on a pool of processes, 0 to detect in the detection threads")
+parser.add_argument("--detect-tiles", type=int, nargs=2, default=[1, 1], dest="detect_tiles", metavar=('ROWS', 'COLS'), help="Split frames into overlapping tiles detected in parallel by the processes")
+parser.add_argument("--no-grabber", action="store_true", dest="no_grabber", help="Read camera frames synchronously instead of from a background grabber")
+parser.add_argument("--detect-profile", choices=list(PROFILES), default='accurate', dest="detect_profile", help="Cascade search profile, faster profiles detect on a downscaled frame")
+parser.add_argument("--detect-downscale", type=float, default=None, dest="detect_downscale", help="Override the factor frames are downscaled by before detection")
+parser.add_argument("--face-distance", type=float, nargs=2, default=None, dest="face_distance", metavar=('MIN', 'MAX'), help="Closest and farthest distance of faces in meters, limits the searched face sizes")
+parser.add_argument("--focal-length", type=float, default=None, dest="focal_length", help="Focal length in pixels for --face-distance, taken from the calibration if omitted")
+parser.add_argument("--motion-gate", choices=['diff', 'mog2'], default=None, dest="motion_gate", help="Only run detection where the frame changed, using frame differencing or background subtraction")
+parser.add_argument("--motion-thresh", type=int, default=25, dest="motion_thresh", help="Gray level change of a moving pixel for --motion-gate diff")
+parser.add_argument("--motion-min-area", type=float, default=0.002, dest="motion_min_area", help="Minimum moving region area as a fraction of the frame")
+parser.add_argument("--motion-hold", type=int, default=15, dest="motion_hold", help="Frames to keep searching a region after its motion stops")
+parser.add_argument("--track", action="store_true", help="Track faces across frames and only recognize new tracks and every --recognize-every frames")
+parser.add_argument("--track-motion", choices=['flow', 'template'], default=None, dest="track_motion", help="Follow tracks between detections using optical flow or template matching")
+parser.add_argument("--recognize-every", type=int, default=15, dest="recognize_every", help="Frames between recognitions of a tracked face")
+parser.add_argument("--embedding-cache", type=int, default=0, dest="embedding_cache", help="Cache the projections and matches of this many recently seen faces, 0 to disable")
+parser.add_argument("--cache-ttl", type=float, default=2.0, dest="cache_ttl", help="Seconds a cached face match stays valid")
+parser.add_argument("--cache-key", choices=['hash', 'track'], default='hash', dest="cache_key", help="Key cached faces by a hash of their crop, or by their track id with --track")
+parser.add_argument("--stats-interval", type=float, default=0, dest="stats_interval", help="Seconds between stage statistics reports, 0 to disable")
+parser.add_argument("--sink", nargs='+', choices=['none', 'preview', 'video', 'json'], default=['preview'], help="Outputs of the processed frames, labels are only drawn for preview and video")
+parser.add_argument("--video-out", default='pybell.avi', dest="video_out", help="Video file written by the video sink, one per camera with several cameras")
+parser.add_argument("--video-fps", type=float, default=15, dest="video_fps", help="Frame rate of the video sink files")
+parser.add_argument("--events-out", default='-', dest="events_out", help="File the json sink appends face events to, - for stdout")
+parser.add_argument("--commands", default='-', help="File or named pipe enrollment commands are read from, - for the terminal")
+parser.add_argument("--no-warm-up", action="store_true", dest="no_warm_up", help="Do not run a blank frame through detection and recognition before the first frame")
+parser.add_argument("--metrics-port", type=int, default=0, dest="metrics_port", help="Serve Prometheus metrics on this local port, 0 to disable")
+parser.add_argument("--metrics-host", default='127.0.0.1', dest="metrics_host", help="Address the metrics endpoint listens on")
+parser.add_argument("--metrics-log-interval", type=float, default=0, dest="metrics_log_interval", help="Seconds between JSON metrics log lines, 0 to disable")
+
+
+def build_pipeline(cam, face_detector, face_recognizer, enrollments, args, motion_gate=None, tracker=None):
+    """Create the capture, undistort, motion gating, detection and recognition pipeline"""
+    # cv2.resize takes (W, H)
+    face_shape = face_recognizer.img_shape[::-1]
+
+    def capture(_):
+        frame = cam.latest_frame(timeout=1)
+        if frame is None:
+            # The capture ended, e.g. at the end of a video file, when nothing is grabbing frames
+            if not cam.grabbing:
+                raise StopIteration
+            return None
+        return FramePacket(frame.frame_id, frame.image, frame.timestamp)
+
+    def undistort(packet):
+        packet.image = cam.undistort(packet.image)
+        return packet
+
+    def gate(packet):
+        packet.regions = motion_gate.update(packet.gray)
+        return packet
+
+    # Detection threads finish frames out of order, while the tracker needs them in order
+    detect_workers = 1 if tracker is not None else args.detect_workers
+
+    # cv2.CascadeClassifier is not thread safe, every detection thread loads its own cascade.
+    # A ParallelFaceDetector is shared, its processes already detect one frame each
+    detectors = threading.local()
+
+    def thread_detector():
+        if not isinstance(face_detector, FaceDetector) or detect_workers == 1:
+            return face_detector
+        detector = getattr(detectors, 'detector', None)
+        if detector is None:
+            detector = detectors.detector = FaceDetector(face_detector.cascade, face_detector.face_shape,
+                                                         face_detector.profile)
+        return detector
+
+    def detect(packet):
+        _, packet.bboxes, faces = thread_detector().detectFaces(packet.image, packet.regions, packet.gray)
+        if args.roi_undistort:
+            faces = [cvt_to_gray(cam.undistort_roi(packet.image, bbox)) for bbox in packet.bboxes]
+        packet.faces = [cv2.resize(face, face_shape) for face in faces]
+        return packet
+
+    def recognize(packet):
+        # Enrollments are applied by the only thread using the recognizer
+        while not enrollments.empty():
+            name, face = enrollments.get_nowait()
+            face_recognizer.add_known_face(name, face)
+            if tracker is not None:
+                tracker.reset_recognition()
+
+        if tracker is not None:
+            apply_tracks(packet, tracker.update(packet.gray, packet.bboxes, packet.faces))
+        else:
+            packet.names, packet.distances = face_recognizer.recognize_batch(packet.faces)
+        return packet
+
+    stages = [('capture', capture, 1)]
+    if cam.undistort_fisheye:
+        stages.append(('undistort', undistort, 1))
+    if motion_gate is not None:
+        stages.append(('gate', gate, 1))
+    stages.append(('detect', detect, detect_workers))
+    stages.append(('recognize', recognize, 1))
+
+    return Pipeline(stages, queue_size=args.queue_size, drop_oldest=not args.no_drop)
+
+
+def print_gate_stats(name, motion_gate):
+    """Print the motion gating counters to stderr"""
+    if motion_gate is not None:
+        stats = motion_gate.stats()
+        print(f"{name:>10}: gate hits={stats['hits']} skips={stats['skips']} "
+              f"skip_ratio={stats['skip_ratio']:.2f} searched={stats['searched_fraction']:.2f}", file=sys.stderr)
+
+
+def print_stats(stats, cam, motion_gate=None):
+    """Print one line of statistics per stage to stderr, stdout may carry JSON events"""
+    print(f"    camera: dropped={cam.dropped_frames}", file=sys.stderr)
+    print_gate_stats('gating', motion_gate)
+    for name, stage in stats.items():
+        print(f"{name:>10}: {stage['fps']:6.1f} fps {stage['mean_latency_ms']:7.2f} ms "
+              f"queue={stage['queue_depth']} dropped={stage['dropped']} errors={stage['errors']}", file=sys.stderr)
+
+
+def print_source_stats(manager):
+    """Print one line of statistics per camera to stderr"""
+    for source, camera in zip(manager.sources, manager.cameras):
+        stats = manager.stats[source].as_dict()
+        print(f"{str(source):>10}: {stats['fps']:6.1f} fps {stats['mean_latency_ms']:7.2f} ms "
+              f"camera dropped={camera.dropped_frames} errors={stats['errors']}", file=sys.stderr)
+    for source, motion_gate in zip(manager.sources, manager.gates):
+        print_gate_stats(str(source), motion_gate)
+
+
+def detection_profile(args, K=None):
+    """Create the DetectionProfile selected on the command line"""
+    kwargs = dict(PROFILES[args.detect_profile])
+    if args.detect_downscale:
+        kwargs['downscale'] = args.detect_downscale
+
+    if args.face_distance is None:
+        return DetectionProfile(**kwargs)
+
+    focal_length = args.focal_length or (K[0, 0] if K is not None else None)
+    assert focal_length, "--face-distance needs --focal-length or a --calibration"
+    min_distance, max_distance = args.face_distance
+    return DetectionProfile.from_camera_geometry(focal_length, min_distance, max_distance, **kwargs)
+
+
+def create_sinks(args):
+    """Create the output sinks selected on the command line"""
+    sinks = list()
+    for sink in args.sink:
+        if sink == 'none':
+            sinks.append(NullSink())
+        elif sink == 'preview':
+            sinks.append(PreviewSink())
+        elif sink == 'video':
+            sinks.append(VideoFileSink(args.video_out, fps=args.video_fps))
+        elif sink == 'json':
+            sinks.append(JsonEventSink(args.events_out))
+    return SinkGroup(sinks)
+
+
+def parse_source(source):
+    """Camera indices are given as integers, anything else is a video file"""
+    return int(source) if source.isdigit() else source
 
 
 if __name__ == "__main__":
-    # Initialize FaceDetector
-    face_detector = FaceDetector()
-
-    # Initialize FaceRecognizer
-    face_space_dict = load_facespace_dict('./data/faces/facespace.pkl')
-    facespace = face_space_dict['facespace']
-    mean_face = face_space_dict['mean_face']
-
-    # Initialize empty known face dictionary
-    known_face_dict = dict()
-    face_recognizer = FaceRecognizer(mean_face, facespace, known_face_dict, thresh=6000, contrast_coeff=1, brightness_coeff=100)
-
-    # Open and Start Camera
-    cam = CameraStream()
-
-    # Continuous stream of input
-    while True:
-        # Get next frame
-        current_frame = cam.next_frame()
-
-        # Detect faces in current frame
-        nb_faces, bboxes, faces = face_detector.detectFaces(current_frame)
-
-        # Set unknown flag to false
-        unknown = False
-
-        # Iterate through Detections
-        for bbox, face in zip(bboxes, faces):
-            resized = cv2.resize(face, (64,64))
-            name = face_recognizer.recognize(resized)
-
-            # If face was recogized
-            if name:
-                print(f'{name} found')
-                # Draw Frame of found face
-                draw_detection_with_label(current_frame, bbox, name, known=True)
-            # If unknown
-            else:
-                draw_detection_with_label(current_frame, bbox, 'UNKNOWN', known=False)
-                unknown = True
-
-        # Show Current frame with detections and labels
-        cv2.imshow('Face Detections', current_frame)
-        cv2.waitKey(1)
-
-        # Allow user to add uknown face as known
-        if unknown:
-            ans = input('Add face to list of known faces? [y/n]: ')
-            if ans[0].lower() == 'y':
-                name = input('Input Name: ')
-                face_recognizer.add_known_face(name, resized)
-
-        cv2.destroyAllWindows()
+    args = parser.parse_args()
+    sources = [parse_source(source) for source in args.camera]
+
+    timer = StartupTimer(STARTED)
+    timer.record('imports', IMPORTED - STARTED)
+
+    # Metrics only record anything once an exporter is enabled
+    metrics_server, metrics_logger = None, None
+    if args.metrics_port:
+        metrics_server = MetricsServer(host=args.metrics_host, port=args.metrics_port)
+    if args.metrics_log_interval:
+        logging.basicConfig(level=logging.INFO)
+        metrics_logger = MetricsLogger(args.metrics_log_interval)
+
+    camera_kwargs = dict(undistort_fisheye=bool(args.calibration) and not args.roi_undistort,
+                         calibration_file=args.calibration)
+    gate_kwargs = None
+    if args.motion_gate:
+        gate_kwargs = dict(method=args.motion_gate, pixel_thresh=args.motion_thresh,
+                           min_area=args.motion_min_area, hold_frames=args.motion_hold)
+    K = load_calibration_coefficients(args.calibration).get('K') if args.calibration else None
+    profile = detection_profile(args, K)
+    tracker_kwargs = None
+    if args.track:
+        tracker_kwargs = dict(motion=args.track_motion, recognize_every=args.recognize_every)
+
+    # Detection threads submit frames to one shared pool of processes
+    parallel_detector = None
+    if args.detect_processes:
+        parallel_detector = ParallelFaceDetector(args.detect_processes, profile=profile, tiles=args.detect_tiles)
+
+    # FaceRecognizer with the known faces saved in the model, loaded while the cameras open
+    cache = None
+    if args.embedding_cache > 0:
+        cache = EmbeddingCache(args.embedding_cache, ttl=args.cache_ttl, key=args.cache_key)
+    tasks = dict(model=lambda: FaceRecognizer.from_model(args.facespace, save_gallery=not args.no_save_gallery,
+                                                         precision=args.precision, thresh=6000, contrast_coeff=1,
+                                                         brightness_coeff=100, cache=cache))
+    if len(sources) > 1:
+        for i, source in enumerate(sources):
+            tasks[f'camera {i}'] = lambda source=source: CameraStream(source, threaded=True, **camera_kwargs)
+    else:
+        tasks['camera'] = lambda: CameraStream(sources[0], threaded=not args.no_grabber, **camera_kwargs)
+        if parallel_detector is None:
+            tasks['cascade'] = lambda: FaceDetector(profile=profile)
+    started = timer.run_concurrently(**tasks)
+
+    face_recognizer = started['model']
+    register_gallery(face_recognizer)
+    face_shape = face_recognizer.img_shape[::-1]
+    cameras = [started[f'camera {i}'] for i in range(len(sources))] if len(sources) > 1 else [started['camera']]
+    face_detector = parallel_detector or started.get('cascade')
+
+    # The first real frame does not pay for lazy initialization, and is not skewed in the metrics
+    if not args.no_warm_up:
+        with timer.phase('warm-up'):
+            warm_up(face_detector, face_recognizer, cameras=cameras)
+    if args.metrics_port or args.metrics_log_interval:
+        REGISTRY.enable()
+    if metrics_logger is not None:
+        metrics_logger.start()
+
+    if len(sources) > 1:
+        # Several cameras share one pool of detection and recognition workers
+        manager = MultiCameraManager(sources, face_recognizer, workers=args.detect_workers,
+                                     fps_targets=args.fps, detector_kwargs=dict(profile=profile),
+                                     detector=parallel_detector, camera_kwargs=camera_kwargs,
+                                     gate_kwargs=gate_kwargs, tracker_kwargs=tracker_kwargs,
+                                     face_shape=face_shape, cameras=cameras)
+        commands = CommandChannel(manager.enroll, args.commands)
+        processed = manager
+
+        def stop():
+            manager.stop()
+            if parallel_detector is not None:
+                parallel_detector.close()
+
+        report_stats = lambda: print_source_stats(manager)
+    else:
+        cam = cameras[0]
+
+        enrollments = queue.Queue()
+        commands = CommandChannel(lambda name, face: enrollments.put((name, face)), args.commands)
+
+        motion_gate = MotionGate(**gate_kwargs) if gate_kwargs is not None else None
+        tracker = FaceTracker(face_recognizer, **tracker_kwargs) if tracker_kwargs is not None else None
+        if tracker is not None and args.detect_workers > 1:
+            logging.warning("--track needs frames in order, detecting on one thread, use --detect-processes to parallelize")
+        pipeline = build_pipeline(cam, face_detector, face_recognizer, enrollments, args, motion_gate, tracker)
+        pipeline.start()
+        processed = pipeline
+
+        def stop():
+            pipeline.stop()
+            cam.stop()
+            if parallel_detector is not None:
+                parallel_detector.close()
+
+        report_stats = lambda: print_stats(pipeline.stats(), cam, motion_gate)
+
+    sinks = create_sinks(args)
+    commands.start()
+
+    last_frame_ids = dict()
+    last_stats = time.monotonic()
+
+    # Reported on stderr, stdout may carry JSON events
+    print(timer.report(), file=sys.stderr)
+    first_frame = True
+
+    # Continuous stream of processed frames, no GUI or terminal I/O unless a sink needs it
+    try:
+        while not commands.quit_requested.is_set():
+            try:
+                packet = processed.get(timeout=1)
+            except TimeoutError:
+                continue
+            except Closed:
+                break
+
+            # Parallel detection can reorder frames, never show an older frame
+            if packet.frame_id < last_frame_ids.get(packet.source, -1):
+                continue
+            last_frame_ids[packet.source] = packet.frame_id
+            if first_frame:
+                print(f"First frame processed {timer.elapsed:.3f}s after start", file=sys.stderr)
+                first_frame = False
+
+            # Unknown faces can be enrolled with commands
+            track_ids = packet.track_ids or [None]*len(packet.faces)
+            for face, name, track_id in zip(packet.faces, packet.names, track_ids):
+                if not name:
+                    commands.offer(face, packet.source, track_id)
+
+            sinks.write(packet)
+            if not sinks.poll():
+                break
+
+            if args.stats_interval and time.monotonic() - last_stats >= args.stats_interval:
+                report_stats()
+                if cache is not None:
+                    print(f"embedding cache: {cache.stats()}", file=sys.stderr)
+                last_stats = time.monotonic()
+    finally:
+        stop()
+        sinks.close()
+        if metrics_logger is not None:
+            metrics_logger.stop()
+        if metrics_server is not None:
+            metrics_server.close()
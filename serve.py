@@ -0,0 +1,77 @@
+""" Serve face detection and recognition to other processes of the box
+
+Usage: python serve.py --port 8080
+       python serve.py --unix-socket /run/pybell.sock
+
+       curl --data-binary @door.jpg -H 'Content-Type: image/jpeg' localhost:8080/recognize
+
+Concurrent requests share one loaded facespace and gallery, and are grouped into batches
+processed on an executor, see components/service.py for the endpoints.
+"""
+import argparse
+import asyncio
+import signal
+
+from components.face_detector import PROFILES
+from components.face_recognizer import FaceRecognizer, register_gallery
+from components.metrics import REGISTRY, MetricsServer
+from components.parallel_detector import ParallelFaceDetector
+from components.service import FaceService
+from components.util.projection import PRECISIONS
+
+parser = argparse.ArgumentParser(description="Serve face detection and recognition over local HTTP")
+
+parser.add_argument("--host", default='127.0.0.1', help="Address to listen on")
+parser.add_argument("--port", type=int, default=8080, help="TCP port to listen on")
+parser.add_argument("--unix-socket", default=None, dest="unix_socket", help="Listen on this Unix socket instead of TCP")
+parser.add_argument("--facespace", default='./data/faces/facespace', help="Model directory written by extract_facespace.py, or legacy facespace pickle file")
+parser.add_argument("--precision", choices=PRECISIONS, default=None, help="Projection precision, the storage type of the facespace if omitted")
+parser.add_argument("--thresh", type=float, default=6000, help="Distance under which a face is recognized as its closest known face")
+parser.add_argument("--save-gallery", action="store_true", dest="save_gallery", help="Save faces enrolled by clients to the model directory")
+parser.add_argument("--workers", type=int, default=None, help="Executor threads, i.e. batches processed at once, all cores if omitted")
+parser.add_argument("--detect-processes", type=int, default=0, dest="detect_processes", help="Detect on a shared pool of processes instead of in the executor threads")
+parser.add_argument("--detect-profile", choices=list(PROFILES), default='accurate', dest="detect_profile", help="Cascade search profile, faster profiles detect on a downscaled frame")
+parser.add_argument("--max-batch", type=int, default=16, dest="max_batch", help="Maximum number of requests per batch")
+parser.add_argument("--batch-window-ms", type=float, default=2, dest="batch_window_ms", help="Milliseconds to wait for more requests to join a batch")
+parser.add_argument("--max-pending", type=int, default=64, dest="max_pending", help="Requests waiting for a batch before new ones are rejected with 503")
+parser.add_argument("--deadline-ms", type=float, default=1000, dest="deadline_ms", help="Default request deadline, requests may set X-Deadline-Ms")
+parser.add_argument("--metrics-port", type=int, default=0, dest="metrics_port", help="Serve Prometheus metrics on this local port, 0 to disable")
+
+
+async def serve(service, args):
+    await service.start(args.host, args.port, args.unix_socket)
+    print(f"Serving on {service.address}")
+
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stopped.set)
+    await stopped.wait()
+    await service.close()
+
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+
+    metrics_server = None
+    if args.metrics_port:
+        REGISTRY.enable()
+        metrics_server = MetricsServer(port=args.metrics_port)
+
+    recognizer = FaceRecognizer.from_model(args.facespace, save_gallery=args.save_gallery, precision=args.precision,
+                                           thresh=args.thresh, contrast_coeff=1, brightness_coeff=100)
+    register_gallery(recognizer)
+    detector = None
+    if args.detect_processes:
+        detector = ParallelFaceDetector(args.detect_processes, profile=args.detect_profile)
+
+    service = FaceService(recognizer, detector, profile=args.detect_profile, workers=args.workers,
+                          max_batch=args.max_batch, batch_window=args.batch_window_ms/1000,
+                          max_pending=args.max_pending, deadline=args.deadline_ms/1000)
+    try:
+        asyncio.run(serve(service, args))
+    finally:
+        if detector is not None:
+            detector.close()
+        if metrics_server is not None:
+            metrics_server.close()
@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from benchmarks.synthetic import synthetic_clip, write_clip
+from components.batch import BatchResults, find_media, plan_video, process_media
+from components.util.model import append_gallery, save_model
+
+class TestBatchProcessing(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        cls.model = os.path.join(cls.folder, 'model')
+        save_model(cls.model, np.linalg.qr(rng.randn(64*64, 10))[0].T, rng.rand(64*64)*255, (64, 64))
+
+        cls.frames, cls.truth = synthetic_clip((240, 320), 30, n_faces=1, size=80)
+        cls.media = os.path.join(cls.folder, 'media')
+        os.makedirs(os.path.join(cls.media, 'dump'))
+        write_clip(os.path.join(cls.media, 'door.avi'), cls.frames, fps=10)
+        for i in (0, 7):
+            cv2.imwrite(os.path.join(cls.media, 'dump', f'{i}.png'), cls.frames[i])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def setUp(self):
+        self.results = BatchResults(os.path.join(tempfile.mkdtemp(dir=self.folder), 'results.db'))
+
+    def tearDown(self):
+        self.results.close()
+
+    def process(self, workers=0, **kwargs):
+        return process_media([self.media], self.results, self.model, workers=workers, chunk_frames=8, **kwargs)
+
+    def test_find_media_and_plan_chunks(self):
+        videos, images = find_media([self.media])
+        self.assertEqual([os.path.basename(v) for v in videos], ['door.avi'])
+        self.assertEqual([os.path.basename(i) for i in images], ['0.png', '7.png'])
+
+        units = plan_video(videos[0], start=0.5, stride=3, chunk_frames=8)
+        self.assertEqual([(u.start, u.end) for u in units], [(5, 11), (11, 17), (17, 23), (23, 29), (29, 30)])
+
+    def test_faces_of_every_frame_are_indexed(self):
+        stats = self.process()
+        self.assertEqual(stats['frames'], 32)
+        self.assertEqual(stats['units'], 6)
+
+        rows = self.results.faces(source=os.path.join(self.media, 'door.avi'))
+        self.assertGreaterEqual(len(rows), 25)
+        for source, frame, timestamp, x, y, w, h, name, distance in rows:
+            tx, ty, size, _ = self.truth[frame][0]
+            self.assertAlmostEqual(timestamp, frame/10)
+            self.assertLess(abs(x + w/2 - tx - size/2), size/4)
+            self.assertIsNone(name)
+            self.assertIsNone(distance)
+
+    def test_resume_only_processes_missing_units(self):
+        self.process(start=1.6)
+        first = self.results.faces()
+        stats = self.process(start=1.6)
+
+        self.assertEqual(stats['frames'], 0)
+        self.assertEqual(stats['skipped'], stats['units'])
+        self.assertEqual(self.results.faces(), first)
+
+        with self.assertRaises(AssertionError):
+            self.process(start=1.6, stride=2)
+
+    def test_gallery_change_prevents_resuming(self):
+        rng = np.random.RandomState(1)
+        model = os.path.join(tempfile.mkdtemp(dir=self.folder), 'model')
+        save_model(model, np.linalg.qr(rng.randn(64*64, 10))[0].T, rng.rand(64*64)*255, (64, 64))
+        process_media([self.media], self.results, model, workers=0, chunk_frames=8, start=1.6)
+
+        append_gallery(model, ['Visitor'], rng.randn(1, 10))
+        with self.assertRaises(AssertionError):
+            process_media([self.media], self.results, model, workers=0, chunk_frames=8, start=1.6)
+
+    def test_stride_and_pool(self):
+        stats = self.process(workers=2, stride=4)
+        self.assertEqual(stats['frames'], 8 + 2)
+        frames = {frame for source, frame, *_ in self.results.faces() if source.endswith('.avi')}
+        self.assertTrue(frames <= set(range(0, 30, 4)))
+
+if __name__ == "__main__":
+    unittest.main()
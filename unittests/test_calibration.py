@@ -0,0 +1,67 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from benchmarks.synthetic import synthetic_calibration_views, synthetic_chessboard
+from components.util.camera import (find_chessboard_corners, find_corners_in_files, calibrate_fisheye,
+                                    calculate_calibration_coefficients, save_calibration_coefficients,
+                                    load_calibration_coefficients)
+
+class TestCalibration(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.images, cls.K, cls.D = synthetic_calibration_views(12, shape=(480, 640))
+
+    def test_downscaled_corners_are_refined_at_full_resolution(self):
+        img, truth = synthetic_chessboard((960, 1280), (7, 7), self.K*[[2], [2], [1]], self.D,
+                                          [0.2, -0.1, 0.05], [-3, -3, 9])
+        corners = find_chessboard_corners(img, downscale=0.5).reshape(7, 7, 2)
+
+        # The detected corner order can start from any corner of the symmetric board
+        orders = [corners, corners[::-1, ::-1], corners[::-1], corners[:, ::-1]]
+        orders += [c.transpose(1, 0, 2) for c in orders]
+        error = min(np.abs(c - truth.reshape(7, 7, 2)).max() for c in orders)
+        self.assertLess(error, 0.3)
+
+    def test_calibration_uses_every_view(self):
+        image_points = [find_chessboard_corners(img) for img in self.images]
+        image_points = [corners for corners in image_points if corners is not None]
+        K, D, rms, used = calibrate_fisheye(image_points, (640, 480))
+
+        self.assertGreaterEqual(len(image_points), 10)
+        self.assertEqual(len(used), len(image_points))
+        self.assertLess(rms, 0.5)
+        np.testing.assert_allclose(K, self.K, rtol=0.01, atol=2)
+        self.assertEqual(D.shape, (1, 4))
+
+    def test_calculate_calibration_coefficients(self):
+        K, _ = calculate_calibration_coefficients(self.images)
+        np.testing.assert_allclose(K, self.K, rtol=0.01, atol=2)
+
+    def test_corners_in_files_and_saved_calibration(self):
+        folder = tempfile.mkdtemp()
+        try:
+            paths = list()
+            for i, img in enumerate(self.images[:4]):
+                paths.append(os.path.join(folder, f'{i}.png'))
+                cv2.imwrite(paths[-1], img)
+            cv2.imwrite(os.path.join(folder, 'blank.png'), np.full((480, 640), 128, dtype=np.uint8))
+
+            views, image_size = find_corners_in_files(paths + [os.path.join(folder, 'blank.png')], processes=2)
+            self.assertEqual(image_size, (640, 480))
+            self.assertEqual([path for path, _ in views], paths)
+
+            calibration_file = os.path.join(folder, 'calibration.pkl')
+            save_calibration_coefficients(self.K, self.D, calibration_file, rms=0.1)
+            calibration = load_calibration_coefficients(calibration_file)
+            np.testing.assert_array_equal(calibration['K'], self.K)
+            self.assertEqual(calibration['rms'], 0.1)
+        finally:
+            shutil.rmtree(folder)
+
+if __name__ == "__main__":
+    unittest.main()
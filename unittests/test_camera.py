@@ -0,0 +1,104 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import numpy as np
+import cv2
+
+from benchmarks.synthetic import write_clip
+from components.camera import CameraStream
+import components.util.camera as util
+
+K = np.array([[300., 0., 320.], [0., 300., 240.], [0., 0., 1.]])
+D = np.array([[0.1], [-0.05], [0.01], [0.]])
+
+class TestCameraStream(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.folder = tempfile.mkdtemp()
+        cls.clip = os.path.join(cls.folder, 'clip.avi')
+        write_clip(cls.clip, [np.full((48, 64), 20*i, dtype=np.uint8) for i in range(10)])
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.folder)
+
+    def finished(self, cam):
+        """Camera whose grabber read the whole clip"""
+        while cam.grabbing:
+            time.sleep(0.01)
+        return cam
+
+    def test_synchronous_reads_return_every_frame(self):
+        cam = CameraStream(self.clip)
+        self.assertEqual([frame.frame_id for frame in cam], list(range(10)))
+        self.assertEqual(cam.dropped_frames, 0)
+        cam.stop()
+
+    def test_grabber_returns_newest_frame_and_counts_dropped(self):
+        cam = self.finished(CameraStream(self.clip, threaded=True, buffer_size=4))
+        self.assertEqual(len(cam.frames), 4)
+
+        frame = cam.latest_frame(timeout=1)
+        self.assertEqual(frame.frame_id, 9)
+        self.assertEqual(frame.image.shape[:2], (48, 64))
+        self.assertEqual(cam.dropped_frames, 9)
+        # The newest frame is only returned once, then the ended capture returns None
+        self.assertIsNone(cam.latest_frame(timeout=1))
+        cam.stop()
+
+    def test_async_iteration_ends_with_the_capture(self):
+        async def collect(cam):
+            return [frame.frame_id async for frame in cam]
+
+        cam = CameraStream(self.clip, threaded=True)
+        frame_ids = asyncio.run(collect(cam))
+        cam.stop()
+
+        self.assertEqual(frame_ids, sorted(set(frame_ids)))
+        self.assertEqual(frame_ids[-1], 9)
+        self.assertEqual(cam.dropped_frames, 10 - len(frame_ids))
+
+class TestUndistortMaps(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        util._undistort_maps.clear()
+
+    def tearDown(self):
+        util._undistort_maps.clear()
+        shutil.rmtree(self.folder)
+
+    def test_maps_are_cached_in_memory_and_on_disk(self):
+        cache_file = util.undistort_maps_file(os.path.join(self.folder, 'calibration.pkl'), (640, 480))
+        maps = util.get_undistort_maps(K, D, (640, 480), new_K=K, cache_file=cache_file)
+        self.assertTrue(os.path.exists(cache_file))
+        self.assertIs(util.get_undistort_maps(K, D, (640, 480), new_K=K, cache_file=cache_file), maps)
+
+        util._undistort_maps.clear()
+        loaded = util.get_undistort_maps(K, D, (640, 480), new_K=K, cache_file=cache_file)
+        np.testing.assert_array_equal(loaded[0], maps[0])
+        np.testing.assert_array_equal(loaded[1], maps[1])
+
+        # Maps of another calibration are recomputed, not loaded
+        other = util.get_undistort_maps(K, D*2, (640, 480), new_K=K, cache_file=cache_file)
+        self.assertFalse(np.array_equal(other[0], maps[0]))
+
+    def test_roi_matches_full_undistorted_frame(self):
+        rng = np.random.RandomState(0)
+        img = cv2.resize(rng.randint(0, 256, (60, 80)).astype(np.uint8), (640, 480))
+        maps = util.get_undistort_maps(K, D, (640, 480), new_K=K)
+        full = cv2.remap(img, maps[0], maps[1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT)
+
+        roi = util.undistort_roi(img, (400, 300, 100, 80), maps, K, D, new_K=K)
+        self.assertLess(roi.size, full.size // 8)
+        self.assertGreaterEqual(roi.shape[0], 80)
+        self.assertGreaterEqual(roi.shape[1], 100)
+        # The region is a crop of the undistorted frame
+        match = cv2.matchTemplate(full, roi, cv2.TM_SQDIFF)
+        self.assertEqual(match.min(), 0)
+
+if __name__ == "__main__":
+    unittest.main()
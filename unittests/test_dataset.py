@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from components.util.dataset import pack_faces, open_faces
+from components.util.image import load_images_from_folder
+
+class TestPackedDataset(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.folder = os.path.join(self.tmp, 'faces')
+        self.dataset = os.path.join(self.tmp, 'faces.pack')
+        os.makedirs(self.folder)
+        self.rng = np.random.RandomState(0)
+        for i in range(5):
+            self.write_face(i)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write_face(self, i):
+        cv2.imwrite(os.path.join(self.folder, f'{i:02d}.png'), self.rng.randint(0, 256, (16, 16)).astype(np.uint8))
+
+    def test_packed_faces_match_folder(self):
+        stats = pack_faces(self.folder, self.dataset)
+        self.assertEqual((stats['faces'], stats['decoded']), (5, 5))
+
+        dataset = open_faces(self.dataset)
+        self.assertIsInstance(dataset.faces, np.memmap)
+        self.assertEqual(dataset.shape, (16, 16))
+        self.assertEqual(dataset.paths, [f'{i:02d}.png' for i in range(5)])
+        np.testing.assert_array_equal(dataset.faces, np.array(load_images_from_folder(self.folder)))
+        self.assertEqual([len(b) for b in dataset.batches(2, max_number=3)], [2, 1])
+
+    def test_repack_only_decodes_changed_files(self):
+        pack_faces(self.folder, self.dataset)
+        os.remove(os.path.join(self.folder, '01.png'))
+        self.write_face(7)
+        self.write_face(2)
+        os.utime(os.path.join(self.folder, '02.png'), (0, 12345))
+
+        stats = pack_faces(self.folder, self.dataset)
+
+        self.assertEqual(stats, {'faces': 5, 'reused': 3, 'decoded': 2, 'removed': 1, 'unreadable': 0})
+        dataset = open_faces(self.dataset)
+        self.assertEqual(dataset.paths, ['00.png', '02.png', '03.png', '04.png', '07.png'])
+        np.testing.assert_array_equal(dataset.faces, np.array(load_images_from_folder(self.folder)))
+
+    def test_unreadable_images_are_not_packed(self):
+        with open(os.path.join(self.folder, '03.png'), 'w') as f:
+            f.write('not an image')
+
+        stats = pack_faces(self.folder, self.dataset, shape=(8, 8))
+
+        self.assertEqual((stats['faces'], stats['unreadable']), (4, 1))
+        dataset = open_faces(self.dataset)
+        self.assertEqual(dataset.faces.shape, (4, 8, 8))
+        self.assertNotIn('03.png', dataset.paths)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+import unittest
+
+import numpy as np
+
+from components.face_detector import FaceDetector, DetectionProfile
+
+class FixedCascade:
+    """Stands in for the cascade, returning the same boxes and recording the searched image"""
+    def __init__(self, bboxes):
+        self.bboxes = np.array(bboxes, dtype=np.int32)
+        self.calls = list()
+
+    def detectMultiScale(self, img, **kwargs):
+        self.calls.append((img.shape, kwargs))
+        return self.bboxes
+
+class TestDetectionProfile(unittest.TestCase):
+    def test_face_sizes_from_camera_geometry(self):
+        profile = DetectionProfile.from_camera_geometry(400, 0.5, 2.0, face_width=0.15)
+        self.assertEqual(profile.min_size, (30, 30))
+        self.assertEqual(profile.max_size, (120, 120))
+
+    def test_cascade_sizes_are_downscaled(self):
+        profile = DetectionProfile(min_size=(40, 40), max_size=(101, 101), downscale=0.5)
+        kwargs = profile.cascade_kwargs()
+        self.assertEqual(kwargs['minSize'], (20, 20))
+        self.assertEqual(kwargs['maxSize'], (51, 51))
+        self.assertNotIn('minSize', DetectionProfile().cascade_kwargs())
+
+    def test_downscaled_detections_are_rescaled(self):
+        detector = FaceDetector(profile=DetectionProfile(downscale=0.5))
+        detector.cf = FixedCascade([(10, 20, 30, 30), (70, 40, 20, 20)])
+        img = np.zeros((100, 160), dtype=np.uint8)
+
+        count, bboxes, faces = detector.detectFaces(img)
+
+        self.assertEqual(detector.cf.calls[0][0], (50, 80))
+        self.assertEqual(count, 2)
+        np.testing.assert_array_equal(bboxes, [(20, 40, 60, 60), (140, 80, 20, 20)])
+        self.assertEqual(faces[1].shape, (20, 20))
+
+    def test_gray_is_reused(self):
+        detector = FaceDetector()
+        detector.cf = FixedCascade([])
+        gray = np.zeros((100, 160), dtype=np.uint8)
+        detector.detectFaces(np.zeros((100, 160, 3), dtype=np.uint8), gray=gray)
+        self.assertEqual(detector.cf.calls[0][0], (100, 160))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+
+import numpy as np
+
+from components.util.eigenfaces import pca, extract_facespace, extract_facespace_streaming, streaming_batch_size
+
+class TestStreamingFacespace(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        # Faces varying mostly along a few directions, like real faces
+        basis = rng.randn(5, 12*12)*40
+        self.faces = np.clip(128 + rng.randn(300, 5).dot(basis) + rng.randn(300, 12*12)*2,
+                             0, 255).astype(np.uint8).reshape(300, 12, 12)
+        self.facespace, self.mean_face = extract_facespace(self.faces, 5)
+
+    def batches(self, size):
+        return (self.faces[i:i+size] for i in range(0, len(self.faces), size))
+
+    def assertSameSubspace(self, facespace):
+        # Rows match up to their sign
+        np.testing.assert_allclose(np.abs(np.sum(facespace*self.facespace, axis=1)), 1, atol=1e-3)
+
+    def test_covariance_matches_pca(self):
+        facespace, mean_face = extract_facespace_streaming(self.batches(64), 5, 'covariance')
+        np.testing.assert_allclose(mean_face, self.mean_face)
+        self.assertSameSubspace(facespace)
+
+    def test_randomized_matches_pca(self):
+        facespace, mean_face = extract_facespace_streaming(self.batches(64), 5, 'randomized')
+        np.testing.assert_allclose(mean_face, self.mean_face)
+        self.assertSameSubspace(facespace)
+
+    def test_incremental_matches_pca(self):
+        seen = list()
+        facespace, mean_face = extract_facespace_streaming(self.batches(7), 5, 'incremental', progress=seen.append)
+        self.assertEqual(seen[-1], 300)
+        np.testing.assert_allclose(mean_face, self.mean_face)
+        self.assertSameSubspace(facespace)
+
+    def test_svd_pca_matches(self):
+        facespace, mean_face = pca(self.faces.reshape(300, -1).astype(np.float64), 5)
+        np.testing.assert_allclose(mean_face, self.mean_face)
+        self.assertSameSubspace(facespace)
+
+    def test_batch_size_fits_budget(self):
+        self.assertEqual(streaming_batch_size(4096, 250, 'covariance', memory_mb=512), 2048)
+        with self.assertRaises(AssertionError):
+            streaming_batch_size(4096, 250, 'covariance', memory_mb=256)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+import time
+import unittest
+
+import numpy as np
+
+from components.embedding_cache import EmbeddingCache
+from components.face_recognizer import FaceRecognizer
+from components.tracker import FaceTracker
+from components.util.image import dhash
+
+class TestEmbeddingCache(unittest.TestCase):
+    def test_ttl_expiry(self):
+        cache = EmbeddingCache(ttl=0.05)
+        cache.put('a', np.zeros(3), 0, 'alice', 1.0)
+        self.assertEqual(cache.get('a').name, 'alice')
+        time.sleep(0.1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual((cache.hits, cache.misses, cache.evictions), (1, 1, 1))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = EmbeddingCache(max_size=2)
+        cache.put('a', np.zeros(3), 0, 'alice', 1.0)
+        cache.put('b', np.zeros(3), 0, 'bob', 1.0)
+        cache.get('a')
+        cache.put('c', np.zeros(3), 0, 'carol', 1.0)
+
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('a'))
+        self.assertEqual(cache.evictions, 1)
+
+    def test_dhash_is_stable_under_small_noise(self):
+        rng = np.random.RandomState(0)
+        face = blocky(rng.randint(0, 256, (64, 64)).astype(np.uint8))
+        noisy = np.clip(face + rng.randint(-2, 3, face.shape), 0, 255).astype(np.uint8)
+        other = blocky(rng.randint(0, 256, (64, 64)).astype(np.uint8))
+
+        self.assertEqual(len(dhash(face)), 8)
+        self.assertEqual(dhash(face), dhash(noisy))
+        self.assertNotEqual(dhash(face), dhash(other))
+
+def blocky(img):
+    """Blocky image whose hash does not depend on single pixel noise"""
+    return np.kron(img[::8, ::8], np.ones((8, 8), dtype=np.uint8))
+
+class TestCachedRecognition(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.mean_face = rng.rand(16*16)*255
+        self.facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(5)]
+        self.cache = EmbeddingCache(ttl=None)
+        self.recognizer = FaceRecognizer(self.mean_face, self.facespace, dict(), img_shape=(16,16),
+                                         thresh=10, cache=self.cache)
+        self.recognizer.add_known_faces(['a', 'b', 'c'], self.faces[:3])
+
+    def count_projections(self):
+        projected = list()
+        project = self.recognizer._project_batch_to_facespace
+        def counting(faces):
+            projected.extend(faces)
+            return project(faces)
+        self.recognizer._project_batch_to_facespace = counting
+        return projected
+
+    def test_results_equal_uncached_results(self):
+        uncached = FaceRecognizer(self.mean_face, self.facespace, dict(), img_shape=(16,16), thresh=10)
+        uncached.add_known_faces(['a', 'b', 'c'], self.faces[:3])
+        expected_names, expected_distances = uncached.nearest_batch(self.faces)
+
+        for _ in range(2):
+            names, distances = self.recognizer.nearest_batch(self.faces)
+            self.assertEqual(names, expected_names)
+            np.testing.assert_allclose(distances, expected_distances, rtol=1e-5, atol=1e-3)
+
+    def count_searches(self):
+        searched = list()
+        search = self.recognizer._search
+        def counting(projections):
+            searched.extend(projections)
+            return search(projections)
+        self.recognizer._search = counting
+        return searched
+
+    def test_hits_skip_projection_and_search(self):
+        projected, searched = self.count_projections(), self.count_searches()
+        self.recognizer.nearest_batch(self.faces)
+        names, _ = self.recognizer.recognize_batch(self.faces[:2] + [self.faces[4].copy()])
+
+        self.assertEqual(len(projected), 5)
+        self.assertEqual(len(searched), 5)
+        self.assertEqual(self.cache.hits, 3)
+        self.assertEqual(names, ['a', 'b', None])
+
+    def test_hash_collision_is_not_matched_as_the_cached_face(self):
+        # Entry of another face stored under the hash of faces[0]
+        self.cache.put(self.cache.key_of(self.faces[0]), np.zeros(10), self.recognizer._gallery_version,
+                       'c', 0.0, self.faces[2])
+        names, distances = self.recognizer.nearest_batch(self.faces[:1])
+
+        self.assertEqual(names, ['a'])
+        self.assertEqual(self.cache.misses, 1)
+        self.assertIsNotNone(self.cache.get(self.cache.key_of(self.faces[0]), self.faces[0]))
+
+    def test_track_ids_key_faces_by_track(self):
+        self.cache.key = 'track'
+        projected = self.count_projections()
+        self.recognizer.nearest_batch(self.faces[:2], track_ids=[1, 2])
+        names, _ = self.recognizer.recognize_batch([self.faces[0], self.faces[3]], track_ids=[1, 2])
+
+        # Track 2 now shows another face, it is recognized again
+        self.assertEqual(len(projected), 3)
+        self.assertEqual(names, ['a', None])
+
+    def test_tracker_rechecks_hit_unchanged_faces(self):
+        self.cache.key = 'track'
+        tracker = FaceTracker(self.recognizer, recognize_every=2, smoothing=1.0)
+        frame = np.zeros((120, 160), dtype=np.uint8)
+        tracks = tracker.update(frame, [(10, 10, 30, 30)], self.faces[:1])
+        self.assertEqual(tracks[0].name, 'a')
+
+        searched = self.count_searches()
+        for _ in range(2):
+            tracker.update(frame, [(10, 10, 30, 30)], self.faces[:1])
+        self.assertEqual((tracker.recognitions, len(searched), self.cache.hits), (2, 0, 1))
+
+        # The face of the track changed, the next recheck recognizes it
+        for _ in range(2):
+            tracks = tracker.update(frame, [(10, 10, 30, 30)], self.faces[1:2])
+        self.assertEqual(len(searched), 1)
+        self.assertIn('b', tracks[0].scores)
+
+    def test_gallery_change_invalidates_matches(self):
+        projected = self.count_projections()
+        names, _ = self.recognizer.recognize_batch(self.faces[3:])
+        self.assertEqual(names, [None, None])
+
+        self.recognizer.add_known_faces(['d'], self.faces[3:4])
+        names, _ = self.recognizer.recognize_batch(self.faces[3:])
+        self.assertEqual(names, ['d', None])
+        self.recognizer.remove_known_face('d')
+        names, _ = self.recognizer.recognize_batch(self.faces[3:])
+        self.assertEqual(names, [None, None])
+
+        # Projections stay valid, only the search is redone, the known face 'd' was projected once
+        self.assertEqual(len(projected), 3)
+
+    def test_cached_projections_are_not_overwritten_by_later_batches(self):
+        self.recognizer.nearest_batch(self.faces[3:])
+        expected = [self.cache.get(self.cache.key_of(face)).projection.copy() for face in self.faces[3:]]
+        self.recognizer.add_known_faces(['d'], self.faces[3:4])
+        self.recognizer.nearest_batch(self.faces)
+
+        for face, projection in zip(self.faces[3:], expected):
+            np.testing.assert_array_equal(self.cache.get(self.cache.key_of(face)).projection, projection)
+            np.testing.assert_allclose(projection, self.recognizer._project_to_facespace(face), rtol=1e-5)
+
+    def test_projection_change_clears_cache(self):
+        self.recognizer.nearest_batch(self.faces)
+        self.assertEqual(len(self.cache), 5)
+        self.recognizer.contrast_coeff = 2
+        self.assertEqual(len(self.cache), 0)
+
+if __name__ == "__main__":
+    unittest.main()
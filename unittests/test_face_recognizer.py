@@ -0,0 +1,108 @@
+import unittest
+
+import numpy as np
+
+from components.face_recognizer import FaceRecognizer
+from components.util.eigenfaces import distance_matrix
+
+class TestFaceRecognizerBatch(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.mean_face = rng.rand(16*16)*255
+        # Orthonormal basis, like the principal components of a facespace
+        self.facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(5)]
+        self.recognizer = FaceRecognizer(self.mean_face, self.facespace, dict(), img_shape=(16,16),
+                                         thresh=10)
+
+    def test_recognize_batch_empty_gallery_returns_unknown(self):
+        names, distances = self.recognizer.recognize_batch(self.faces)
+        self.assertEqual(names, [None]*5)
+        self.assertTrue(np.all(np.isinf(distances)))
+
+    def test_recognize_batch_no_faces(self):
+        names, distances = self.recognizer.recognize_batch([])
+        self.assertEqual(names, [])
+        self.assertEqual(distances.shape, (0,))
+
+    def test_recognize_batch_matches_single_face_distances(self):
+        projections = self.recognizer._project_batch_to_facespace(self.faces)
+        self.recognizer.add_known_faces(['a', 'b', 'c'], self.faces[:3])
+
+        names, distances = self.recognizer.recognize_batch(self.faces)
+
+        self.assertEqual(names[:3], ['a', 'b', 'c'])
+        self.assertEqual(names[3:], [None, None])
+        for i, projection in enumerate(projections):
+            expected = distance_matrix(projection, projections[:3]).min()
+            self.assertAlmostEqual(distances[i], expected, delta=max(1, 1e-4*expected))
+
+    def test_removed_face_is_not_recognized(self):
+        self.recognizer.add_known_faces(['a', 'b'], self.faces[:2])
+        self.assertEqual(self.recognizer.remove_known_face('a'), 1)
+
+        names, _ = self.recognizer.recognize_batch(self.faces[:2])
+        self.assertEqual(names, [None, 'b'])
+
+class TestFaceRecognizerPrecision(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.mean_face = rng.rand(16*16)*255
+        self.facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(5)]
+        self.reference = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16), thresh=10)
+
+    def test_precisions_match_float64_projections(self):
+        expected = self.reference._project_batch_to_facespace(self.faces)
+        for precision, rtol in [('float32', 1e-5), ('int8', 2e-2)]:
+            recognizer = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16), thresh=10,
+                                        precision=precision)
+            projections = recognizer._project_batch_to_facespace(self.faces)
+            self.assertEqual(projections.dtype, np.float32)
+            np.testing.assert_allclose(projections, expected, rtol=0, atol=rtol*np.abs(expected).max())
+
+    def test_int8_storage_and_recognition(self):
+        recognizer = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16), thresh=10,
+                                    precision='int8')
+        self.assertEqual(recognizer.facespace.dtype, np.int8)
+        self.assertEqual(recognizer.gallery.dtype, np.float32)
+
+        recognizer.add_known_faces(['a', 'b'], self.faces[:2])
+        names, _ = recognizer.recognize_batch(self.faces[:3])
+        self.assertEqual(names, ['a', 'b', None])
+
+class TestFaceRecognizerFusedProjection(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.mean_face = rng.rand(16*16)*255
+        self.facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = np.stack([rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(5)])
+
+    def expected(self, contrast, brightness):
+        adjusted = contrast*self.faces.reshape(5, -1).astype(np.float64) + brightness - self.mean_face
+        return np.matmul(adjusted, self.facespace.T)
+
+    def test_fused_projection_matches_adjusted_faces(self):
+        for precision, rtol in [('float64', 1e-10), ('float32', 1e-5), ('int8', 2e-2)]:
+            recognizer = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16),
+                                        contrast_coeff=1.3, brightness_coeff=20, precision=precision)
+            expected = self.expected(1.3, 20)
+            for faces in (self.faces, list(self.faces)):
+                projections = recognizer._project_batch_to_facespace(faces)
+                np.testing.assert_allclose(projections, expected, rtol=0, atol=rtol*np.abs(expected).max())
+
+    def test_changing_coefficients_updates_projection(self):
+        recognizer = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16))
+        recognizer.contrast_coeff = 0.8
+        recognizer.brightness_coeff = 70
+
+        np.testing.assert_allclose(recognizer._project_batch_to_facespace(self.faces), self.expected(0.8, 70))
+
+    def test_recognize_adjusts_faces_once(self):
+        recognizer = FaceRecognizer(self.mean_face, self.facespace, img_shape=(16,16), thresh=1e-6,
+                                    contrast_coeff=1.3, brightness_coeff=20)
+        recognizer.add_known_faces(['a'], self.faces[:1])
+        self.assertEqual(recognizer.recognize(self.faces[0]), 'a')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+
+import numpy as np
+
+from components.util.gallery import FaceGallery
+
+class TestFaceGallery(unittest.TestCase):
+    def test_add_grows_capacity_and_keeps_vectors(self):
+        gallery = FaceGallery(4, capacity=2)
+        vectors = np.arange(40, dtype=np.float32).reshape(10, 4)
+        for i, vector in enumerate(vectors):
+            ids = gallery.add([f'person{i % 3}'], vector)
+            self.assertEqual(list(ids), [i])
+
+        self.assertEqual(len(gallery), 10)
+        self.assertGreaterEqual(gallery.capacity, 10)
+        np.testing.assert_array_equal(gallery.vectors, vectors)
+        self.assertEqual(gallery.name(4), 'person1')
+
+    def test_remove_tombstones_all_faces_of_a_person(self):
+        gallery = FaceGallery(2)
+        gallery.add(['a', 'b', 'a'], np.zeros((3, 2)))
+
+        np.testing.assert_array_equal(gallery.remove('a'), [0, 2])
+        self.assertEqual(len(gallery), 1)
+        self.assertEqual(gallery.size, 3)
+        self.assertEqual(len(gallery.remove('unknown')), 0)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,137 @@
+import unittest
+
+import numpy as np
+
+from components.util.gallery import FaceGallery
+from components.util.gallery_index import create_index, BruteForceIndex
+
+class TestGalleryIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.gallery = rng.randn(600, 20)*np.linspace(10, 1, 20)
+        self.queries = self.gallery[:50] + rng.randn(50, 20)*0.1
+        self.brute = BruteForceIndex()
+        self.brute.add(self.gallery, np.arange(600))
+
+    def test_brute_force_finds_source_vector(self):
+        dist, ids = self.brute.search(self.queries, k=3)
+        self.assertEqual(dist.shape, (50, 3))
+        np.testing.assert_array_equal(ids[:, 0], np.arange(50))
+        self.assertTrue(np.all(np.diff(dist, axis=1) >= 0))
+
+    def test_empty_index_returns_no_neighbours(self):
+        dist, ids = BruteForceIndex().search(self.queries, k=2)
+        self.assertTrue(np.all(np.isinf(dist)))
+        self.assertTrue(np.all(ids == -1))
+
+    def test_brute_force_searches_gallery_in_place(self):
+        gallery = FaceGallery(20, dtype=np.float64)
+        index = BruteForceIndex(gallery)
+        ids = gallery.add([str(i % 300) for i in range(600)], self.gallery)
+        index.add(gallery.vectors[ids], ids)
+        self.assertEqual(len(index), 600)
+        for a, b in zip(index.search(self.queries, k=3), self.brute.search(self.queries, k=3)):
+            np.testing.assert_array_equal(a, b)
+
+        index.remove(gallery.remove('0'))
+        self.brute.remove([0, 300])
+        self.assertEqual(len(index), 598)
+        for a, b in zip(index.search(self.queries, k=3), self.brute.search(self.queries, k=3)):
+            np.testing.assert_array_equal(a, b)
+        np.testing.assert_array_equal(index.radius_search(self.queries[:1], 15.0)[0][0],
+                                      self.brute.radius_search(self.queries[:1], 15.0)[0][0])
+
+    def test_tree_indexes_are_exact_with_incremental_inserts(self):
+        expected_dist, expected_ids = self.brute.search(self.queries, k=5)
+        for kind in ('kdtree', 'balltree'):
+            index = create_index(kind, min_tree_size=100)
+            for start in range(0, 600, 7):
+                index.add(self.gallery[start:start+7], np.arange(start, min(start+7, 600)))
+
+            dist, ids = index.search(self.queries, k=5)
+            np.testing.assert_array_equal(ids, expected_ids)
+            np.testing.assert_allclose(dist, expected_dist, rtol=1e-6)
+
+    def test_radius_search_matches_brute_force(self):
+        index = create_index('kdtree', min_tree_size=100)
+        index.add(self.gallery[:550], np.arange(550))
+        index.add(self.gallery[550:], np.arange(550, 600))
+
+        for (ids, dist), (expected_ids, _) in zip(index.radius_search(self.queries, 15.0),
+                                                   self.brute.radius_search(self.queries, 15.0)):
+            np.testing.assert_array_equal(ids, expected_ids)
+            self.assertTrue(np.all(dist <= 15.0))
+
+    def test_ivfpq_recall(self):
+        index = create_index('ivfpq', n_lists=8, n_subvectors=5, n_bits=6, n_probe=3, train_size=400)
+        index.add(self.gallery[:400], np.arange(400))
+        index.add(self.gallery[400:], np.arange(400, 600))
+        self.assertTrue(index.is_trained)
+        self.assertEqual(len(index), 600)
+
+        _, ids = index.search(self.queries, k=1)
+        recall = np.mean(ids[:, 0] == np.arange(50))
+        self.assertGreater(recall, 0.8)
+
+    def test_ivfpq_radius_search_is_not_limited_to_reranked_candidates(self):
+        index = create_index('ivfpq', n_lists=8, n_subvectors=5, n_bits=6, n_probe=8, rerank=5, train_size=400)
+        index.add(self.gallery, np.arange(600))
+
+        ids, dist = index.radius_search(self.queries[0], 1e6)[0]
+        self.assertEqual(len(ids), 600)
+        # The closest candidates have their exact distance
+        np.testing.assert_allclose(dist[ids == 0], np.linalg.norm(self.gallery[0] - self.queries[0]))
+
+    def test_ivfpq_single_inserts_match_bulk_insert(self):
+        bulk = create_index('ivfpq', n_lists=8, n_subvectors=5, n_bits=6, n_probe=3, train_size=400)
+        bulk.add(self.gallery[:400], np.arange(400))
+        bulk.add(self.gallery[400:], np.arange(400, 600))
+        single = create_index('ivfpq', n_lists=8, n_subvectors=5, n_bits=6, n_probe=3, train_size=400)
+        single.add(self.gallery[:400], np.arange(400))
+        for i in range(400, 600):
+            single.add(self.gallery[i], [i])
+        single.remove(np.arange(590, 600))
+        bulk.remove(np.arange(590, 600))
+
+        self.assertEqual(len(single), 590)
+        for a, b in zip(single.search(self.queries, k=3), bulk.search(self.queries, k=3)):
+            np.testing.assert_array_equal(a, b)
+
+    def test_removed_vectors_are_not_returned(self):
+        for kind in ('brute', 'kdtree', 'ivfpq'):
+            index = create_index(kind) if kind == 'brute' else \
+                    create_index(kind, min_tree_size=100) if kind == 'kdtree' else \
+                    create_index(kind, n_lists=8, n_subvectors=5, n_bits=6, train_size=400)
+            index.add(self.gallery, np.arange(600))
+            index.remove(np.arange(10))
+
+            self.assertEqual(len(index), 590)
+            _, ids = index.search(self.queries[:10], k=2)
+            self.assertFalse(np.any(np.isin(ids, np.arange(10))), kind)
+            for match_ids, _ in index.radius_search(self.queries[:10], 15.0):
+                self.assertFalse(np.any(np.isin(match_ids, np.arange(10))), kind)
+
+    def test_tree_index_with_every_vector_removed(self):
+        for kind in ('kdtree', 'balltree'):
+            index = create_index(kind, min_tree_size=100)
+            index.add(self.gallery, np.arange(600))
+            index.remove(np.arange(600))
+            self.assertEqual(len(index), 0)
+
+            dist, ids = index.search(self.queries, k=2)
+            self.assertTrue(np.all(np.isinf(dist)))
+            self.assertTrue(np.all(ids == -1))
+
+            # Faces enrolled afterwards are found in the insert buffer
+            index.add(self.gallery[:5], np.arange(5))
+            _, ids = index.search(self.queries[:5], k=1)
+            np.testing.assert_array_equal(ids[:, 0], np.arange(5))
+            self.assertEqual([list(match_ids) for match_ids, _ in index.radius_search(self.queries[:2], 1.0)],
+                             [[0], [1]])
+
+    def test_unknown_index_type_raises(self):
+        with self.assertRaises(ValueError):
+            create_index('lsh')
+
+if __name__ == "__main__":
+    unittest.main()
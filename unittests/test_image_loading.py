@@ -0,0 +1,50 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from components.util.image import load_images_from_folder, load_image_batches, resize_image
+
+class TestImageLoading(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        self.images = [rng.randint(0, 256, (32, 24, 3)).astype(np.uint8) for _ in range(7)]
+        for i, image in enumerate(self.images):
+            cv2.imwrite(os.path.join(self.folder, f'{i:02d}.png'), image)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_resize_keeps_aspect_ratio_and_crops_center(self):
+        image = np.zeros((40, 80), dtype=np.uint8)
+        image[:, 20:60] = 255
+        resized = resize_image(image, (20, 20))
+        self.assertEqual(resized.shape, (20, 20))
+        self.assertTrue(np.all(resized == 255))
+
+    def test_folder_loads_into_one_array(self):
+        faces = load_images_from_folder(self.folder, shape=(16, 16), workers=3)
+        self.assertEqual(faces.shape, (7, 16, 16))
+        self.assertEqual(faces.dtype, np.uint8)
+        expected = resize_image(cv2.cvtColor(self.images[0], cv2.COLOR_BGR2GRAY), (16, 16))
+        # Decoders round their own grayscale conversion slightly differently
+        self.assertLessEqual(np.abs(faces[0].astype(int) - expected).max(), 3)
+
+    def test_batches_cover_folder_in_order(self):
+        batches = list(load_image_batches(self.folder, 3, workers=2))
+        self.assertEqual([len(b) for b in batches], [3, 3, 1])
+        faces = load_images_from_folder(self.folder)
+        np.testing.assert_array_equal(np.concatenate(batches), np.array(faces))
+
+    def test_unreadable_images_are_skipped(self):
+        with open(os.path.join(self.folder, '03.png'), 'w') as f:
+            f.write('not an image')
+        batches = list(load_image_batches(self.folder, 4, shape=(8, 8)))
+        self.assertEqual([len(b) for b in batches], [3, 3])
+
+if __name__ == "__main__":
+    unittest.main()
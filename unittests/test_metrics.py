@@ -0,0 +1,118 @@
+import gc
+import json
+import logging
+import unittest
+import urllib.request
+import weakref
+
+import numpy as np
+
+from components.face_recognizer import FaceRecognizer, register_gallery
+from components.metrics import MetricsRegistry, MetricsServer, MetricsLogger, REGISTRY
+from components.pipeline import Pipeline, Closed
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry(enabled=True)
+
+    def test_disabled_registry_records_nothing(self):
+        registry = MetricsRegistry()
+        counter = registry.counter('frames_total')
+        histogram = registry.histogram('detect_seconds')
+        counter.inc()
+        histogram.observe(0.1)
+        with histogram.time():
+            pass
+
+        self.assertEqual(counter.value, 0)
+        self.assertEqual(histogram.count, 0)
+
+    def test_same_name_and_labels_return_the_same_metric(self):
+        a = self.registry.counter('frames_total', camera=0)
+        self.assertIs(self.registry.counter('frames_total', camera='0'), a)
+        self.assertIsNot(self.registry.counter('frames_total', camera=1), a)
+        with self.assertRaises(AssertionError):
+            self.registry.gauge('frames_total', camera=0)
+
+    def test_histogram_buckets_and_quantiles(self):
+        histogram = self.registry.histogram('detect_seconds', buckets=(0.01, 0.1, 1))
+        for value in [0.005, 0.05, 0.05, 0.5, 5]:
+            histogram.observe(value)
+        with histogram.time():
+            pass
+
+        self.assertEqual(histogram.count, 6)
+        self.assertEqual(histogram.quantile(0.5), 0.1)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    def test_prometheus_text(self):
+        self.registry.counter('frames_total', 'Frames read', camera='door').inc(3)
+        self.registry.gauge('queue_depth', 'Queued items', func=lambda: 2)
+        self.registry.histogram('detect_seconds', 'Detection time', buckets=(0.1,)).observe(0.05)
+
+        lines = self.registry.render_prometheus().splitlines()
+        self.assertIn('# TYPE frames_total counter', lines)
+        self.assertIn('frames_total{camera="door"} 3', lines)
+        self.assertIn('queue_depth 2', lines)
+        self.assertIn('detect_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('detect_seconds_bucket{le="+Inf"} 1', lines)
+        self.assertIn('detect_seconds_count 1', lines)
+
+    def test_server_and_logger_export_metrics(self):
+        self.registry.counter('frames_total').inc(2)
+
+        server = MetricsServer(self.registry, port=0)
+        try:
+            with urllib.request.urlopen(f'http://127.0.0.1:{server.port}/metrics', timeout=5) as response:
+                self.assertIn('frames_total 2', response.read().decode())
+        finally:
+            server.close()
+
+        metrics_logger = MetricsLogger(60, self.registry, logging.getLogger('test.metrics'))
+        with self.assertLogs('test.metrics', level='INFO') as logs:
+            metrics_logger.log()
+        self.assertEqual(json.loads(logs.output[0].split(':', 2)[2])['frames_total'], 2)
+
+class TestPipelineMetrics(unittest.TestCase):
+    def test_stages_record_latency_and_queue_metrics(self):
+        REGISTRY.enable()
+        try:
+            source = iter(range(10))
+            pipeline = Pipeline([('metrics-source', lambda _: next(source), 1)], queue_size=20)
+            pipeline.start()
+            while True:
+                try:
+                    pipeline.get(timeout=5)
+                except Closed:
+                    break
+            pipeline.stop()
+        finally:
+            REGISTRY.disable()
+
+        self.assertEqual(REGISTRY.histogram('pybell_stage_seconds', stage='metrics-source').count, 10)
+        self.assertEqual(next(REGISTRY.gauge('pybell_queue_depth', stage='metrics-source').samples())[2], 0)
+
+    def test_gallery_loaded_before_enabling_is_exported(self):
+        rng = np.random.RandomState(0)
+        recognizer = FaceRecognizer(rng.rand(16*16)*255, np.linalg.qr(rng.randn(16*16, 10))[0].T, dict(),
+                                    img_shape=(16,16))
+        register_gallery(recognizer)
+        recognizer.add_known_faces(['a', 'b'], [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(2)])
+
+        REGISTRY.enable()
+        try:
+            self.assertIn('pybell_gallery_faces 2', REGISTRY.render_prometheus())
+        finally:
+            REGISTRY.disable()
+
+    def test_recognizers_are_not_kept_alive_by_metrics(self):
+        rng = np.random.RandomState(0)
+        recognizer = FaceRecognizer(rng.rand(16*16)*255, np.linalg.qr(rng.randn(16*16, 10))[0].T, dict(),
+                                    img_shape=(16,16))
+        ref = weakref.ref(recognizer)
+        del recognizer
+        gc.collect()
+        self.assertIsNone(ref())
+
+if __name__ == "__main__":
+    unittest.main()
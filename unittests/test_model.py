@@ -0,0 +1,106 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from components.face_recognizer import FaceRecognizer
+from components.util.eigenfaces import save_facespace_dict
+from components.util.model import save_model, load_model, load_facespace, append_gallery, save_gallery
+
+class TestModelFormat(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.model_dir = os.path.join(self.tmp, 'model')
+        rng = np.random.RandomState(0)
+        self.mean_face = rng.rand(16*16)*255
+        self.facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(3)]
+        save_model(self.model_dir, self.facespace, self.mean_face, (16, 16))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_round_trip_is_memory_mapped(self):
+        model = load_model(self.model_dir)
+        self.assertIsInstance(model['facespace'], np.memmap)
+        np.testing.assert_array_equal(model['facespace'], self.facespace)
+        np.testing.assert_array_equal(model['mean_face'], self.mean_face)
+        self.assertEqual((model['img_shape'], model['components']), ((16, 16), 10))
+        self.assertEqual(model['names'], [])
+        self.assertEqual(model['vectors'].shape, (0, 10))
+
+    def test_append_gallery(self):
+        vectors = np.arange(30, dtype=np.float32).reshape(3, 10)
+        append_gallery(self.model_dir, ['a', 'b'], vectors[:2])
+        append_gallery(self.model_dir, ['a'], vectors[2:])
+
+        model = load_model(self.model_dir)
+        self.assertEqual(model['names'], ['a', 'b', 'a'])
+        np.testing.assert_array_equal(model['vectors'], vectors)
+
+    def test_interrupted_append_is_ignored(self):
+        append_gallery(self.model_dir, ['a'], np.ones((1, 10)))
+        # Bytes written by an append whose header was never replaced
+        with open(os.path.join(self.model_dir, 'gallery_vectors.bin'), 'ab') as f:
+            f.write(b'\x00'*13)
+
+        self.assertEqual(len(load_model(self.model_dir)['vectors']), 1)
+        append_gallery(self.model_dir, ['b'], np.full((1, 10), 2))
+        np.testing.assert_array_equal(load_model(self.model_dir)['vectors'][:, 0], [1, 2])
+
+    def test_save_gallery_replaces_files(self):
+        append_gallery(self.model_dir, ['a', 'b'], np.ones((2, 10)))
+        save_gallery(self.model_dir, ['b'], np.full((1, 10), 3))
+
+        model = load_model(self.model_dir, mmap=False)
+        self.assertEqual(model['names'], ['b'])
+        np.testing.assert_array_equal(model['vectors'], np.full((1, 10), 3))
+        self.assertFalse(os.path.exists(os.path.join(self.model_dir, 'gallery_vectors.bin')))
+
+    def test_int8_model_loads_quantized(self):
+        int8_dir = os.path.join(self.tmp, 'int8')
+        save_model(int8_dir, self.facespace, self.mean_face, (16, 16), precision='int8')
+
+        recognizer = FaceRecognizer.from_model(int8_dir, thresh=10)
+        self.assertEqual(recognizer.precision, 'int8')
+        self.assertIsInstance(recognizer.facespace, np.memmap)
+        np.testing.assert_allclose(recognizer.facespace*recognizer.facespace_scales[:, None], self.facespace,
+                                   atol=np.abs(self.facespace).max()/127)
+
+    def test_legacy_pickle(self):
+        pickle_file = os.path.join(self.tmp, 'facespace.pkl')
+        save_facespace_dict(self.facespace, self.mean_face, pickle_file)
+        model = load_facespace(pickle_file)
+        self.assertEqual(model['img_shape'], (16, 16))
+        np.testing.assert_array_equal(model['facespace'], self.facespace)
+
+        # The provided pickle is used while the default model directory does not exist
+        recognizer = FaceRecognizer.from_model(os.path.join(self.tmp, 'facespace'))
+        np.testing.assert_array_equal(recognizer.facespace, self.facespace)
+        self.assertIsNone(recognizer.model_dir)
+
+    def test_recognizer_saves_known_faces(self):
+        recognizer = FaceRecognizer.from_model(self.model_dir, thresh=10)
+        recognizer.add_known_faces(['a', 'b', 'c'], self.faces)
+        recognizer.remove_known_face('b')
+
+        reloaded = FaceRecognizer.from_model(self.model_dir, thresh=10)
+        self.assertEqual(len(reloaded.gallery), 2)
+        names, _ = reloaded.recognize_batch(self.faces)
+        self.assertEqual(names, ['a', None, 'c'])
+
+    def test_known_faces_need_their_projection_settings(self):
+        recognizer = FaceRecognizer.from_model(self.model_dir, brightness_coeff=100)
+        recognizer.add_known_faces(['a'], self.faces[:1])
+        self.assertEqual(load_model(self.model_dir)['projection'], recognizer.projection_settings)
+
+        FaceRecognizer.from_model(self.model_dir, brightness_coeff=100)
+        with self.assertRaises(AssertionError):
+            FaceRecognizer.from_model(self.model_dir, brightness_coeff=50)
+        with self.assertRaises(AssertionError):
+            FaceRecognizer.from_model(self.model_dir, brightness_coeff=100, precision='int8')
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+import numpy as np
+
+from components.motion_gate import MotionGate, merge_overlapping_boxes
+
+class TestMotionGate(unittest.TestCase):
+    def setUp(self):
+        self.background = np.full((240, 320), 100, dtype=np.uint8)
+
+    def test_static_frames_are_skipped(self):
+        gate = MotionGate(hold_frames=0)
+        for _ in range(5):
+            self.assertEqual(gate.update(self.background), [])
+
+        self.assertEqual(gate.stats()['skips'], 5)
+        self.assertEqual(gate.stats()['hits'], 0)
+
+    def test_moving_object_region_contains_change(self):
+        gate = MotionGate(hold_frames=0)
+        gate.update(self.background)
+
+        frame = self.background.copy()
+        frame[100:140, 200:240] = 250
+        regions = gate.update(frame)
+
+        self.assertEqual(len(regions), 1)
+        x, y, w, h = regions[0]
+        self.assertTrue(x <= 200 and y <= 100 and x + w >= 240 and y + h >= 140)
+        self.assertLess(w*h, 320*240)
+        self.assertEqual(gate.stats()['hits'], 1)
+
+    def test_regions_are_held_after_motion_stops(self):
+        gate = MotionGate(hold_frames=2)
+        gate.update(self.background)
+        frame = self.background.copy()
+        frame[100:140, 200:240] = 250
+        moving = gate.update(frame)
+
+        self.assertEqual(gate.update(frame), moving)
+        self.assertEqual(gate.update(frame), moving)
+        self.assertEqual(gate.update(frame), [])
+
+    def test_merge_overlapping_boxes(self):
+        merged = merge_overlapping_boxes([(0, 0, 10, 10), (5, 5, 10, 10), (50, 50, 5, 5)])
+        self.assertEqual(sorted(merged), [(0, 0, 15, 15), (50, 50, 5, 5)])
+
+if __name__ == "__main__":
+    unittest.main()
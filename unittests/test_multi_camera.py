@@ -0,0 +1,106 @@
+import threading
+import time
+import unittest
+
+import numpy as np
+
+from components.camera import TimestampedFrame
+from components.face_recognizer import FaceRecognizer
+from components.multi_camera import MultiCameraManager
+from components.pipeline import Closed
+
+class FakeCamera:
+    """Camera with a new frame whenever one is read, until n_frames were read"""
+    undistort_fisheye = False
+
+    def __init__(self, index, n_frames):
+        self.index = index
+        self.n_frames = n_frames
+        self.dropped_frames = 0
+        self._next_id = 0
+
+    @property
+    def grabbing(self):
+        return self._next_id < self.n_frames
+
+    def latest_frame(self, timeout=None):
+        if self._next_id >= self.n_frames:
+            return None
+        # Camera index and frame id are written in the image, for the detector
+        image = np.zeros((32, 32), dtype=np.uint8)
+        image[0, :2] = self.index, self._next_id
+        self._next_id += 1
+        return TimestampedFrame(image, time.monotonic(), self._next_id - 1)
+
+    def stop(self):
+        pass
+
+class RecordingDetector:
+    """Thread safe detector finding no faces, recording the frames detected at once per camera"""
+    def __init__(self, seconds=0.005):
+        self.seconds = seconds
+        self.overlaps = 0
+        self.order = list()
+        self.times = list()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+    def detectFaces(self, img, regions=None, gray=None):
+        camera, frame_id = int(img[0, 0]), int(img[0, 1])
+        with self._lock:
+            self.overlaps += camera in self._in_flight
+            self._in_flight.add(camera)
+            self.order.append((camera, frame_id))
+            self.times.append(time.monotonic())
+        time.sleep(self.seconds)
+        with self._lock:
+            self._in_flight.discard(camera)
+        return 0, list(), list()
+
+class TestMultiCameraManager(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.recognizer = FaceRecognizer(rng.rand(16*16)*255, np.linalg.qr(rng.randn(16*16, 10))[0].T, dict(),
+                                         img_shape=(16,16))
+
+    def run_manager(self, cameras, workers=3, **kwargs):
+        detector = RecordingDetector()
+        manager = MultiCameraManager([f'camera {c.index}' for c in cameras], self.recognizer, workers=workers,
+                                     detector=detector, cameras=cameras, queue_size=1000, **kwargs)
+        packets = list()
+        while True:
+            try:
+                packets.append(manager.get(timeout=10))
+            except Closed:
+                break
+        manager.stop()
+        return manager, detector, packets
+
+    def test_frames_of_a_camera_are_processed_one_at_a_time_in_order(self):
+        manager, detector, packets = self.run_manager([FakeCamera(0, 20), FakeCamera(1, 20)], workers=4)
+
+        self.assertEqual(detector.overlaps, 0)
+        for source in manager.sources:
+            frame_ids = [p.frame_id for p in packets if p.source == source]
+            self.assertEqual(frame_ids, list(range(20)))
+            self.assertEqual(manager.stats[source].as_dict()['errors'], 0)
+
+    def test_sources_are_scheduled_round_robin(self):
+        _, detector, _ = self.run_manager([FakeCamera(0, 30), FakeCamera(1, 10)], workers=1)
+
+        # A camera always having a new frame does not starve the other one
+        self.assertEqual([camera for camera, _ in detector.order[:20]], [0, 1]*10)
+        self.assertEqual(len(detector.order), 40)
+
+    def test_fps_target_limits_a_source(self):
+        _, detector, _ = self.run_manager([FakeCamera(0, 4), FakeCamera(1, 20)], workers=2,
+                                          fps_targets=[10, None])
+
+        # Camera 0 is due every 100ms while camera 1 runs through its 20 frames meanwhile
+        times = [t for (camera, _), t in zip(detector.order, detector.times) if camera == 0]
+        self.assertEqual(len(times), 4)
+        self.assertGreaterEqual(min(np.diff(times)), 0.09)
+        self.assertLess(max(t for (camera, _), t in zip(detector.order, detector.times) if camera == 1), times[2])
+
+if __name__ == "__main__":
+    unittest.main()
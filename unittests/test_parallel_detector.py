@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_clip, synthetic_frame
+from components.face_detector import FaceDetector
+from components.parallel_detector import ParallelFaceDetector
+from components.tracker import iou
+from components.util.detection import non_max_suppression, tile_regions
+
+class TestTilesAndSuppression(unittest.TestCase):
+    def test_tiles_cover_image_with_overlap(self):
+        regions = tile_regions((100, 200), (2, 2), overlap=20)
+        self.assertEqual(regions, [(0, 0, 110, 60), (90, 0, 110, 60), (0, 40, 110, 60), (90, 40, 110, 60)])
+
+    def test_suppression_keeps_largest_of_duplicates(self):
+        bboxes = [(10, 10, 50, 50), (12, 11, 48, 48), (100, 100, 20, 20)]
+        np.testing.assert_array_equal(non_max_suppression(bboxes), [(10, 10, 50, 50), (100, 100, 20, 20)])
+        self.assertEqual(non_max_suppression([]).shape, (0, 4))
+
+class TestParallelFaceDetector(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.frames, cls.truth = synthetic_clip((240, 320), 6, n_faces=1, size=80)
+        cls.detector = FaceDetector()
+
+    def test_frames_match_serial_detection_in_order(self):
+        with ParallelFaceDetector(2, max_in_flight=3) as parallel:
+            results = list(parallel.detect_frames(self.frames))
+
+        self.assertEqual(len(results), len(self.frames))
+        for frame, (count, bboxes, faces) in zip(self.frames, results):
+            expected = self.detector.detectFaces(frame)[1]
+            self.assertEqual(count, len(expected))
+            np.testing.assert_array_equal(bboxes, expected)
+            self.assertEqual(faces[0].shape, tuple(bboxes[0][2:]))
+
+    def test_face_on_tile_border_is_found_once(self):
+        frame = synthetic_frame((240, 320), [(120, 80, 80)])
+        with ParallelFaceDetector(2, tiles=(2, 2), overlap=100) as parallel:
+            count, bboxes, _ = parallel.detectFaces(frame)
+        self.assertEqual(count, 1)
+        self.assertGreater(iou(bboxes[0], (120, 80, 80, 80)), 0.5)
+
+    def test_buffers_grow_with_frame_size(self):
+        with ParallelFaceDetector(1) as parallel:
+            parallel.detectFaces(np.zeros((60, 80), dtype=np.uint8))
+            count, _, _ = parallel.detectFaces(self.frames[0])
+        self.assertEqual(count, 1)
+
+    def test_frames_growing_while_in_flight(self):
+        frames = [np.zeros((100, 100), dtype=np.uint8), self.frames[0], np.zeros((60, 80), dtype=np.uint8),
+                  np.zeros((480, 640), dtype=np.uint8), self.frames[1]]
+        with ParallelFaceDetector(1, max_in_flight=2) as parallel:
+            counts = [count for count, _, _ in parallel.detect_frames(frames)]
+        self.assertEqual(counts, [0, 1, 0, 0, 1])
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,105 @@
+import collections
+import queue
+import unittest
+
+import numpy as np
+
+import pybell
+from benchmarks.synthetic import synthetic_clip
+from components.camera import TimestampedFrame
+from components.face_detector import FaceDetector
+from components.face_recognizer import FaceRecognizer
+from components.pipeline import FrameQueue, Pipeline, Closed
+from components.tracker import FaceTracker
+
+class ClipCamera:
+    """Camera returning the frames of a clip, then ending"""
+    undistort_fisheye = False
+    grabbing = False
+
+    def __init__(self, frames):
+        self.frames = iter(enumerate(frames))
+
+    def latest_frame(self, timeout=None):
+        frame_id, image = next(self.frames, (None, None))
+        return None if image is None else TimestampedFrame(image, 0.0, frame_id)
+
+class TestFrameQueue(unittest.TestCase):
+    def test_full_queue_drops_oldest(self):
+        q = FrameQueue(maxsize=2)
+        for i in range(5):
+            q.put(i)
+
+        self.assertEqual(q.dropped, 3)
+        self.assertEqual([q.get(), q.get()], [3, 4])
+
+    def test_closed_queue_raises_once_empty(self):
+        q = FrameQueue(maxsize=2)
+        q.put(1)
+        q.close()
+
+        self.assertEqual(q.get(), 1)
+        with self.assertRaises(Closed):
+            q.get()
+
+    def test_get_times_out(self):
+        with self.assertRaises(TimeoutError):
+            FrameQueue().get(timeout=0.01)
+
+class TestPipeline(unittest.TestCase):
+    def test_items_flow_through_stages_in_order(self):
+        source = iter(range(20))
+        pipeline = Pipeline([('source', lambda _: next(source), 1),
+                             ('double', lambda x: 2*x, 1),
+                             ('odd', lambda x: x + 1, 1)], queue_size=4, drop_oldest=False)
+        pipeline.start()
+
+        results = list()
+        while True:
+            try:
+                results.append(pipeline.get(timeout=5))
+            except Closed:
+                break
+        pipeline.stop()
+
+        self.assertEqual(results, [2*i + 1 for i in range(20)])
+        stats = pipeline.stats()
+        self.assertEqual(stats['double']['processed'], 20)
+        self.assertEqual(stats['odd']['dropped'], 0)
+
+class TestBuildPipeline(unittest.TestCase):
+    def run_pipeline(self, frames, detect_workers, track=False):
+        rng = np.random.RandomState(0)
+        recognizer = FaceRecognizer(rng.rand(64*64)*255, np.linalg.qr(rng.randn(64*64, 10))[0].T, dict(),
+                                    img_shape=(64,64), thresh=1)
+        args = pybell.parser.parse_args(['--detect-workers', str(detect_workers), '--no-drop'])
+        tracker = FaceTracker(recognizer) if track else None
+        pipeline = pybell.build_pipeline(ClipCamera(frames), FaceDetector(), recognizer, queue.Queue(), args,
+                                         tracker=tracker)
+        pipeline.start()
+
+        bboxes = collections.OrderedDict()
+        while True:
+            try:
+                packet = pipeline.get(timeout=30)
+            except Closed:
+                break
+            bboxes[packet.frame_id] = sorted(map(tuple, packet.bboxes))
+        pipeline.stop()
+        return bboxes
+
+    def test_detection_threads_match_single_thread(self):
+        frames, _ = synthetic_clip((240, 320), 24, n_faces=2, size=80)
+        single = self.run_pipeline(frames, 1)
+
+        self.assertEqual(len(single), 24)
+        self.assertGreater(sum(map(len, single.values())), 0)
+        self.assertEqual(dict(self.run_pipeline(frames, 4)), dict(single))
+
+    def test_tracked_frames_stay_in_order(self):
+        frames, _ = synthetic_clip((240, 320), 24, n_faces=2, size=80)
+        tracked = self.run_pipeline(frames, 4, track=True)
+        self.assertEqual(list(tracked), list(range(24)))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,156 @@
+import asyncio
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+import numpy as np
+import cv2
+
+from benchmarks.synthetic import synthetic_frame
+from components.face_recognizer import FaceRecognizer
+from components.service import FaceService, ReadWriteLock
+
+async def request(address, path, body=b'', content_type='image/png', headers=None):
+    """Send one request to the service, returns its status and JSON response"""
+    if isinstance(address, str):
+        reader, writer = await asyncio.open_unix_connection(address)
+    else:
+        reader, writer = await asyncio.open_connection(*address)
+    lines = [f"{'POST' if body else 'GET'} {path} HTTP/1.1", f'Content-Type: {content_type}',
+             f'Content-Length: {len(body)}', 'Connection: close']
+    lines += [f'{name}: {value}' for name, value in (headers or dict()).items()]
+    writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split()[1]), json.loads(payload)
+
+class SlowDetector:
+    """Detector taking a fixed time per image and finding no faces"""
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def detectFaces(self, img, regions=None, gray=None):
+        time.sleep(self.seconds)
+        return 0, list(), list()
+
+class TestFaceService(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        self.recognizer = FaceRecognizer(rng.rand(64*64)*255, np.linalg.qr(rng.randn(64*64, 10))[0].T, dict(),
+                                         img_shape=(64,64), thresh=1)
+        self.frame = synthetic_frame((240, 320), [(100, 60, 100)])
+        self.png = cv2.imencode('.png', self.frame)[1].tobytes()
+
+    def serve(self, test, service, unix_socket=None):
+        async def run():
+            await service.start(port=0, unix_socket=unix_socket)
+            try:
+                return await test(service.address)
+            finally:
+                await service.close()
+        return asyncio.run(run())
+
+    def test_enrolled_face_is_recognized(self):
+        async def test(address):
+            status, detected = await request(address, '/detect', self.png)
+            self.assertEqual(status, 200)
+            self.assertEqual(len(detected['faces']), 1)
+            self.assertNotIn('name', detected['faces'][0])
+
+            x, y, w, h = detected['faces'][0]['bbox']
+            face = cv2.imencode('.png', self.frame[y:y+h, x:x+w])[1].tobytes()
+            status, enrolled = await request(address, '/enroll?name=Visitor', face)
+            self.assertEqual((status, enrolled['gallery']), (200, 1))
+
+            status, recognized = await request(address, '/recognize', self.png)
+            self.assertEqual(recognized['faces'][0]['name'], 'Visitor')
+            self.assertEqual((await request(address, '/health'))[1]['gallery'], 1)
+            self.assertEqual((await request(address, '/missing'))[0], 404)
+
+        self.serve(test, FaceService(self.recognizer, workers=1))
+
+    def test_concurrent_requests_are_batched(self):
+        async def test(address):
+            responses = await asyncio.gather(*[request(address, '/recognize', self.png) for _ in range(6)])
+            self.assertEqual([status for status, _ in responses], [200]*6)
+            self.assertGreater(max(response['batch_size'] for _, response in responses), 1)
+
+        self.serve(test, FaceService(self.recognizer, workers=1, batch_window=0.05))
+
+    def test_backpressure_and_deadlines(self):
+        async def test(address):
+            # One batch in flight and one request waiting, the others are rejected
+            responses = await asyncio.gather(*[request(address, '/detect', self.png) for _ in range(6)])
+            statuses = sorted(status for status, _ in responses)
+            self.assertIn(200, statuses)
+            self.assertIn(503, statuses)
+
+            status, response = await request(address, '/detect', self.png, headers={'X-Deadline-Ms': 50})
+            self.assertEqual(status, 504)
+
+        service = FaceService(self.recognizer, SlowDetector(0.2), workers=1, max_batch=1, batch_window=0,
+                              max_pending=1, deadline=5)
+        self.serve(test, service)
+
+    def test_negative_content_length_is_rejected(self):
+        async def test(address):
+            status, response = await request(address, '/detect', headers={'Content-Length': -5})
+            self.assertEqual(status, 400)
+            self.assertIn('Content-Length', response['error'])
+
+        self.serve(test, FaceService(self.recognizer, workers=1))
+
+    def test_raw_pixels_over_unix_socket(self):
+        async def test(address):
+            height, width = self.frame.shape
+            status, response = await request(address, f'/detect?width={width}&height={height}',
+                                             self.frame.tobytes(), 'application/octet-stream')
+            self.assertEqual((status, len(response['faces'])), (200, 1))
+
+            status, _ = await request(address, f'/detect?width={width}&height={height + 1}',
+                                      self.frame.tobytes(), 'application/octet-stream')
+            self.assertEqual(status, 400)
+
+        folder = tempfile.mkdtemp()
+        try:
+            self.serve(test, FaceService(self.recognizer, workers=1), unix_socket=os.path.join(folder, 'pybell.sock'))
+        finally:
+            if os.path.exists(os.path.join(folder, 'pybell.sock')):
+                os.unlink(os.path.join(folder, 'pybell.sock'))
+            os.rmdir(folder)
+
+class TestReadWriteLock(unittest.TestCase):
+    def test_readers_share_and_writers_exclude(self):
+        lock = ReadWriteLock()
+        events = list()
+        both_reading = threading.Barrier(2, timeout=5)
+
+        def read(name):
+            with lock.reading():
+                # Both readers hold the lock at once, or the barrier times out
+                both_reading.wait()
+                events.append(name)
+                time.sleep(0.05)
+
+        def write():
+            with lock.writing():
+                events.append('write')
+
+        readers = [threading.Thread(target=read, args=(name,)) for name in ('a', 'b')]
+        for reader in readers:
+            reader.start()
+        time.sleep(0.01)
+        writer = threading.Thread(target=write)
+        writer.start()
+        for thread in readers + [writer]:
+            thread.join()
+
+        self.assertEqual(sorted(events[:2]), ['a', 'b'])
+        self.assertEqual(events[2], 'write')
+
+if __name__ == "__main__":
+    unittest.main()
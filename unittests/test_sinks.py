@@ -0,0 +1,101 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import cv2
+
+from components.commands import CommandChannel
+from components.pipeline import FramePacket
+from components.sinks import SinkGroup, CallbackSink, JsonEventSink, VideoFileSink
+
+def make_packet(frame_id=0, source=None):
+    packet = FramePacket(frame_id, np.full((120, 160, 3), 200, dtype=np.uint8), source=source)
+    packet.bboxes = [(20, 30, 40, 40), (80, 30, 40, 40)]
+    packet.faces = [np.zeros((8, 8), dtype=np.uint8)]*2
+    packet.names = ['alice', None]
+    packet.distances = np.array([12.5, np.inf])
+    return packet
+
+class TestSinks(unittest.TestCase):
+    def test_frames_are_only_drawn_when_a_sink_needs_pixels(self):
+        images = list()
+        headless = SinkGroup([CallbackSink(lambda packet: images.append(packet.image.copy()))])
+        headless.write(make_packet())
+        self.assertTrue(np.all(images[-1] == 200))
+
+        preview = SinkGroup([CallbackSink(lambda packet: images.append(packet.image.copy()), needs_pixels=True)])
+        preview.write(make_packet())
+        self.assertFalse(np.all(images[-1] == 200))
+
+    def test_json_events_of_frames_with_faces(self):
+        stream = io.StringIO()
+        sink = JsonEventSink(stream)
+        sink.write(make_packet(frame_id=3, source='door'))
+        empty = make_packet(frame_id=4)
+        empty.bboxes = list()
+        sink.write(empty)
+        sink.close()
+
+        events = [json.loads(line) for line in stream.getvalue().splitlines()]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['frame_id'], 3)
+        self.assertEqual(events[0]['source'], 'door')
+        self.assertEqual([face['name'] for face in events[0]['faces']], ['alice', None])
+        self.assertEqual([face['distance'] for face in events[0]['faces']], [12.5, None])
+
+    def test_video_file_per_source(self):
+        folder = tempfile.mkdtemp()
+        try:
+            sink = SinkGroup([VideoFileSink(os.path.join(folder, 'out.avi'))])
+            for i in range(5):
+                sink.write(make_packet(i, source=0))
+            sink.write(make_packet(0, source='hall.mp4'))
+            sink.close()
+
+            capture = cv2.VideoCapture(os.path.join(folder, 'out-0.avi'))
+            self.assertEqual(int(capture.get(cv2.CAP_PROP_FRAME_COUNT)), 5)
+            capture.release()
+            self.assertTrue(os.path.isfile(os.path.join(folder, 'out-hall.mp4.avi')))
+        finally:
+            shutil.rmtree(folder)
+
+class TestCommandChannel(unittest.TestCase):
+    def setUp(self):
+        self.enrolled = list()
+        self.output = io.StringIO()
+        self.faces = [np.full((8, 8), i, dtype=np.uint8) for i in range(3)]
+
+    def channel(self, commands):
+        return CommandChannel(lambda name, face: self.enrolled.append((name, int(face[0, 0]))),
+                              io.StringIO(commands), self.output)
+
+    def test_enroll_latest_or_track_id(self):
+        channel = self.channel("enroll Jane Doe\nenroll #1 Bob\nenroll #1 Bob\nquit\nenroll Late\n")
+        channel.offer(self.faces[0], track_id=1)
+        channel.offer(self.faces[1], track_id=2)
+        channel.offer(self.faces[2], track_id=3)
+        channel.start()
+        channel.join(5)
+
+        self.assertEqual(self.enrolled, [('Jane Doe', 2), ('Bob', 0)])
+        self.assertTrue(channel.quit_requested.is_set())
+        self.assertIn('No unknown face #1', self.output.getvalue())
+
+    def test_unknown_faces_are_bounded(self):
+        channel = self.channel("unknown\nbogus\n")
+        channel.max_unknown = 2
+        for face in self.faces:
+            channel.offer(face, source='door')
+        channel.start()
+        channel.join(5)
+
+        replies = self.output.getvalue().splitlines()
+        self.assertEqual(replies[0], 'Unknown faces: #door/f1 #door/f2')
+        self.assertTrue(replies[1].startswith('Commands:'))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,49 @@
+import subprocess
+import sys
+import time
+import unittest
+
+import numpy as np
+
+from components.face_recognizer import FaceRecognizer
+from components.startup import StartupTimer, warm_up
+
+class TestStartup(unittest.TestCase):
+    def test_runtime_does_not_import_training_dependencies(self):
+        code = "import sys, components.face_recognizer, components.util.model; print('sklearn' in sys.modules)"
+        output = subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True).stdout
+        self.assertEqual(output.strip(), b'False')
+
+    def test_tasks_run_concurrently(self):
+        timer = StartupTimer()
+        results = timer.run_concurrently(model=lambda: time.sleep(0.2) or 'model',
+                                         camera=lambda: time.sleep(0.2) or 'camera')
+
+        self.assertEqual(results, {'model': 'model', 'camera': 'camera'})
+        self.assertLess(timer.phases['concurrent'], 0.35)
+        self.assertGreaterEqual(timer.phases['model'], 0.2)
+        self.assertIn('camera', timer.report())
+
+    def test_errors_are_raised_after_every_task_finished(self):
+        finished = list()
+        def fail():
+            raise IOError("camera not found")
+
+        with self.assertRaises(IOError):
+            StartupTimer().run_concurrently(camera=fail, model=lambda: time.sleep(0.1) or finished.append(1))
+        self.assertEqual(finished, [1])
+
+    def test_warm_up_leaves_results_unchanged(self):
+        rng = np.random.RandomState(0)
+        recognizer = FaceRecognizer(rng.rand(16*16)*255, np.linalg.qr(rng.randn(16*16, 10))[0].T, dict(),
+                                    img_shape=(16,16), thresh=10)
+        faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(3)]
+        recognizer.add_known_faces(['a', 'b'], faces[:2])
+
+        warm_up(None, recognizer)
+        names, _ = recognizer.recognize_batch(faces)
+        self.assertEqual(names, ['a', 'b', None])
+        self.assertEqual(len(recognizer.gallery), 2)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,59 @@
+import unittest
+
+import numpy as np
+
+from components.face_recognizer import FaceRecognizer
+from components.tracker import FaceTracker, iou
+
+class TestFaceTracker(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(0)
+        mean_face = rng.rand(16*16)*255
+        facespace = np.linalg.qr(rng.randn(16*16, 10))[0].T
+        self.faces = [rng.randint(0, 256, (16,16)).astype(np.uint8) for _ in range(2)]
+        self.recognizer = FaceRecognizer(mean_face, facespace, dict(), img_shape=(16,16), thresh=10)
+        self.recognizer.add_known_faces(['a', 'b'], self.faces)
+        self.frame = np.zeros((120, 160), dtype=np.uint8)
+
+    def test_iou(self):
+        self.assertEqual(iou((0, 0, 10, 10), (0, 0, 10, 10)), 1.0)
+        self.assertEqual(iou((0, 0, 10, 10), (20, 20, 10, 10)), 0.0)
+        self.assertAlmostEqual(iou((0, 0, 10, 10), (5, 0, 10, 10)), 50/150.)
+
+    def test_overlapping_detections_keep_their_track(self):
+        tracker = FaceTracker(self.recognizer)
+        first = tracker.update(self.frame, [(10, 10, 30, 30), (100, 10, 30, 30)], self.faces)
+        second = tracker.update(self.frame, [(102, 12, 30, 30), (12, 11, 30, 30)], self.faces[::-1])
+
+        ids = {t.bbox[0] // 50: t.track_id for t in first}
+        self.assertEqual({t.bbox[0] // 50: t.track_id for t in second}, ids)
+        self.assertEqual(sorted(t.name for t in second), ['a', 'b'])
+
+    def test_recognition_runs_once_per_track_and_interval(self):
+        tracker = FaceTracker(self.recognizer, recognize_every=5)
+        for _ in range(5):
+            tracks = tracker.update(self.frame, [(10, 10, 30, 30)], self.faces[:1])
+        self.assertEqual(tracker.recognitions, 1)
+        self.assertEqual(tracks[0].name, 'a')
+
+        tracker.update(self.frame, [(10, 10, 30, 30)], self.faces[:1])
+        self.assertEqual(tracker.recognitions, 2)
+
+    def test_reset_recognition_recognizes_again(self):
+        tracker = FaceTracker(self.recognizer)
+        tracker.update(self.frame, [(10, 10, 30, 30)], self.faces[:1])
+        tracker.reset_recognition()
+        tracker.update(self.frame, [(10, 10, 30, 30)], self.faces[:1])
+        self.assertEqual(tracker.recognitions, 2)
+
+    def test_lost_tracks_are_dropped(self):
+        tracker = FaceTracker(self.recognizer, max_missed=2)
+        tracker.update(self.frame, [(10, 10, 30, 30)], self.faces[:1])
+        for _ in range(2):
+            self.assertEqual(tracker.update(self.frame, [], []), [])
+            self.assertEqual(len(tracker.tracks), 1)
+        tracker.update(self.frame, [], [])
+        self.assertEqual(tracker.tracks, [])
+
+if __name__ == "__main__":
+    unittest.main()